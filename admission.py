@@ -0,0 +1,159 @@
+import time
+
+
+class TokenBucket:
+    """
+    Tokens refill at `rate` per second up to `burst`. Messages take a token
+    only if there is one, bytes are reserved ahead and paid back by waiting.
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float | None = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take `amount` tokens, going into debt if needed, and return the
+        seconds until the debt is paid back.
+        """
+        self.tokens -= amount
+        return max(-self.tokens / self.rate, 0.0)
+
+
+class ClientState:
+    __slots__ = ("messages", "bytes", "transfers")
+
+    def __init__(self, messages: TokenBucket, bytes: TokenBucket):
+        self.messages = messages
+        self.bytes = bytes
+        self.transfers = 0
+
+
+class AdmissionController:
+    """
+    Per-client and global limits checked before any database or disk work.
+    Text messages and upload starts take a message token from the bucket of
+    their client and from the global one, and are rejected when either is
+    empty. Received bytes are reserved from the byte buckets, and the
+    connection that overdraws them stops being read until they refill, which
+    slows down that client only. Uploads are also limited in size and in
+    number at a time per client and overall.
+
+    Clients are forgotten once their buckets are full again and they have no
+    transfer, checked every `sweep_interval` seconds.
+    """
+
+    def __init__(self,
+                 message_rate: float = 20,
+                 message_burst: float = 50,
+                 byte_rate: float = 1024 * 1024,
+                 byte_burst: float = 4 * 1024 * 1024,
+                 global_message_rate: float = 1000,
+                 global_message_burst: float = 2000,
+                 global_byte_rate: float = 50 * 1024 * 1024,
+                 global_byte_burst: float = 100 * 1024 * 1024,
+                 max_upload_size: int = 100 * 1024 * 1024,
+                 max_transfers_per_client: int = 4,
+                 max_transfers: int = 64,
+                 idle_timeout: float = 30,
+                 sweep_interval: float = 60):
+        self.__message_rate = message_rate
+        self.__message_burst = message_burst
+        self.__byte_rate = byte_rate
+        self.__byte_burst = byte_burst
+        self.__messages = TokenBucket(global_message_rate,
+                                      global_message_burst)
+        self.__bytes = TokenBucket(global_byte_rate, global_byte_burst)
+        self.__max_upload_size = max_upload_size
+        self.__max_transfers_per_client = max_transfers_per_client
+        self.__max_transfers = max_transfers
+        self.idle_timeout = idle_timeout  # seconds an upload may go silent
+        self.__sweep_interval = sweep_interval
+        self.__swept = time.monotonic()
+        self.__clients: dict[int, ClientState] = {}
+        self.__transfers = 0
+
+    def admit_message(self, client_id: int) -> str | None:
+        """
+        Take a message token. Return why the message is rejected, if it is.
+        """
+        now = time.monotonic()
+        state = self.__state(client_id, now)
+        state.messages.refill(now)
+        self.__messages.refill(now)
+        if state.messages.tokens < 1:
+            return "client message rate"
+        if self.__messages.tokens < 1:
+            return "global message rate"
+        state.messages.tokens -= 1
+        self.__messages.tokens -= 1
+        return None
+
+    def admit_upload(self, client_id: int, size: int) -> str | None:
+        """
+        Take a message token and a transfer slot for an upload of `size`
+        bytes. Return why the upload is rejected, if it is. An admitted
+        upload gives its slot back with `release_upload`.
+        """
+        if size > self.__max_upload_size:
+            return "upload size"
+        reason = self.admit_message(client_id)
+        if reason is not None:
+            return reason
+        state = self.__clients[client_id]
+        if state.transfers >= self.__max_transfers_per_client:
+            return "client transfers"
+        if self.__transfers >= self.__max_transfers:
+            return "global transfers"
+        state.transfers += 1
+        self.__transfers += 1
+        return None
+
+    def release_upload(self, client_id: int):
+        state = self.__clients.get(client_id)
+        if state is not None and state.transfers > 0:
+            state.transfers -= 1
+            self.__transfers -= 1
+
+    def reserve_bytes(self, client_id: int, size: int) -> float:
+        """
+        Reserve `size` received bytes. Return the seconds to wait before
+        reading from the client again.
+        """
+        now = time.monotonic()
+        state = self.__state(client_id, now)
+        state.bytes.refill(now)
+        self.__bytes.refill(now)
+        return max(state.bytes.reserve(size), self.__bytes.reserve(size))
+
+    def get_stats(self) -> dict:
+        return {"clients": len(self.__clients), "transfers": self.__transfers}
+
+    def __state(self, client_id: int, now: float) -> ClientState:
+        if now - self.__swept > self.__sweep_interval:
+            self.__sweep(now)
+        state = self.__clients.get(client_id)
+        if state is None:
+            # refilled at `now` next, so they start full
+            state = self.__clients[client_id] = ClientState(
+                TokenBucket(self.__message_rate, self.__message_burst, now),
+                TokenBucket(self.__byte_rate, self.__byte_burst, now))
+        return state
+
+    def __sweep(self, now: float):
+        self.__swept = now
+        for client_id, state in list(self.__clients.items()):
+            state.messages.refill(now)
+            state.bytes.refill(now)
+            if (not state.transfers and
+                    state.messages.tokens >= state.messages.burst and
+                    state.bytes.tokens >= state.bytes.burst):
+                del self.__clients[client_id]
@@ -0,0 +1,304 @@
+import bisect
+import heapq
+import itertools
+import json
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+
+EPOCH = datetime(1970, 1, 1)  # periods are aligned on it
+MAGIC = b"BBSEG001"
+TRAILER = struct.Struct("!Q8s")  # offset of the index, magic
+
+# (id, content, created_at, status value, media status value, media info) of
+# an archived message, segments written before media processing have no media
+Row = tuple[int, str, datetime, str, str | None, dict | None]
+Key = tuple[datetime, int]  # (created_at, id) order of the messages of a chat
+
+
+class Segment:
+    """
+    A read-only file of the messages of one closed time period. The messages
+    of each chat are stored as one zlib-compressed block, sorted by
+    (created_at, id), and the index at the end of the file maps every chat_id
+    to its block and to the keys of its first and last messages, so a chat
+    is read without touching the other blocks, and a segment holding none
+    of the messages wanted is skipped without reading its block.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            file.seek(-TRAILER.size, os.SEEK_END)
+            index_offset, magic = TRAILER.unpack(file.read(TRAILER.size))
+            if magic != MAGIC:
+                raise ValueError("%s is not an archive segment" % path)
+            file.seek(index_offset)
+            index = json.loads(
+                zlib.decompress(file.read()[:-TRAILER.size]))
+        # chat_id -> (offset, length, count)
+        self.chats: dict[int, tuple[int, int, int]] = {}
+        # chat_id -> (first key, last key), missing in older segments
+        self.bounds: dict[int, tuple[Key, Key]] = {}
+        for chat_id, block in index["chats"].items():
+            offset, length, count, *bounds = block
+            self.chats[int(chat_id)] = (offset, length, count)
+            if bounds:
+                first_at, first_id, last_at, last_id = bounds
+                self.bounds[int(chat_id)] = (
+                    (datetime.fromisoformat(first_at), first_id),
+                    (datetime.fromisoformat(last_at), last_id))
+        self.rows = index["rows"]
+
+    def read_chat(self, chat_id: int) -> list[Row]:
+        block = self.chats.get(chat_id)
+        if block is None:
+            return []
+        offset, length, _ = block
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            data = file.read(length)
+        return [(id, content, datetime.fromisoformat(created_at), status,
+                 *(media or (None, None)))
+                for id, content, created_at, status, *media in json.loads(
+                    zlib.decompress(data))]
+
+    def __iter__(self) -> Iterator[tuple[int, Row]]:
+        for chat_id in self.chats:
+            for row in self.read_chat(chat_id):
+                yield chat_id, row
+
+    @staticmethod
+    def write(path: str, rows: Iterable[tuple[int, Row]]):
+        """
+        Write a segment from (chat_id, row) pairs sorted by chat_id and then
+        by (created_at, id). The file is complete once it appears at `path`.
+        """
+        chats = {}
+        count = 0
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(MAGIC)
+            block, block_chat_id = [], None
+            for chat_id, (id, content, created_at, *values) in rows:
+                if chat_id != block_chat_id and block:
+                    chats[block_chat_id] = Segment.__write_block(file, block)
+                    block = []
+                block_chat_id = chat_id
+                block.append((id, content, created_at.isoformat(), *values))
+                count += 1
+            if block:
+                chats[block_chat_id] = Segment.__write_block(file, block)
+            index_offset = file.tell()
+            file.write(
+                zlib.compress(
+                    json.dumps({
+                        "chats": chats,
+                        "rows": count
+                    }).encode()))
+            file.write(TRAILER.pack(index_offset, MAGIC))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def __write_block(file, block: list) -> tuple:
+        data = zlib.compress(json.dumps(block).encode())
+        offset = file.tell()
+        file.write(data)
+        first, last = block[0], block[-1]
+        return (offset, len(data), len(block), first[2], first[0], last[2],
+                last[0])
+
+
+class ArchiveStore:
+    """
+    Directory of archive segments. Messages are partitioned into periods of
+    `period_days` days, and a period is archived once it is closed, as
+    segments of up to `segment_rows` messages. Opened segments and the most
+    recently read chat blocks are kept in memory, so paging through an
+    archived chat decompresses each block once.
+    """
+
+    def __init__(self,
+                 directory: str = "archive",
+                 period_days: int = 7,
+                 cache_size: int = 64,
+                 segment_rows: int = 10000):
+        self.directory = directory
+        self.period = timedelta(days=period_days)
+        self.segment_rows = segment_rows
+        self.__cache_size = cache_size
+        self.__segments: dict[str, Segment] = {}
+        # (path, chat_id) -> rows of the chat in the segment and their keys
+        self.__blocks: OrderedDict[tuple[str, int],
+                                   tuple[list[Row], list[Key]]] = OrderedDict()
+        self.__lock = threading.Lock()  # read from request and export threads
+        os.makedirs(directory, exist_ok=True)
+
+    def period_start(self, time: datetime) -> datetime:
+        return EPOCH + (time - EPOCH) // self.period * self.period
+
+    def path(self, period_start: datetime, first_id: int) -> str:
+        return os.path.join(
+            self.directory,
+            "messages-%s-%d.seg" % (period_start.strftime("%Y%m%d"), first_id))
+
+    def write(self, period_start: datetime, first_id: int,
+              rows: Iterable[tuple[int, Row]]) -> str:
+        """
+        Write the segment of a period whose first message is `first_id`.
+        """
+        path = self.path(period_start, first_id)
+        Segment.write(path, rows)
+        with self.__lock:
+            self.__segments.pop(path, None)
+        return path
+
+    def iter_rows(self, path: str) -> Iterator[tuple[int, Row]]:
+        """
+        Iterate over the (chat_id, row) of every message of a segment.
+        """
+        return iter(Segment(path))
+
+    def remove(self, path: str):
+        with self.__lock:
+            self.__segments.pop(path, None)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def find(self, paths: list[str], chat_id: int,
+             message_id: int) -> Key | None:
+        """
+        Get the (created_at, id) of an archived message of a chat.
+        """
+        for path in paths:
+            _, keys = self.__read_chat(path, chat_id)
+            for key in keys:
+                if key[1] == message_id:
+                    return key
+        return None
+
+    def read(self,
+             segments: list[tuple[datetime, str]],
+             chat_id: int,
+             limit: int,
+             after: Key | None = None,
+             before: Key | None = None,
+             since: datetime | None = None,
+             until: datetime | None = None,
+             status: str | None = None) -> list[Row]:
+        """
+        Get the first `limit` archived messages of a chat in (created_at, id)
+        order after `after`, or the last `limit` ones before `before` in
+        reverse order. `segments` are the (period start, path) of the
+        segments to read, oldest first. Periods do not overlap, so reading
+        stops at the first period that fills the page. Within a period, the
+        segments whose keys for the chat are all outside the page are not
+        read.
+        """
+        descending = before is not None
+        if descending:
+            segments = segments[::-1]
+        rows = []
+        for period_start, period in itertools.groupby(segments,
+                                                      lambda e: e[0]):
+            if len(rows) == limit:
+                break
+            blocks = []
+            for _, path in period:
+                bounds = self.__bounds(path, chat_id, period_start)
+                if bounds is not None and self.__overlaps(
+                        bounds, after, before, since, until):
+                    blocks.append((bounds, path))
+            # by the key their messages start from in the order of the page
+            blocks.sort(key=lambda block: block[0][1]
+                        if descending else block[0][0],
+                        reverse=descending)
+            for (first, last), path in blocks:
+                if len(rows) == limit and (
+                        last < self.__key(rows[-1])
+                        if descending else first > self.__key(rows[-1])):
+                    break  # the page is full of messages before this block
+                selected = [
+                    row for row in self.__select(path, chat_id, after,
+                                                 before, since, until,
+                                                 descending)
+                    if status is None or row[3] == status
+                ]
+                rows = list(
+                    itertools.islice(
+                        heapq.merge(rows,
+                                    selected,
+                                    key=self.__key,
+                                    reverse=descending), limit))
+        return rows
+
+    def __bounds(self, path: str, chat_id: int,
+                 period_start: datetime) -> tuple[Key, Key] | None:
+        """
+        Get the keys of the first and last messages of a chat in a segment,
+        None if it holds none. Those of older segments are their period's.
+        """
+        segment = self.__segment(path)
+        if chat_id not in segment.chats:
+            return None
+        return segment.bounds.get(
+            chat_id, ((period_start, 0), (period_start + self.period, 0)))
+
+    @staticmethod
+    def __overlaps(bounds: tuple[Key, Key], after: Key | None,
+                   before: Key | None, since: datetime | None,
+                   until: datetime | None) -> bool:
+        first, last = bounds
+        return ((after is None or last > after) and
+                (before is None or first < before) and
+                (since is None or last[0] >= since) and
+                (until is None or first[0] < until))
+
+    @staticmethod
+    def __key(row: Row) -> Key:
+        return row[2], row[0]
+
+    def __select(self, path: str, chat_id: int, after: Key | None,
+                 before: Key | None, since: datetime | None,
+                 until: datetime | None, descending: bool) -> list[Row]:
+        rows, keys = self.__read_chat(path, chat_id)
+        start, end = 0, len(rows)
+        if after is not None:
+            start = bisect.bisect_right(keys, after)
+        if before is not None:
+            end = bisect.bisect_left(keys, before)
+        if since is not None:
+            start = max(start, bisect.bisect_left(keys, (since, 0)))
+        if until is not None:
+            end = min(end, bisect.bisect_left(keys, (until, 0)))
+        selected = rows[start:end]
+        return selected[::-1] if descending else selected
+
+    def __read_chat(self, path: str,
+                    chat_id: int) -> tuple[list[Row], list[Key]]:
+        key = (path, chat_id)
+        with self.__lock:
+            block = self.__blocks.get(key)
+            if block is not None:
+                self.__blocks.move_to_end(key)
+                return block
+        rows = self.__segment(path).read_chat(chat_id)
+        block = (rows, [(created_at, id) for id, _, created_at, *_ in rows])
+        with self.__lock:
+            self.__blocks[key] = block
+            while len(self.__blocks) > self.__cache_size:
+                self.__blocks.popitem(last=False)
+        return block
+
+    def __segment(self, path: str) -> Segment:
+        with self.__lock:
+            segment = self.__segments.get(path)
+            if segment is None:
+                segment = self.__segments[path] = Segment(path)
+            return segment
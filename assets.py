@@ -0,0 +1,78 @@
+import mmap
+import os
+import pickle
+import time
+
+
+class Asset:
+    """
+    A static file memory-mapped once, with its metadata frame precomputed.
+    """
+
+    def __init__(self, path: str, type: str):
+        self.path = path
+        self.type = type
+        stat = os.stat(path)
+        self.mtime = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.__data = b""  # mmap can not map an empty file
+        if self.size:
+            with open(path, "rb") as file:
+                self.__data = mmap.mmap(file.fileno(),
+                                        0,
+                                        access=mmap.ACCESS_READ)
+        self.view = memoryview(self.__data)
+        self.metadata = {
+            "name": os.path.basename(path),
+            "size": self.size,
+            "type": type
+        }
+        self.metadata_frame = pickle.dumps(self.metadata)
+        self.checked_at = time.monotonic()
+
+    def chunks(self, size: int):
+        """
+        Yield the content as zero-copy slices of at most `size` bytes.
+        """
+        for start in range(0, self.size, size):
+            yield self.view[start:start + size]
+
+
+class AssetCache:
+    """
+    Cache of static assets sent back to clients. Files are loaded once and
+    reloaded when their mtime changes, which is checked at most every
+    `check_interval` seconds.
+    """
+
+    def __init__(self,
+                 chunk_size: int = 16 * 1024,
+                 check_interval: float = 1.0):
+        self.chunk_size = chunk_size
+        self.__check_interval = check_interval
+        self.__assets: dict[tuple[str, str], Asset] = {}
+
+    def get(self, path: str, type: str) -> Asset | None:
+        """
+        Get the cached asset of a local file, or None if `path` is not one.
+        """
+        key = (path, type)
+        asset = self.__assets.get(key)
+        if asset is None and not os.path.isfile(path):
+            return None
+        if asset is None or self.__is_stale(asset):
+            # readers of the previous mapping keep it alive until they finish
+            asset = Asset(path, type)
+            self.__assets[key] = asset
+        return asset
+
+    def __is_stale(self, asset: Asset) -> bool:
+        now = time.monotonic()
+        if now - asset.checked_at < self.__check_interval:
+            return False
+        asset.checked_at = now
+        try:
+            return os.stat(asset.path).st_mtime_ns != asset.mtime
+        except FileNotFoundError:
+            # keep serving the mapped content of a deleted file
+            return False
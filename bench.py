@@ -0,0 +1,334 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import pickle
+import random
+import sqlite3
+import sys
+import time
+import urllib.request
+
+import websockets
+
+import protocol
+from protocol import FrameType
+
+REJECTED = "Message rejected"  # over an admission limit of the server
+ABORTED = "Transfer aborted"  # dropped by the server before its ack
+TEXT_ACKS = ("Saved message", "Message discarded", REJECTED)
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Stats:
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}  # by message kind
+        self.statuses: dict[str, int] = {}
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def record(self, kind: str, latency: float, status: str):
+        self.latencies.setdefault(kind, []).append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        messages = sum(len(v) for v in self.latencies.values())
+        return {
+            "elapsed_s": elapsed,
+            "messages": messages,
+            "messages_per_s": messages / elapsed,
+            "errors": self.errors,
+            "rejected": self.statuses.get(REJECTED, 0),
+            "aborted": self.statuses.get(ABORTED, 0),
+            "statuses": self.statuses,
+            "bytes_sent_per_s": self.bytes_sent / elapsed,
+            "bytes_received_per_s": self.bytes_received / elapsed,
+            "ack_latency_ms": {
+                kind: {
+                    "count": len(values),
+                    "p50": percentile(values, 50) * 1000,
+                    "p95": percentile(values, 95) * 1000,
+                    "p99": percentile(values, 99) * 1000,
+                    "max": max(values) * 1000,
+                } for kind, values in self.latencies.items()
+            },
+        }
+
+
+class SimulatedClient:
+    """
+    A headless client speaking the real protocol: it sends its timezone,
+    then text messages and uploads, waiting for the ack of each one.
+    """
+
+    def __init__(self, url: str, client_id: int, legacy: bool,
+                 chunk_size: int, stats: Stats):
+        self.__url = "%s/%d" % (url, client_id)
+        self.__client_id = client_id
+        self.__legacy = legacy
+        self.__chunk_size = chunk_size
+        self.__stats = stats
+        self.__ws = None
+        self.__reader = None
+        self.__text_acks: asyncio.Queue = asyncio.Queue()
+        self.__transfer_acks: dict[int, asyncio.Future] = {}
+        self.__transfer_ids = itertools.count(1)
+
+    async def connect(self):
+        self.__ws = await websockets.connect(
+            self.__url,
+            subprotocols=None if self.__legacy else [protocol.SUBPROTOCOL],
+            max_size=None)
+        if self.__ws.subprotocol != protocol.SUBPROTOCOL:
+            self.__legacy = True
+        self.__reader = asyncio.create_task(self.__read_loop())
+        await self.__send("UTC")
+
+    async def close(self):
+        self.__reader.cancel()
+        await self.__ws.close()
+
+    async def send_text(self, message: str):
+        start = time.perf_counter()
+        await self.__send(message)
+        status = await self.__text_ack()
+        self.__stats.record("text", time.perf_counter() - start, status)
+
+    async def upload(self, type: str, size: int):
+        data = os.urandom(min(size, self.__chunk_size))
+        metadata = {
+            "name": "bench_%d.bin" % self.__client_id,
+            "size": size,
+            "type": type,
+            "client_id": self.__client_id
+        }
+        start = time.perf_counter()
+        if self.__legacy:
+            await self.__send(pickle.dumps(metadata))
+            for offset in range(0, size, self.__chunk_size):
+                await self.__send(data[:size - offset])
+            status = await self.__text_ack()
+        else:
+            transfer_id = next(self.__transfer_ids)
+            ack = asyncio.get_running_loop().create_future()
+            self.__transfer_acks[transfer_id] = ack
+            await self.__send(
+                protocol.encode_json(FrameType.META, transfer_id, metadata))
+            for offset in range(0, size, self.__chunk_size):
+                if ack.done():
+                    break  # rejected or aborted, the rest is not read
+                await self.__send(
+                    protocol.encode(FrameType.DATA, transfer_id,
+                                    data[:size - offset], offset))
+            status = await ack
+        self.__stats.record(type, time.perf_counter() - start, status)
+
+    async def __send(self, message: str | bytes):
+        self.__stats.bytes_sent += len(message)
+        await self.__ws.send(message)
+
+    async def __text_ack(self) -> str:
+        status = await self.__text_acks.get()
+        if status is None:
+            self.__text_acks.put_nowait(None)  # for the next waiter
+            raise ConnectionError("Connection closed by the server")
+        return status
+
+    async def __read_loop(self):
+        try:
+            await self.__read_messages()
+        finally:
+            # fail whatever is still waiting for an ack
+            self.__text_acks.put_nowait(None)
+            for ack in self.__transfer_acks.values():
+                if not ack.done():
+                    ack.set_exception(
+                        ConnectionError("Connection closed by the server"))
+
+    async def __read_messages(self):
+        legacy_bytes_left = 0  # of a file the server is streaming back
+        async for message in self.__ws:
+            self.__stats.bytes_received += len(message)
+            if isinstance(message, str):
+                if message in TEXT_ACKS:
+                    self.__text_acks.put_nowait(message)
+            elif self.__legacy:
+                # skip the canned files the server sends after an upload
+                if legacy_bytes_left == 0:
+                    legacy_bytes_left = pickle.loads(message)["size"]
+                else:
+                    legacy_bytes_left -= len(message)
+            else:
+                frame = protocol.decode(message)
+                if frame.type in (FrameType.ACK, FrameType.ABORT):
+                    ack = self.__transfer_acks.pop(frame.transfer_id, None)
+                    if ack is not None and not ack.done():
+                        ack.set_result(frame.text() if frame.type ==
+                                       FrameType.ACK else ABORTED)
+
+
+def load_replay(path: str) -> list[dict]:
+    """
+    Load recorded traffic, one JSON object per line. A line with a `size`
+    is replayed as an upload of its `type`, any other line as a text message
+    made of its `text`, `body` or `title` field.
+    """
+    operations = []
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "size" in record:
+                operations.append({
+                    "type": record.get("type", "video"),
+                    "size": int(record["size"])
+                })
+            else:
+                text = record.get("text") or record.get("body") or record.get(
+                    "title") or line.strip()
+                operations.append({"type": "text", "text": text})
+    return operations
+
+
+def build_operations(args) -> list[dict]:
+    operations = [{
+        "type": "text",
+        "text": "x" * args.text_size
+    } for _ in range(args.messages)]
+    operations += [{
+        "type": "voice",
+        "size": args.voice_size
+    } for _ in range(args.voice)]
+    operations += [{
+        "type": "video",
+        "size": args.video_size
+    } for _ in range(args.video)]
+    random.shuffle(operations)
+    return operations
+
+
+def count_rows(db_path: str | None) -> int | None:
+    if not db_path:
+        return None
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM message").fetchone()[0]
+
+
+def writer_rows(http: str | None) -> int | None:
+    if not http:
+        return None
+    with urllib.request.urlopen("%s/stats/writer" % http) as response:
+        return json.loads(response.read())["rows"]
+
+
+async def run_client(args, client_id: int, operations: list[dict],
+                     stats: Stats):
+    client = SimulatedClient(args.url, client_id, args.legacy,
+                             args.chunk_size, stats)
+    try:
+        await client.connect()
+        for operation in operations:
+            if operation["type"] == "text":
+                await client.send_text(operation["text"])
+            else:
+                await client.upload(operation["type"], operation["size"])
+        await client.close()
+    except Exception as e:
+        stats.errors += 1
+        print("client %d failed: %r" % (client_id, e), file=sys.stderr)
+
+
+async def run(args) -> dict:
+    if args.replay:
+        replayed = load_replay(args.replay)
+        # deal the recorded operations to the clients round-robin
+        plans = [replayed[i::args.clients] for i in range(args.clients)]
+    else:
+        plans = [build_operations(args) for _ in range(args.clients)]
+
+    stats = Stats()
+    rows_before = count_rows(args.db)
+    writer_before = writer_rows(args.http)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(client_id, operations):
+        async with semaphore:
+            await run_client(args, client_id, operations, stats)
+
+    first_id = args.client_id_base
+    start = time.perf_counter()
+    await asyncio.gather(*(limited(first_id + i, operations)
+                           for i, operations in enumerate(plans)))
+    elapsed = time.perf_counter() - start
+
+    report = stats.report(elapsed)
+    report["clients"] = args.clients
+    rows_after = count_rows(args.db)
+    writer_after = writer_rows(args.http)
+    if rows_before is not None:
+        report["db_rows_per_s"] = (rows_after - rows_before) / elapsed
+    elif writer_before is not None:
+        report["db_rows_per_s"] = (writer_after - writer_before) / elapsed
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load generator and latency benchmark for the server.")
+    parser.add_argument("--url", default="ws://localhost:8000/ws")
+    parser.add_argument("--http",
+                        default="http://localhost:8000",
+                        help="base URL of the HTTP API, for writer stats")
+    parser.add_argument("--db", help="server database to count rows in")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--concurrency",
+                        type=int,
+                        default=1000,
+                        help="clients connected at the same time")
+    parser.add_argument("--client-id-base",
+                        type=int,
+                        default=random.randrange(1 << 30),
+                        help="client_id of the first simulated client")
+    parser.add_argument("--messages",
+                        type=int,
+                        default=10,
+                        help="text messages per client")
+    parser.add_argument("--text-size", type=int, default=64)
+    parser.add_argument("--voice",
+                        type=int,
+                        default=0,
+                        help="voice uploads per client")
+    parser.add_argument("--voice-size", type=int, default=256 * 1024)
+    parser.add_argument("--video",
+                        type=int,
+                        default=0,
+                        help="video uploads per client")
+    parser.add_argument("--video-size", type=int, default=1024 * 1024)
+    parser.add_argument("--chunk-size", type=int, default=16 * 1024)
+    parser.add_argument("--legacy",
+                        action="store_true",
+                        help="use the pickle format instead of frames")
+    parser.add_argument("--replay",
+                        help="JSON lines file of recorded traffic to replay")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    print(output)
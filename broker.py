@@ -0,0 +1,236 @@
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+Envelope = tuple[int | None, int, bytes]  # client_id, kind, payload
+
+
+class Broker:
+    """
+    State shared by the workers of a server: the global connection count,
+    which worker holds the connections of a client, and messages waiting to
+    be delivered by another worker. A message is a (kind, payload) pair of a
+    `Connection` queue item, addressed to a client or to every client when
+    its client_id is None.
+    """
+
+    # seconds between fetches of a worker, None if there is nothing to fetch
+    poll_interval: float | None = None
+
+    async def start(self, worker_id: str):
+        pass
+
+    async def stop(self, worker_id: str):
+        pass
+
+    async def register(self, client_id: int, worker_id: str,
+                       limit: int) -> int | None:
+        """
+        Register a connection unless `limit` connections are registered
+        already. Return a token to unregister it with, or None.
+        """
+        raise NotImplementedError
+
+    async def unregister(self, token: int):
+        raise NotImplementedError
+
+    async def connection_count(self) -> int:
+        raise NotImplementedError
+
+    async def publish(self, client_id: int | None, kind: int, payload,
+                      sender: str):
+        """
+        Queue a message for the workers holding connections of `client_id`,
+        or for every worker if it is None, except the sending worker.
+        """
+        raise NotImplementedError
+
+    async def fetch(self, worker_id: str) -> list[Envelope]:
+        """
+        Take the messages queued for a worker as (client_id, kind, payload).
+        """
+        raise NotImplementedError
+
+
+class LocalBroker(Broker):
+    """
+    Broker of a single worker, everything lives in process memory.
+    """
+
+    def __init__(self):
+        self.__tokens = 0
+        self.__connections: dict[int, int] = {}  # token -> client_id
+
+    async def register(self, client_id: int, worker_id: str,
+                       limit: int) -> int | None:
+        if len(self.__connections) >= limit:
+            return None
+        self.__tokens += 1
+        self.__connections[self.__tokens] = client_id
+        return self.__tokens
+
+    async def unregister(self, token: int):
+        self.__connections.pop(token, None)
+
+    async def connection_count(self) -> int:
+        return len(self.__connections)
+
+    async def publish(self, client_id: int | None, kind: int, payload,
+                      sender: str):
+        # there is no other worker to deliver to
+        pass
+
+    async def fetch(self, worker_id: str) -> list[Envelope]:
+        return []
+
+
+class SQLiteBroker(Broker):
+    """
+    Broker backed by a SQLite file, for workers running on the same machine.
+    Workers refresh a heartbeat whenever they fetch, and the rows of a
+    worker not seen for `worker_ttl` seconds are purged.
+    """
+
+    def __init__(self,
+                 path: str = "broker.db",
+                 worker_ttl: float = 10.0,
+                 poll_interval: float = 0.05):
+        self.poll_interval = poll_interval
+        self.__worker_ttl = worker_ttl
+        self.__executor = ThreadPoolExecutor(max_workers=1,
+                                             thread_name_prefix="broker")
+        self.__conn = sqlite3.connect(path,
+                                      timeout=30,
+                                      isolation_level=None,
+                                      check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.executescript("""
+            CREATE TABLE IF NOT EXISTS worker (
+                worker_id TEXT PRIMARY KEY, seen_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS connection (
+                id INTEGER PRIMARY KEY, client_id INTEGER NOT NULL,
+                worker_id TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS ix_connection_client_id
+                ON connection (client_id);
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY, worker_id TEXT NOT NULL,
+                client_id INTEGER, kind INTEGER NOT NULL, payload BLOB);
+            CREATE INDEX IF NOT EXISTS ix_outbox_worker_id
+                ON outbox (worker_id, id);
+        """)
+
+    async def start(self, worker_id: str):
+        await self.__run(self.__heartbeat, worker_id)
+
+    async def stop(self, worker_id: str):
+        await self.__run(self.__remove_worker, worker_id)
+
+    async def register(self, client_id: int, worker_id: str,
+                       limit: int) -> int | None:
+        return await self.__run(self.__register, client_id, worker_id, limit)
+
+    async def unregister(self, token: int):
+        await self.__run(self.__execute, "DELETE FROM connection WHERE id = ?",
+                         (token,))
+
+    async def connection_count(self) -> int:
+        return await self.__run(self.__count)
+
+    async def publish(self, client_id: int | None, kind: int, payload,
+                      sender: str):
+        await self.__run(self.__publish, client_id, kind, payload, sender)
+
+    async def fetch(self, worker_id: str) -> list[Envelope]:
+        return await self.__run(self.__fetch, worker_id)
+
+    async def __run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.__executor, func, *args)
+
+    def __execute(self, sql: str, params: tuple = ()):
+        return self.__conn.execute(sql, params)
+
+    def __live_since(self) -> float:
+        return time.time() - self.__worker_ttl
+
+    def __count(self) -> int:
+        return self.__conn.execute(
+            """SELECT COUNT(*) FROM connection JOIN worker USING (worker_id)
+               WHERE worker.seen_at >= ?""",
+            (self.__live_since(),)).fetchone()[0]
+
+    def __register(self, client_id: int, worker_id: str,
+                   limit: int) -> int | None:
+        # an immediate transaction makes the count and the insert atomic
+        self.__conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.__count() >= limit:
+                return None
+            return self.__conn.execute(
+                "INSERT INTO connection (client_id, worker_id) VALUES (?, ?)",
+                (client_id, worker_id)).lastrowid
+        finally:
+            self.__conn.execute("COMMIT")
+
+    def __publish(self, client_id: int | None, kind: int, payload,
+                  sender: str):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        else:
+            payload = bytes(payload)
+        if client_id is None:
+            workers = self.__conn.execute(
+                "SELECT worker_id FROM worker WHERE seen_at >= ?",
+                (self.__live_since(),)).fetchall()
+        else:
+            workers = self.__conn.execute(
+                "SELECT DISTINCT worker_id FROM connection WHERE client_id = ?",
+                (client_id,)).fetchall()
+        self.__conn.executemany(
+            """INSERT INTO outbox (worker_id, client_id, kind, payload)
+               VALUES (?, ?, ?, ?)""",
+            [(worker_id, client_id, kind, payload)
+             for worker_id, in workers
+             if worker_id != sender])
+
+    def __fetch(self, worker_id: str) -> list[Envelope]:
+        self.__heartbeat(worker_id)
+        rows = self.__conn.execute(
+            """SELECT id, client_id, kind, payload FROM outbox
+               WHERE worker_id = ? ORDER BY id""", (worker_id,)).fetchall()
+        if not rows:
+            return []
+        self.__conn.execute(
+            "DELETE FROM outbox WHERE worker_id = ? AND id <= ?",
+            (worker_id, rows[-1][0]))
+        return [(client_id, kind, payload)
+                for _, client_id, kind, payload in rows]
+
+    def __heartbeat(self, worker_id: str):
+        self.__conn.execute(
+            """INSERT INTO worker (worker_id, seen_at) VALUES (?, ?)
+               ON CONFLICT (worker_id)
+               DO UPDATE SET seen_at = excluded.seen_at""",
+            (worker_id, time.time()))
+        dead_workers = self.__conn.execute(
+            "SELECT worker_id FROM worker WHERE seen_at < ?",
+            (self.__live_since(),)).fetchall()
+        for dead_worker, in dead_workers:
+            self.__remove_worker(dead_worker)
+
+    def __remove_worker(self, worker_id: str):
+        for table in ("connection", "outbox", "worker"):
+            self.__conn.execute("DELETE FROM %s WHERE worker_id = ?" % table,
+                                (worker_id,))
+
+
+def create_broker(backend: str = "local", **options) -> Broker:
+    """
+    Create the broker configured by the `broker` section of config.yml.
+    """
+    if backend == "local":
+        return LocalBroker(**options)
+    if backend == "sqlite":
+        return SQLiteBroker(**options)
+    raise ValueError("Unknown broker backend %s" % backend)
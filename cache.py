@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import tzinfo
+
+import pytz
+
+
+@dataclass
+class ChatEntry:
+    chats: list  # chats of the client, oldest first
+    tzinfo: tzinfo  # resolved timezone of the first chat
+    expires_at: float
+
+
+class ChatCache:
+    """
+    In-process LRU cache of the chats of a client, keyed by client_id.
+    Entries expire `ttl` seconds after they are stored and the least recently
+    used entry is evicted once `max_size` clients are cached.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__entries: OrderedDict[int, ChatEntry] = OrderedDict()
+        self.__hits = 0
+        self.__misses = 0
+
+    def get(self, client_id: int) -> ChatEntry | None:
+        entry = self.__entries.get(client_id)
+        if entry is not None and entry.expires_at < time.monotonic():
+            del self.__entries[client_id]
+            entry = None
+        if entry is None:
+            self.__misses += 1
+            return None
+        self.__hits += 1
+        self.__entries.move_to_end(client_id)
+        return entry
+
+    def put(self, client_id: int, chats: list) -> ChatEntry:
+        """
+        Cache the chats of a client. `chats` must not be empty.
+        """
+        entry = ChatEntry(chats, pytz.timezone(chats[0].timezone),
+                          time.monotonic() + self.__ttl)
+        self.__entries[client_id] = entry
+        self.__entries.move_to_end(client_id)
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
+        return entry
+
+    def __contains__(self, client_id: int) -> bool:
+        return client_id in self.__entries
+
+    def invalidate(self, client_id: int):
+        self.__entries.pop(client_id, None)
+
+    def get_stats(self) -> dict:
+        return {
+            "size": len(self.__entries),
+            "hits": self.__hits,
+            "misses": self.__misses,
+        }
@@ -1,25 +1,56 @@
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import os
 import pickle
 import sys
 import threading
 import time
 import uuid
 
+import websockets
 from tzlocal import get_localzone
 from websocket import WebSocketApp
 
+import protocol
 from config import config
 from file import File
+from protocol import FrameType
+
+FRAME_CHUNK_SIZE = 16 * 1024  # bytes of a file sent in one data frame
+TEXT_SUCCESS_RESPONSE = "Saved message"
+TEXT_DISCARD_RESPONSE = "Message discarded"
+TEXT_REJECTED_RESPONSE = "Message rejected"
+LEGACY_TRANSFER_ID = 0  # legacy connections carry one transfer at a time
+RESUME_TIMEOUT = 10  # seconds to wait for the server to say where to resume
+
+
+def resume_offset(answer: dict) -> int:
+    """
+    Get the offset to resume an upload from out of the server's answer.
+    """
+    if answer["in_progress"]:
+        # the server has not noticed the previous connection dropped yet
+        raise ConnectionError("Upload %s is still in progress" %
+                              answer["upload_id"])
+    return answer["offset"]
 
 
 class Client:
 
-    def __init__(self, client_id: int):
+    def __init__(self, client_id: int, legacy: bool = False):
         self.__client_id = client_id
         self.__conn = None
         self.__run_app = None
         self.__bytes_left = -1  # number of bytes left to receive in multimedia message
         self.__multimedia_metadata = None
         self.__ready_for_new_message = True
+        self.__legacy = legacy  # do not ask the server for framed messages
+        self.__framed = False  # whether the server accepted framed messages
+        self.__transfer_ids = itertools.count(1)
+        self.__incoming: dict[int, dict] = {}  # metadata of framed transfers
+        self.__resume_queries: dict[int, concurrent.futures.Future] = {}
 
     def init_connection(self):
         """
@@ -30,6 +61,8 @@ class Client:
         def on_message(ws, message):
             if isinstance(message, str):
                 print(message)
+            elif isinstance(message, bytes) and self.__framed:
+                self.__handle_frame(protocol.decode(message))
             elif isinstance(message, bytes):
                 if self.__bytes_left == -1:  # first chunk
                     self.__multimedia_metadata = pickle.loads(message)
@@ -57,11 +90,12 @@ class Client:
             pass
 
         print("init connection with client id %d" % self.__client_id)
-        self.__conn = WebSocketApp("%s/%d" %
-                                   (config["ws_endpoint"], self.__client_id),
-                                   on_message=on_message,
-                                   on_ping=on_ping,
-                                   on_pong=on_pong)
+        self.__conn = WebSocketApp(
+            "%s/%d" % (config["ws_endpoint"], self.__client_id),
+            on_message=on_message,
+            on_ping=on_ping,
+            on_pong=on_pong,
+            subprotocols=None if self.__legacy else [protocol.SUBPROTOCOL])
 
         self.__run_app = threading.Thread(target=self.__conn.run_forever,
                                           kwargs={
@@ -75,6 +109,9 @@ class Client:
             print("waiting for connection")
             time.sleep(1)
         print("connected")
+        # an older server does not accept the subprotocol, fall back to pickle
+        self.__framed = self.__conn.sock.handshake_response.subprotocol == \
+            protocol.SUBPROTOCOL
         self.send_msg(str(get_localzone()))
 
     def get_id(self):
@@ -83,11 +120,11 @@ class Client:
     def send_msg(self, text: str):
         self.__conn.send_text(text)
 
-    def send_voice(self, file_address: str):
-        self.__send_file_stream(file_address, "voice")
+    def send_voice(self, file_address: str, upload_id: str | None = None):
+        self.__send_file_stream(file_address, "voice", upload_id)
 
-    def send_video(self, file_address: str):
-        self.__send_file_stream(file_address, "video")
+    def send_video(self, file_address: str, upload_id: str | None = None):
+        self.__send_file_stream(file_address, "video", upload_id)
 
     def close_connection(self):
         self.__conn.close()
@@ -98,15 +135,312 @@ class Client:
     def is_ready_for_new_message(self): 
         return self.__ready_for_new_message
 
-    def __send_file_stream(self, file_address: str, type: str):
+    def __send_file_stream(self,
+                           file_address: str,
+                           type: str,
+                           upload_id: str | None = None):
+        """
+        Send a file. Sending it again with the same `upload_id` after a
+        dropped connection continues from where the server stopped receiving.
+        """
         file = File(file_address)
         file_metadata = file.get_metadata()
         file_metadata["type"] = type
         file_metadata["client_id"] = self.__client_id
-        self.__conn.send_bytes(pickle.dumps(file_metadata))
+        if upload_id is not None and not self.__framed:
+            raise ValueError("Resumable uploads need framed messages")
+        if not self.__framed:
+            self.__conn.send_bytes(pickle.dumps(file_metadata))
+            for chunk in file.get_bytes_stream(256):
+                self.__conn.send_bytes(chunk)
+            return
+
+        offset = 0
+        if upload_id is not None:
+            offset = self.__query_resume_offset(upload_id)
+            file_metadata["upload_id"] = upload_id
+            file_metadata["offset"] = offset
+        transfer_id = next(self.__transfer_ids)
+        self.__conn.send_bytes(
+            protocol.encode_json(FrameType.META, transfer_id, file_metadata))
+        for chunk in file.get_bytes_stream(FRAME_CHUNK_SIZE, offset):
+            self.__conn.send_bytes(
+                protocol.encode(FrameType.DATA, transfer_id, chunk, offset))
+            offset += len(chunk)
+
+    def __query_resume_offset(self, upload_id: str) -> int:
+        """
+        Ask the server how much of an upload it already has.
+        """
+        transfer_id = next(self.__transfer_ids)
+        answer = concurrent.futures.Future()
+        self.__resume_queries[transfer_id] = answer
+        self.__conn.send_bytes(
+            protocol.encode_json(FrameType.RESUME, transfer_id,
+                                 {"upload_id": upload_id}))
+        return resume_offset(answer.result(RESUME_TIMEOUT))
+
+    def __handle_frame(self, frame: protocol.Frame):
+        """
+        Handle a frame from the server. Frames of several incoming files can
+        be interleaved, each file is tracked by its transfer id.
+        """
+        if frame.type == FrameType.ACK:
+            print(frame.text())
+        elif frame.type == FrameType.RESUME:
+            answer = self.__resume_queries.pop(frame.transfer_id, None)
+            if answer is not None:
+                answer.set_result(frame.json())
+        elif frame.type == FrameType.META:
+            metadata = frame.json()
+            metadata["bytes_left"] = metadata["size"]
+            self.__incoming[frame.transfer_id] = metadata
+            print(metadata)
+        elif frame.type == FrameType.DATA:
+            metadata = self.__incoming[frame.transfer_id]
+            filename = "CLIENT_%d_RECEIVED_%s" % (self.__client_id,
+                                                  metadata["name"])
+            with open(filename, "r+b" if frame.offset else "wb") as file:
+                file.seek(frame.offset)
+                file.write(frame.payload)
+            metadata["bytes_left"] -= len(frame.payload)
+            if metadata["bytes_left"] == 0:
+                print("File received")
+                del self.__incoming[frame.transfer_id]
+        elif frame.type == FrameType.ABORT:
+            self.__incoming.pop(frame.transfer_id, None)
+
+
+class AsyncClient:
+    """
+    Asyncio client. Text messages are pipelined without waiting for their
+    acks, and several files can be uploaded at the same time. Every send
+    returns a future that resolves to the server's status text.
+    """
+
+    def __init__(self,
+                 client_id: int,
+                 chunk_size: int = 64 * 1024,
+                 max_uploads: int = 4,
+                 legacy: bool = False):
+        self.__client_id = client_id
+        self.__chunk_size = chunk_size
+        self.__legacy = legacy
+        self.__ws = None
+        self.__reader: asyncio.Task | None = None
+        # uploads share the socket, the send buffer limits bytes in flight
+        self.__uploads = asyncio.Semaphore(1 if legacy else max_uploads)
+        self.__send_lock = asyncio.Lock()
+        self.__text_acks: collections.deque = collections.deque()
+        self.__transfer_acks: dict[int, asyncio.Future] = {}
+        self.__transfer_ids = itertools.count(1)
+        self.__incoming: dict[int, dict] = {}  # metadata of incoming files
+        self.__resume_queries: dict[int, asyncio.Future] = {}
+
+    async def connect(self, timezone: str | None = None):
+        """
+        Connect to the server and send the client's timezone.
+        """
+        self.__ws = await websockets.connect(
+            "%s/%d" % (config["ws_endpoint"], self.__client_id),
+            subprotocols=None if self.__legacy else [protocol.SUBPROTOCOL],
+            max_size=None)
+        # an older server does not accept the subprotocol, fall back to pickle
+        if self.__ws.subprotocol != protocol.SUBPROTOCOL:
+            self.__legacy = True
+            self.__uploads = asyncio.Semaphore(1)
+        self.__reader = asyncio.create_task(self.__read_loop())
+        async with self.__send_lock:
+            await self.__ws.send(timezone or str(get_localzone()))
+
+    async def close(self):
+        await self.__ws.close()
+        await asyncio.gather(self.__reader, return_exceptions=True)
+
+    def get_id(self):
+        return self.__client_id
+
+    async def send_msg(self, text: str) -> asyncio.Future:
+        """
+        Send a text message and return a future of its ack.
+        """
+        ack = asyncio.get_running_loop().create_future()
+        async with self.__send_lock:
+            # acks of text messages come back in the order they were sent
+            self.__text_acks.append(ack)
+            await self.__ws.send(text)
+        return ack
+
+    async def send_voice(self,
+                         file_address: str,
+                         upload_id: str | None = None) -> asyncio.Future:
+        return await self.__start_upload(file_address, "voice", upload_id)
+
+    async def send_video(self,
+                         file_address: str,
+                         upload_id: str | None = None) -> asyncio.Future:
+        return await self.__start_upload(file_address, "video", upload_id)
+
+    async def __start_upload(self, file_address: str, type: str,
+                             upload_id: str | None) -> asyncio.Future:
+        """
+        Start uploading a file in the background once an upload slot is
+        free, and return a future of its ack. Sending it again with the same
+        `upload_id` after a dropped connection continues from where the
+        server stopped receiving.
+        """
+        if upload_id is not None and self.__legacy:
+            raise ValueError("Resumable uploads need framed messages")
+        await self.__uploads.acquire()
+        ack = asyncio.get_running_loop().create_future()
+        task = asyncio.create_task(
+            self.__upload(file_address, type, upload_id, ack))
+        task.add_done_callback(lambda _: self.__uploads.release())
+        return ack
+
+    async def __upload(self, file_address: str, type: str,
+                       upload_id: str | None, ack: asyncio.Future):
+        try:
+            file = await asyncio.to_thread(File, file_address)
+            metadata = await asyncio.to_thread(file.get_metadata)
+            metadata["type"] = type
+            metadata["client_id"] = self.__client_id
+            offset = 0
+            if upload_id is not None:
+                offset = await self.__query_resume_offset(upload_id)
+                metadata["upload_id"] = upload_id
+                metadata["offset"] = offset
+            stream = file.get_bytes_stream(self.__chunk_size, offset)
+            if self.__legacy:
+                await self.__send_legacy(metadata, stream, ack)
+            else:
+                await self.__send_frames(metadata, stream, ack, offset)
+        except Exception as e:
+            if not ack.done():
+                ack.set_exception(e)
+
+    async def __query_resume_offset(self, upload_id: str) -> int:
+        """
+        Ask the server how much of an upload it already has.
+        """
+        transfer_id = next(self.__transfer_ids)
+        answer = asyncio.get_running_loop().create_future()
+        self.__resume_queries[transfer_id] = answer
+        async with self.__send_lock:
+            await self.__ws.send(
+                protocol.encode_json(FrameType.RESUME, transfer_id,
+                                     {"upload_id": upload_id}))
+        return resume_offset(await asyncio.wait_for(answer, RESUME_TIMEOUT))
+
+    async def __send_frames(self, metadata: dict, stream, ack: asyncio.Future,
+                            offset: int):
+        transfer_id = next(self.__transfer_ids)
+        self.__transfer_acks[transfer_id] = ack
+        async with self.__send_lock:
+            await self.__ws.send(
+                protocol.encode_json(FrameType.META, transfer_id, metadata))
+        # the lock is taken per chunk so other messages interleave
+        while chunk := await asyncio.to_thread(next, stream, None):
+            if ack.done():
+                # rejected by the server, or aborted on its side already
+                if not ack.cancelled() and ack.exception() is None:
+                    async with self.__send_lock:
+                        await self.__ws.send(
+                            protocol.encode(FrameType.ABORT, transfer_id))
+                return
+            async with self.__send_lock:
+                await self.__ws.send(
+                    protocol.encode(FrameType.DATA, transfer_id, chunk,
+                                    offset))
+            offset += len(chunk)
+
+    async def __send_legacy(self, metadata: dict, stream, ack: asyncio.Future):
+        chunks = [pickle.dumps(metadata)]
+        while chunk := await asyncio.to_thread(next, stream, None):
+            chunks.append(chunk)
+            if len(chunks) < 2:
+                continue
+            async with self.__send_lock:
+                await self.__ws.send(chunks.pop(0))
+        # the ack of the file is queued with the one of its last chunk
+        async with self.__send_lock:
+            self.__text_acks.append(ack)
+            for chunk in chunks:
+                await self.__ws.send(chunk)
+
+    async def __read_loop(self):
+        try:
+            async for message in self.__ws:
+                if isinstance(message, str):
+                    self.__handle_text(message)
+                elif self.__legacy:
+                    await self.__handle_legacy_bytes(message)
+                else:
+                    await self.__handle_frame(protocol.decode(message))
+        finally:
+            error = ConnectionError("Connection closed")
+            for ack in [
+                    *self.__text_acks, *self.__transfer_acks.values(),
+                    *self.__resume_queries.values()
+            ]:
+                if not ack.done():
+                    ack.set_exception(error)
+
+    def __handle_text(self, message: str):
+        if message in (TEXT_SUCCESS_RESPONSE, TEXT_DISCARD_RESPONSE,
+                       TEXT_REJECTED_RESPONSE) and self.__text_acks:
+            self.__text_acks.popleft().set_result(message)
+        else:
+            print(message)
+
+    async def __handle_frame(self, frame: protocol.Frame):
+        if frame.type == FrameType.ACK:
+            ack = self.__transfer_acks.pop(frame.transfer_id, None)
+            if ack is not None and not ack.done():
+                ack.set_result(frame.text())
+        elif frame.type == FrameType.RESUME:
+            answer = self.__resume_queries.pop(frame.transfer_id, None)
+            if answer is not None and not answer.done():
+                answer.set_result(frame.json())
+        elif frame.type == FrameType.META:
+            metadata = frame.json()
+            metadata["received"] = 0
+            self.__incoming[frame.transfer_id] = metadata
+        elif frame.type == FrameType.DATA:
+            metadata = self.__incoming[frame.transfer_id]
+            await self.__save_chunk(metadata, frame.offset,
+                                    bytes(frame.payload))
+            if metadata["received"] == metadata["size"]:
+                del self.__incoming[frame.transfer_id]
+        elif frame.type == FrameType.ABORT:
+            self.__incoming.pop(frame.transfer_id, None)
+            ack = self.__transfer_acks.pop(frame.transfer_id, None)
+            if ack is not None and not ack.done():
+                ack.set_exception(ConnectionError("Upload aborted by server"))
+
+    async def __handle_legacy_bytes(self, message: bytes):
+        metadata = self.__incoming.get(LEGACY_TRANSFER_ID)
+        if metadata is None:  # first chunk
+            metadata = pickle.loads(message)
+            metadata["received"] = 0
+            self.__incoming[LEGACY_TRANSFER_ID] = metadata
+            return
+        await self.__save_chunk(metadata, metadata["received"], message)
+        if metadata["received"] == metadata["size"]:
+            del self.__incoming[LEGACY_TRANSFER_ID]
+
+    async def __save_chunk(self, metadata: dict, offset: int, chunk: bytes):
+        filename = "CLIENT_%d_RECEIVED_%s" % (self.__client_id,
+                                              os.path.basename(
+                                                  metadata["name"]))
+        await asyncio.to_thread(self.__write_at, filename, offset, chunk)
+        metadata["received"] += len(chunk)
 
-        for chunk in file.get_bytes_stream(256):
-            self.__conn.send_bytes(chunk)
+    @staticmethod
+    def __write_at(filename: str, offset: int, chunk: bytes):
+        with open(filename, "r+b" if offset else "wb") as file:
+            file.seek(offset)
+            file.write(chunk)
 
 
 if __name__ == "__main__":
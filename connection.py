@@ -0,0 +1,348 @@
+import asyncio
+import enum
+import itertools
+import json
+import os
+import pickle
+import socket
+from typing import AsyncIterator, Iterable
+
+from fastapi import WebSocket
+
+import protocol
+from assets import AssetCache
+from broker import Broker, LocalBroker
+from file import File
+from metrics import Metrics, log
+from protocol import FrameType
+from remote import RemoteSource
+
+
+class Backpressure(enum.Enum):
+    DROP = "drop"  # drop messages that do not fit in the queue
+    # make a reply wait until the queue has room, broadcasts are dropped
+    BLOCK = "block"
+    DISCONNECT = "disconnect"  # close the connection of a slow reader
+
+
+class Connection:
+    """
+    A registered websocket. Outbound messages go through a bounded queue
+    drained by a dedicated writer task, so a slow reader only delays itself.
+    """
+
+    # kinds of queued items
+    TEXT = 1
+    BYTES = 2
+    STREAM = 3  # async iterable of binary messages sent back to back
+    CLOSE = 4
+
+    def __init__(self, websocket: WebSocket, client_id: int, framed: bool,
+                 queue_size: int):
+        self.websocket = websocket
+        self.client_id = client_id
+        self.framed = framed  # whether the connection uses protocol frames
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.writer: asyncio.Task | None = None
+        self.token: int | None = None  # registration in the broker
+        self.closing = False
+        self.dropped = 0
+
+
+class ConnectionManager:
+    """
+    Registry of active connections indexed by websocket and by client_id.
+    The connection count across workers and the delivery of messages to
+    clients connected to another worker go through the broker.
+    """
+
+    def __init__(self,
+                 assets: AssetCache | None = None,
+                 broker: Broker | None = None,
+                 remote: RemoteSource | None = None,
+                 metrics: Metrics | None = None,
+                 max_connections: int = 50,
+                 max_per_client: int = 10,
+                 queue_size: int = 256,
+                 backpressure: str = Backpressure.DROP.value):
+        self.__assets = assets or AssetCache()
+        self.__broker = broker or LocalBroker()
+        self.__remote = remote
+        self.__metrics = metrics or Metrics()
+        self.__worker_id = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.__poller: asyncio.Task | None = None
+        self.__max_connections = max_connections
+        self.__max_per_client = max_per_client
+        self.__queue_size = queue_size
+        self.__backpressure = Backpressure(backpressure)
+        self.__by_socket: dict[WebSocket, Connection] = {}
+        self.__by_client: dict[int, set[Connection]] = {}
+        self.__transfer_ids = itertools.count(1)
+        self.__rejected = 0
+        self.__dropped = 0
+        self.__slow_disconnects = 0
+
+    async def start(self):
+        """
+        Join the broker and start delivering messages of other workers.
+        """
+        await self.__broker.start(self.__worker_id)
+        if self.__broker.poll_interval is not None:
+            self.__poller = asyncio.create_task(self.__poll_loop())
+
+    async def stop(self):
+        if self.__poller is not None:
+            self.__poller.cancel()
+        await self.__broker.stop(self.__worker_id)
+
+    async def connect(self, websocket: WebSocket, client_id: int) -> bool:
+        token = None
+        if len(self.__by_client.get(client_id, ())) < self.__max_per_client:
+            # the limit holds across all workers
+            token = await self.__broker.register(client_id, self.__worker_id,
+                                                 self.__max_connections)
+        if token is None:
+            self.__rejected += 1
+            await websocket.close()
+            return False
+        # use framed messages if the client asks for them
+        framed = protocol.SUBPROTOCOL in websocket.scope.get("subprotocols", [])
+        await websocket.accept(protocol.SUBPROTOCOL if framed else None)
+
+        connection = Connection(websocket, client_id, framed,
+                                self.__queue_size)
+        connection.token = token
+        connection.writer = asyncio.create_task(self.__write_loop(connection))
+        self.__by_socket[websocket] = connection
+        self.__by_client.setdefault(client_id, set()).add(connection)
+        return True
+
+    async def disconnect(self, websocket: WebSocket):
+        connection = self.__by_socket.pop(websocket, None)
+        if connection is None:
+            return
+        connection.writer.cancel()
+        clients = self.__by_client[connection.client_id]
+        clients.discard(connection)
+        if not clients:
+            del self.__by_client[connection.client_id]
+        await self.__broker.unregister(connection.token)
+
+    async def close(self, websocket: WebSocket, code: int = 1000):
+        """
+        Close a connection once the messages queued before are sent.
+        """
+        connection = self.__by_socket.get(websocket)
+        if connection is None:
+            await websocket.close(code)
+            return
+        await self.__enqueue(connection, Connection.CLOSE, code)
+        await asyncio.wait([connection.writer])
+        await self.disconnect(websocket)
+
+    async def send_text(self, message: str, websocket: WebSocket):
+        await self.__send(websocket, Connection.TEXT, message)
+
+    async def send_json(self, data: dict, websocket: WebSocket):
+        await self.__send(websocket, Connection.TEXT, json.dumps(data))
+
+    async def send_frame(self, frame: bytes, websocket: WebSocket):
+        await self.__send(websocket, Connection.BYTES, frame)
+
+    async def send_voice(self, file_address: str, websocket: WebSocket):
+        await self.__send_file_stream(file_address, "voice", websocket)
+
+    async def send_image(self, file_address: str, websocket: WebSocket):
+        await self.__send_file_stream(file_address, "image", websocket)
+
+    async def broadcast(self,
+                        data: str | bytes | dict,
+                        client_ids: list[int] | None = None) -> int:
+        """
+        Send the same message to many clients, or to every client if
+        `client_ids` is None, including clients connected to other workers.
+        The payload is encoded once and shared by all queues, and is never
+        waited for: a full queue drops it or disconnects its reader. Return
+        the number of local connections it was queued for.
+        """
+        if isinstance(data, dict):
+            data = json.dumps(data)
+        kind = Connection.TEXT if isinstance(data, str) else Connection.BYTES
+        if client_ids is None:
+            await self.__broker.publish(None, kind, data, self.__worker_id)
+        else:
+            for client_id in client_ids:
+                await self.__broker.publish(client_id, kind, data,
+                                            self.__worker_id)
+        return self.__deliver(kind, data, client_ids)
+
+    async def connection_count(self) -> int:
+        """
+        Get the number of connections across all workers.
+        """
+        return await self.__broker.connection_count()
+
+    def is_connected(self, websocket: WebSocket) -> bool:
+        return websocket in self.__by_socket
+
+    def is_client_connected(self, client_id: int) -> bool:
+        return client_id in self.__by_client
+
+    def is_framed(self, websocket: WebSocket) -> bool:
+        connection = self.__by_socket.get(websocket)
+        return connection is not None and connection.framed
+
+    def get_stats(self) -> dict:
+        return {
+            "connections": len(self.__by_socket),
+            "clients": len(self.__by_client),
+            "queued": sum(c.queue.qsize() for c in self.__by_socket.values()),
+            "rejected": self.__rejected,
+            "dropped": self.__dropped,
+            "slow_disconnects": self.__slow_disconnects,
+        }
+
+    def __deliver(self, kind: int, payload,
+                  client_ids: list[int] | None) -> int:
+        if client_ids is None:
+            connections = list(self.__by_socket.values())
+        else:
+            connections = [
+                connection for client_id in client_ids
+                for connection in self.__by_client.get(client_id, ())
+            ]
+        # one slow reader must not hold back the others
+        return sum(
+            self.__offer(connection, kind, payload)
+            for connection in connections)
+
+    async def __poll_loop(self):
+        while True:
+            try:
+                messages = await self.__broker.fetch(self.__worker_id)
+            except Exception as e:
+                log("broker_fetch_failed", error=str(e))
+                messages = []
+            for client_id, kind, payload in messages:
+                if kind == Connection.TEXT:
+                    payload = payload.decode()
+                self.__deliver(kind, payload,
+                               None if client_id is None else [client_id])
+            await asyncio.sleep(self.__broker.poll_interval)
+
+    async def __send(self, websocket: WebSocket, kind: int, payload):
+        connection = self.__by_socket.get(websocket)
+        if connection is not None:
+            await self.__enqueue(connection, kind, payload)
+
+    async def __enqueue(self, connection: Connection, kind: int,
+                        payload) -> bool:
+        """
+        Queue a reply for the writer task of a connection, applying the
+        backpressure policy if the queue is full. Return whether it was queued.
+        """
+        if connection.closing:
+            return False
+        if kind == Connection.CLOSE or self.__backpressure == Backpressure.BLOCK:
+            await connection.queue.put((kind, payload))
+            return True
+        return self.__offer(connection, kind, payload)
+
+    def __offer(self, connection: Connection, kind: int, payload) -> bool:
+        """
+        Queue an item without waiting. If the queue is full, the item is
+        dropped, or the connection is closed with the disconnect policy.
+        Return whether it was queued.
+        """
+        if connection.closing:
+            return False
+        try:
+            connection.queue.put_nowait((kind, payload))
+            return True
+        except asyncio.QueueFull:
+            pass
+        if self.__backpressure != Backpressure.DISCONNECT:
+            connection.dropped += 1
+            self.__dropped += 1
+        else:
+            self.__slow_disconnects += 1
+            connection.closing = True
+            # the handler of the connection sees the disconnect and cleans up
+            connection.writer.cancel()
+            asyncio.create_task(connection.websocket.close(1013))
+        return False
+
+    async def __write_loop(self, connection: Connection):
+        websocket = connection.websocket
+        metrics = self.__metrics
+        while True:
+            kind, payload = await connection.queue.get()
+            try:
+                if kind == Connection.TEXT:
+                    await websocket.send_text(payload)
+                    metrics.inc("sent_bytes_total", len(payload))
+                elif kind == Connection.BYTES:
+                    await websocket.send_bytes(payload)
+                    metrics.inc("sent_bytes_total", len(payload))
+                elif kind == Connection.STREAM:
+                    async for message in payload:
+                        await websocket.send_bytes(message)
+                        metrics.inc("sent_bytes_total", len(message))
+                else:
+                    connection.closing = True
+                    await websocket.close(payload)
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # the socket is gone, its handler sees the disconnect
+                connection.closing = True
+                return
+
+    async def __send_file_stream(self, file_address: str, type: str,
+                                 websocket: WebSocket):
+        connection = self.__by_socket.get(websocket)
+        if connection is None:
+            return
+        # local files are served from the asset cache without any disk I/O
+        asset = self.__assets.get(file_address, type)
+        if asset:
+            metadata = asset.metadata
+            chunks = self.__iterate(asset.chunks(self.__assets.chunk_size))
+        else:
+            # remote files are looked up and downloaded off the event loop
+            file = await asyncio.to_thread(File, file_address, self.__remote)
+            metadata = await asyncio.to_thread(file.get_metadata)
+            metadata["type"] = type
+            chunks = file.aget_bytes_stream(256)
+
+        if connection.framed:
+            messages = self.__frames(next(self.__transfer_ids), metadata,
+                                     chunks)
+        else:
+            messages = self.__legacy_messages(
+                asset.metadata_frame if asset else pickle.dumps(metadata),
+                chunks)
+        # the whole file is one queue item so it is never dropped halfway
+        await self.__enqueue(connection, Connection.STREAM, messages)
+
+    @staticmethod
+    async def __iterate(chunks: Iterable) -> AsyncIterator:
+        for chunk in chunks:
+            yield chunk
+
+    @staticmethod
+    async def __legacy_messages(metadata_frame: bytes,
+                                chunks: AsyncIterator) -> AsyncIterator:
+        yield metadata_frame
+        async for chunk in chunks:
+            yield chunk
+
+    @staticmethod
+    async def __frames(transfer_id: int, metadata: dict,
+                       chunks: AsyncIterator) -> AsyncIterator:
+        yield protocol.encode_json(FrameType.META, transfer_id, metadata)
+        offset = 0
+        async for chunk in chunks:
+            yield protocol.encode(FrameType.DATA, transfer_id, chunk, offset)
+            offset += len(chunk)
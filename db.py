@@ -1,10 +1,33 @@
-from sqlalchemy import create_engine
+from sqlalchemy import (bindparam, case, create_engine, delete, event, exists,
+                        func, inspect, select, text, tuple_, update)
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import Session, DeclarativeBase
 from datetime import datetime
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
-from sqlalchemy import Column, Integer, String, DateTime, Enum
+from sqlalchemy import Column, Integer, String, DateTime, Enum, Index, JSON
+from sqlalchemy.exc import IntegrityError, OperationalError
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import asyncio
 import enum
+import functools
+import heapq
+
+from archive import ArchiveStore
+from cache import ChatCache, ChatEntry
+
+CONTENT_PREFIX = "sha256:"  # of Message.content pointing at a stored blob
+
+# full-text index of the messages, kept when they are archived; its rowid is
+# the message id and its other columns are stored as in the message table
+CREATE_SEARCH_INDEX = text(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5("
+    "content, chat_id UNINDEXED, created_at UNINDEXED, status UNINDEXED, "
+    "tokenize='unicode61 remove_diacritics 2')")
+INDEX_MESSAGE = text(
+    "INSERT INTO message_search(rowid, content, chat_id, created_at, status) "
+    "VALUES (:id, :content, :chat_id, :created_at, :status)")
 
 
 class Base(DeclarativeBase):
@@ -13,6 +36,7 @@ class Base(DeclarativeBase):
 
 class Chat(Base):
     __tablename__ = "chat"
+    __table_args__ = (Index("ix_chat_client_id", "client_id"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     client_id: Mapped[int] = mapped_column(Integer)
     created_at: Mapped[datetime] = mapped_column(DateTime)
@@ -28,48 +52,950 @@ class Message(Base):
         SUCCESS = "success"
         UNSUCCESS = "unsuccess"
 
+    class MediaStatus(enum.Enum):
+        PENDING = "pending"  # waiting for the media processor
+        VALID = "valid"
+        INVALID = "invalid"  # does not match its declared size or type
+        FAILED = "failed"  # could not be read
+
     __tablename__ = "message"
+    # keyset pagination walks a chat in (created_at, id) order
+    __table_args__ = (Index("ix_message_chat_id_created_at_id", "chat_id",
+                            "created_at", "id"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     chat_id: Mapped[int] = mapped_column(Integer)
     content: Mapped[str] = mapped_column(String)
     created_at: Mapped[datetime] = mapped_column(DateTime)
     status: Mapped[Status] = mapped_column(Enum(Status))
+    # set on stored media only, `media_info` holds the declared type and size
+    # and what the media processor found in the file
+    media_status: Mapped[MediaStatus | None] = mapped_column(
+        Enum(MediaStatus), nullable=True)
+    media_info: Mapped[dict | None] = mapped_column(JSON, nullable=True)
 
     def __repr__(self):
         return f"<Message(id={self.id}, chat_id={self.chat_id}, content={self.content}, created_at={self.created_at})>"
 
 
+@dataclass(slots=True)
+class ChatRow:
+    id: int
+    client_id: int
+    created_at: datetime
+    timezone: str
+
+
+@dataclass(slots=True)
+class MessageRow:
+    id: int
+    chat_id: int
+    content: str
+    created_at: datetime
+    status: Message.Status
+    media_status: Message.MediaStatus | None = None
+    media_info: dict | None = None
+
+
+@dataclass(slots=True)
+class SearchResult:
+    id: int
+    chat_id: int
+    content: str
+    created_at: datetime
+    status: Message.Status
+    rank: float
+    snippet: str
+
+
+class ArchiveSegment(Base):
+    """
+    A compressed, read-only file holding the messages of a closed period
+    that were moved out of the message table.
+    """
+    __tablename__ = "archive_segment"
+    __table_args__ = (Index("ix_archive_segment_period_start_first_id",
+                            "period_start", "first_id"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    path: Mapped[str] = mapped_column(String, unique=True)
+    period_start: Mapped[datetime] = mapped_column(DateTime)
+    first_id: Mapped[int] = mapped_column(Integer)
+    last_id: Mapped[int] = mapped_column(Integer)
+    rows: Mapped[int] = mapped_column(Integer)
+    created_at: Mapped[datetime] = mapped_column(DateTime)
+
+    def __repr__(self):
+        return f"<ArchiveSegment(path={self.path}, rows={self.rows})>"
+
+
+class PartialUpload(Base):
+    """
+    An unfinished upload kept on disk so that its client can resume it.
+    `received` is the number of bytes of `partial_path` that are kept.
+    """
+    __tablename__ = "partial_upload"
+    __table_args__ = (Index("ix_partial_upload_client_id_upload_id",
+                            "client_id",
+                            "upload_id",
+                            unique=True),
+                      Index("ix_partial_upload_updated_at", "updated_at"))
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    client_id: Mapped[int] = mapped_column(Integer)
+    upload_id: Mapped[str] = mapped_column(String)
+    chat_id: Mapped[int] = mapped_column(Integer)
+    type: Mapped[str] = mapped_column(String)
+    path: Mapped[str] = mapped_column(String)  # name the client sent
+    partial_path: Mapped[str] = mapped_column(String)
+    size: Mapped[int] = mapped_column(Integer)
+    received: Mapped[int] = mapped_column(Integer)
+    updated_at: Mapped[datetime] = mapped_column(DateTime)
+
+    def __repr__(self):
+        return f"<PartialUpload(id={self.id}, client_id={self.client_id}, upload_id={self.upload_id}, received={self.received}/{self.size})>"
+
+
+class ChatStats(Base):
+    """
+    Counters of the messages of a chat, updated in the transaction that
+    writes the messages. `media_bytes` is the size of the blobs the messages
+    point at, counted once per message.
+    """
+    __tablename__ = "chat_stats"
+    chat_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    messages: Mapped[int] = mapped_column(Integer)
+    successes: Mapped[int] = mapped_column(Integer)
+    failures: Mapped[int] = mapped_column(Integer)
+    last_message_at: Mapped[datetime] = mapped_column(DateTime)
+    media_bytes: Mapped[int] = mapped_column(Integer)
+
+    def __repr__(self):
+        return f"<ChatStats(chat_id={self.chat_id}, messages={self.messages})>"
+
+
+@dataclass(slots=True)
+class ChatStatsRow:
+    chat_id: int
+    messages: int = 0
+    successes: int = 0
+    failures: int = 0
+    last_message_at: datetime | None = None
+    media_bytes: int = 0
+
+
+@dataclass(slots=True)
+class PartialUploadRow:
+    client_id: int
+    upload_id: str
+    chat_id: int
+    type: str
+    path: str
+    partial_path: str
+    size: int
+    received: int
+
+
+class Blob(Base):
+    """
+    A media file stored once under the SHA-256 digest of its content.
+    """
+    __tablename__ = "blob"
+    __table_args__ = (Index("ix_blob_prefix_digest_size", "prefix_digest",
+                            "size"),)
+    digest: Mapped[str] = mapped_column(String, primary_key=True)
+    size: Mapped[int] = mapped_column(Integer)
+    prefix_digest: Mapped[str] = mapped_column(String)
+    refcount: Mapped[int] = mapped_column(Integer)
+    created_at: Mapped[datetime] = mapped_column(DateTime)
+
+    def __repr__(self):
+        return f"<Blob(digest={self.digest}, size={self.size}, refcount={self.refcount})>"
+
+
 class DB:
+    """
+    Messages are written to the message table only, which keeps the recent
+    ones. With an `archive`, the closed periods are moved out of it into
+    archive segments by `compact_archive`, and messages are read from both
+    tiers as if they were one table. Every message is added to the full-text
+    index in the transaction that writes it.
 
-    def __init__(self, address: str = "sqlite:///local.db"):
-        self.__engine = create_engine(address, echo=True)
-        Base.metadata.create_all(self.__engine, checkfirst=True)
-        self.__session = Session(self.__engine)
+    Every call uses a short-lived session of its own and returns plain rows,
+    so nothing outlives the call. Plain methods are safe to call from any
+    thread. Coroutine methods are the ones called from the event loop, they
+    run their queries on `workers` threads sharing a pool of `pool_size`
+    connections.
+    """
 
-    def get_chat(self, client_id: int):
-        return self.__session.query(Chat).filter_by(client_id=client_id).first()
+    def __init__(self,
+                 address: str = "sqlite:///local.db",
+                 chat_cache: ChatCache | None = None,
+                 archive: ArchiveStore | None = None,
+                 pool_size: int = 10,
+                 workers: int = 4):
+        # the engine is shared with the writer, ingest and export threads
+        self.__engine = create_engine(
+            address,
+            pool_size=pool_size,
+            connect_args={"check_same_thread": False})
+        if self.__engine.dialect.name == "sqlite":
+            event.listen(self.__engine, "connect", self.__set_journal_mode)
+        self.__executor = ThreadPoolExecutor(max_workers=workers,
+                                             thread_name_prefix="db")
+        self.__archive = archive
+        try:
+            Base.metadata.create_all(self.__engine, checkfirst=True)
+            self.__migrate()
+        except (OperationalError, IntegrityError):
+            # another worker process created the schema at the same time
+            Base.metadata.create_all(self.__engine, checkfirst=True)
+            self.__migrate()
+        self.__chat_cache = chat_cache or ChatCache()  # used on the loop only
 
-    def create_chat(self, client_id: int, timezone: str):
-        chat = Chat(client_id=client_id,
-                    created_at=datetime.now(),
-                    timezone=timezone)
-        self.__session.add(chat)
-        self.__session.commit()
+    @property
+    def engine(self):
+        return self.__engine
+
+    async def get_chat(self, client_id: int) -> ChatRow | None:
+        entry = await self.get_chat_entry(client_id)
+        return entry.chats[0] if entry else None
+
+    async def create_chat(self, client_id: int, timezone: str) -> ChatRow:
+        chat = await self.__run(self.__insert_chat, client_id, timezone)
+        if client_id in self.__chat_cache:
+            self.__chat_cache.invalidate(client_id)
+        else:
+            self.__chat_cache.put(client_id, [chat])
         return chat
 
-    def get_chats(self, client_id: int):
-        return self.__session.query(Chat).filter_by(client_id=client_id).all()
+    async def get_chats(self, client_id: int) -> list[ChatRow]:
+        entry = await self.get_chat_entry(client_id)
+        return list(entry.chats) if entry else []
+
+    async def get_chat_entry(self, client_id: int) -> ChatEntry | None:
+        """
+        Get the cached chats of a client along with their resolved timezone,
+        loading them from the database on a cache miss.
+        """
+        entry = self.__chat_cache.get(client_id)
+        if entry is not None:
+            return entry
+        chats = await self.__run(self.__select_chats, client_id)
+        return self.__chat_cache.put(client_id, chats) if chats else None
+
+    def get_chat_cache_stats(self) -> dict:
+        return self.__chat_cache.get_stats()
+
+    async def get_messages(self,
+                           chat_id: int,
+                           limit: int = 10,
+                           offset: int = 0,
+                           after_id: int | None = None,
+                           before_id: int | None = None) -> list[MessageRow]:
+        """
+        Get messages of a chat ordered by (created_at, id). If `after_id` or
+        `before_id` is given, return the page right after or right before that
+        message using the composite index instead of skipping `offset` rows.
+        """
+        return await self.__run(self.__read_messages, chat_id, limit, offset,
+                                after_id, before_id)
 
-    def get_messages(self, chat_id: int, limit: int = 10, offset: int = 0):
-        return self.__session.query(Message).filter_by(
-            chat_id=chat_id).limit(limit).offset(offset).all()
+    def __read_messages(self, chat_id: int, limit: int, offset: int,
+                        after_id: int | None,
+                        before_id: int | None) -> list[MessageRow]:
+        query = select(Message.id, Message.chat_id, Message.content,
+                       Message.created_at, Message.status,
+                       Message.media_status, Message.media_info).where(
+                           Message.chat_id == chat_id)
+        key = tuple_(Message.created_at, Message.id)
+        cursor_id = after_id if after_id is not None else before_id
+        with Session(self.__engine) as session:
+            if cursor_id is None:
+                query = query.order_by(Message.created_at, Message.id)
+                if self.__archive is None:
+                    return self.__rows(
+                        session.execute(query.limit(limit).offset(offset)))
+                # the offset spans both tiers, so both are read up to its end
+                messages = self.__rows(
+                    session.execute(query.limit(limit + offset)))
+                archived = self.__read_archive(chat_id, limit + offset)
+                return self.__merge(messages, archived,
+                                    limit + offset)[offset:]
+
+            cursor_key = self.__find_message(session, chat_id, cursor_id)
+            if cursor_key is None:
+                return []
+            if after_id is not None:
+                messages = self.__rows(
+                    session.execute(
+                        query.where(key > tuple_(*cursor_key)).order_by(
+                            Message.created_at, Message.id).limit(limit)))
+                archived = self.__read_archive(chat_id,
+                                               limit,
+                                               after=cursor_key)
+                return self.__merge(messages, archived, limit)
+            messages = self.__rows(
+                session.execute(
+                    query.where(key < tuple_(*cursor_key)).order_by(
+                        Message.created_at.desc(),
+                        Message.id.desc()).limit(limit)))
+        archived = self.__read_archive(chat_id, limit, before=cursor_key)
+        messages = self.__merge(messages, archived, limit, reverse=True)
+        messages.reverse()
+        return messages
+
+    def export_messages(self,
+                        chat_id: int,
+                        limit: int,
+                        after_id: int | None = None,
+                        since: datetime | None = None,
+                        until: datetime | None = None,
+                        status: Message.Status | None = None
+                        ) -> list[MessageRow]:
+        """
+        Get up to `limit` rows of a chat in (created_at, id) order, right
+        after message `after_id` if given. Use a dedicated short-lived session
+        so it can be called from another thread without holding the database
+        between calls.
+        """
+        query = select(Message.id, Message.chat_id, Message.content,
+                       Message.created_at, Message.status,
+                       Message.media_status, Message.media_info).where(
+                           Message.chat_id == chat_id)
+        if since is not None:
+            query = query.where(Message.created_at >= since)
+        if until is not None:
+            query = query.where(Message.created_at < until)
+        if status is not None:
+            query = query.where(Message.status == status)
+        with Session(self.__engine) as session:
+            cursor_key = None
+            if after_id is not None:
+                cursor_key = self.__find_message(session, chat_id, after_id)
+                if cursor_key is None:
+                    return []
+                query = query.where(
+                    tuple_(Message.created_at, Message.id) > tuple_(
+                        *cursor_key))
+            rows = self.__rows(
+                session.execute(
+                    query.order_by(Message.created_at,
+                                   Message.id).limit(limit)))
+        archived = self.__read_archive(chat_id,
+                                       limit,
+                                       after=cursor_key,
+                                       since=since,
+                                       until=until,
+                                       status=status)
+        return self.__merge(rows, archived, limit)
 
     def create_message(self, chat_id: int, content: str,
-                       status: Message.Status):
-        message = Message(chat_id=chat_id,
-                          content=content,
-                          created_at=datetime.now(),
-                          status=status)
-        self.__session.add(message)
-        self.__session.commit()
-        return message
+                       status: Message.Status) -> MessageRow:
+        return self.create_messages([(chat_id, content, status,
+                                      datetime.now(), None)])[0]
+
+    def create_messages(
+            self, rows: list[tuple[int, str, Message.Status, datetime,
+                                   dict | None]]) -> list[MessageRow]:
+        """
+        Insert many messages with a single commit. Each row is a tuple of
+        (chat_id, content, status, created_at, media_info), messages with
+        a `media_info` are pending media processing.
+        """
+        messages = [
+            Message(chat_id=chat_id,
+                    content=content,
+                    created_at=created_at,
+                    status=status,
+                    media_status=(None if media_info is None else
+                                  Message.MediaStatus.PENDING),
+                    media_info=media_info)
+            for chat_id, content, status, created_at, media_info in rows
+        ]
+        with Session(self.__engine) as session:
+            session.add_all(messages)
+            session.flush()
+            self.__index_messages(session, messages)
+            self.__count_messages(session, messages)
+            rows = [
+                MessageRow(message.id, message.chat_id, message.content,
+                           message.created_at, message.status,
+                           message.media_status, message.media_info)
+                for message in messages
+            ]
+            session.commit()
+        return rows
+
+    def search_messages(self,
+                        query: str,
+                        chat_ids: list[int],
+                        limit: int,
+                        by_rank: bool = True,
+                        after: tuple[float, int] | None = None
+                        ) -> list[SearchResult]:
+        """
+        Get up to `limit` messages of the chats matching an FTS5 query, best
+        ranked first or newest first, right after the (rank, id) of the last
+        result of the previous page if given. Only the full-text index is
+        read, so archived messages are found too. Safe to call from any
+        thread.
+        """
+        statement = ("SELECT rowid, chat_id, content, created_at, status, "
+                     "rank, snippet(message_search, 0, '<mark>', '</mark>', "
+                     "'…', 16) FROM message_search WHERE message_search "
+                     "MATCH :query AND chat_id IN :chat_ids")
+        params = {"query": query, "chat_ids": chat_ids, "limit": limit}
+        if after is not None and by_rank:
+            statement += (" AND (rank > :rank OR "
+                          "(rank = :rank AND rowid > :id))")
+        elif after is not None:
+            statement += " AND rowid < :id"
+        if after is not None:
+            params["rank"], params["id"] = after
+        statement += (" ORDER BY rank, rowid" if by_rank else
+                      " ORDER BY rowid DESC") + " LIMIT :limit"
+        statement = text(statement).bindparams(
+            bindparam("chat_ids", expanding=True))
+        with Session(self.__engine) as session:
+            rows = session.execute(statement, params).all()
+        return [
+            SearchResult(id, chat_id, content,
+                         datetime.fromisoformat(created_at),
+                         Message.Status[status], rank, snippet)
+            for id, chat_id, content, created_at, status, rank, snippet in rows
+        ]
+
+    async def get_chat_stats(self,
+                             chat_ids: list[int]) -> list[ChatStatsRow]:
+        """
+        Get the counters of chats, in the order of `chat_ids`. A chat
+        without messages has all its counters at zero.
+        """
+        return await self.__run(self.__select_chat_stats, chat_ids)
+
+    async def get_partial_upload(self, client_id: int,
+                                 upload_id: str) -> PartialUploadRow | None:
+        return await self.__run(self.__select_partial_upload, client_id,
+                                upload_id)
+
+    async def save_partial_upload(self, client_id: int, upload_id: str,
+                                  **fields):
+        """
+        Create or update the partial upload `upload_id` of a client.
+        """
+        await self.__run(self.__upsert_partial_upload, client_id, upload_id,
+                         fields)
+
+    async def delete_partial_upload(self, client_id: int, upload_id: str):
+        await self.__run(self.__delete_partial_upload, client_id, upload_id)
+
+    async def take_expired_partial_uploads(
+            self, updated_before: datetime) -> list[PartialUploadRow]:
+        """
+        Delete and return the partial uploads not updated since
+        `updated_before`.
+        """
+        return await self.__run(self.__take_expired_partial_uploads,
+                                updated_before)
+
+    def add_blob_reference(self, digest: str, size: int,
+                           prefix_digest: str) -> int:
+        """
+        Take a reference to a blob, creating it if it is new. Return its
+        reference count. Safe to call from any thread.
+        """
+        statement = insert(Blob).values(digest=digest,
+                                        size=size,
+                                        prefix_digest=prefix_digest,
+                                        refcount=1,
+                                        created_at=datetime.now())
+        statement = statement.on_conflict_do_update(
+            index_elements=[Blob.digest],
+            set_={"refcount": Blob.refcount + 1}).returning(Blob.refcount)
+        with Session(self.__engine) as session:
+            refcount = session.execute(statement).scalar_one()
+            session.commit()
+        return refcount
+
+    def release_blob(self, digest: str) -> int:
+        """
+        Drop a reference to a blob and delete its row once it has none left.
+        Return the number of references left. Safe to call from any thread.
+        """
+        with Session(self.__engine) as session:
+            blob = session.get(Blob, digest)
+            if blob is None:
+                return 0
+            blob.refcount -= 1
+            refcount = blob.refcount
+            if refcount <= 0:
+                session.delete(blob)
+            session.commit()
+        return max(refcount, 0)
+
+    def find_blob(self, prefix_digest: str, size: int) -> str | None:
+        with Session(self.__engine) as session:
+            return session.query(Blob.digest).filter_by(
+                prefix_digest=prefix_digest, size=size).limit(1).scalar()
+
+    def get_blob_stats(self) -> dict:
+        with Session(self.__engine) as session:
+            blobs, size, references = session.query(
+                func.count(Blob.digest), func.coalesce(func.sum(Blob.size), 0),
+                func.coalesce(func.sum(Blob.refcount), 0)).one()
+        return {"blobs": blobs, "bytes": size, "references": references}
+
+    def compact_archive(self, closed_before: datetime) -> int:
+        """
+        Move the first `segment_rows` messages of the oldest period, if it
+        ended before `closed_before`, from the message table to an archive
+        segment, and return how many were moved. A period is moved by
+        calling it again until it returns 0. The rows are read in a short
+        transaction and deleted in another one once the segment is written,
+        so writers never wait for the segment to be compressed. Safe to call
+        from any thread.
+        """
+        if self.__archive is None:
+            return 0
+        with Session(self.__engine) as session:
+            oldest = session.scalar(select(func.min(Message.created_at)))
+            if oldest is None:
+                return 0
+            period_start = self.__archive.period_start(oldest)
+            if period_start + self.__archive.period > closed_before:
+                return 0
+            # sqlite reuses the ids past the largest one left in the table,
+            # so the last message stays until a newer one is written
+            last_id = session.scalar(select(func.max(Message.id)))
+            condition = ((Message.created_at >= period_start) &
+                         (Message.created_at
+                          < period_start + self.__archive.period) &
+                         (Message.id < last_id))
+            rows = session.execute(
+                select(Message.chat_id, Message.id, Message.content,
+                       Message.created_at, Message.status,
+                       Message.media_status, Message.media_info).where(
+                           condition).order_by(Message.id).limit(
+                               self.__archive.segment_rows)).all()
+        if not rows:
+            return 0
+        # messages are written in id order, so the batch holds every message
+        # of the period up to its last id
+        first_id, segment_last_id = rows[0].id, rows[-1].id
+        condition &= Message.id.between(first_id, segment_last_id)
+        rows.sort(key=lambda row: (row.chat_id, row.created_at, row.id))
+        path = self.__archive.write(
+            period_start, first_id,
+            ((chat_id, (id, content, created_at, status.value,
+                        media_status.value if media_status else None,
+                        media_info))
+             for chat_id, id, content, created_at, status, media_status,
+             media_info in rows))
+        with Session(self.__engine) as session:
+            session.add(
+                ArchiveSegment(path=path,
+                               period_start=period_start,
+                               first_id=first_id,
+                               last_id=segment_last_id,
+                               rows=len(rows),
+                               created_at=datetime.now()))
+            session.execute(delete(Message).where(condition))
+            try:
+                session.commit()
+            except IntegrityError:
+                # another worker archived the same messages first
+                return 0
+            except Exception:
+                self.__archive.remove(path)
+                raise
+        return len(rows)
+
+    async def get_pending_media(self, created_before: datetime,
+                                limit: int) -> list[MessageRow]:
+        """
+        Get up to `limit` messages still pending media processing that were
+        written before `created_before`, oldest first.
+        """
+        return await self.__run(self.__select_pending_media, created_before,
+                                limit)
+
+    async def set_media_info(self, message_id: int,
+                             media_status: Message.MediaStatus,
+                             media_info: dict):
+        await self.__run(self.__update_media_info, message_id, media_status,
+                         media_info)
+
+    def get_archive_stats(self) -> dict:
+        with Session(self.__engine) as session:
+            segments, rows = session.query(
+                func.count(ArchiveSegment.id),
+                func.coalesce(func.sum(ArchiveSegment.rows), 0)).one()
+            hot_rows = session.scalar(select(func.count(Message.id)))
+        return {"segments": segments, "archived": rows, "hot": hot_rows}
+
+    async def __run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.__executor, functools.partial(func, *args, **kwargs))
+
+    @staticmethod
+    def __set_journal_mode(connection, _):
+        # readers and the writer do not block each other in WAL mode
+        connection.execute("PRAGMA journal_mode=WAL")
+
+    @staticmethod
+    def __rows(result) -> list[MessageRow]:
+        return [MessageRow(*row) for row in result]
+
+    def __insert_chat(self, client_id: int, timezone: str) -> ChatRow:
+        with Session(self.__engine) as session:
+            chat = Chat(client_id=client_id,
+                        created_at=datetime.now(),
+                        timezone=timezone)
+            session.add(chat)
+            session.flush()
+            row = ChatRow(chat.id, chat.client_id, chat.created_at,
+                          chat.timezone)
+            session.commit()
+        return row
+
+    def __select_chat_stats(self, chat_ids: list[int]) -> list[ChatStatsRow]:
+        with Session(self.__engine) as session:
+            stats = {
+                row.chat_id: ChatStatsRow(*row)
+                for row in session.execute(
+                    select(ChatStats.chat_id, ChatStats.messages,
+                           ChatStats.successes, ChatStats.failures,
+                           ChatStats.last_message_at,
+                           ChatStats.media_bytes).where(
+                               ChatStats.chat_id.in_(chat_ids)))
+            }
+        return [stats.get(id) or ChatStatsRow(id) for id in chat_ids]
+
+    def __count_messages(self, session: Session, messages: list):
+        """
+        Add messages to the counters of their chats.
+        """
+        digests = {
+            message.content[len(CONTENT_PREFIX):]
+            for message in messages
+            if message.content.startswith(CONTENT_PREFIX)
+        }
+        sizes = {}
+        if digests:
+            sizes = dict(
+                session.execute(
+                    select(Blob.digest,
+                           Blob.size).where(Blob.digest.in_(digests))).all())
+        stats: dict[int, ChatStatsRow] = {}
+        for message in messages:
+            row = stats.get(message.chat_id)
+            if row is None:
+                row = stats[message.chat_id] = ChatStatsRow(message.chat_id)
+            row.messages += 1
+            if message.status == Message.Status.SUCCESS:
+                row.successes += 1
+            else:
+                row.failures += 1
+            if (row.last_message_at is None or
+                    message.created_at > row.last_message_at):
+                row.last_message_at = message.created_at
+            if message.content.startswith(CONTENT_PREFIX):
+                row.media_bytes += sizes.get(
+                    message.content[len(CONTENT_PREFIX):], 0)
+        self.__add_chat_stats(session, list(stats.values()))
+
+    @staticmethod
+    def __add_chat_stats(session: Session, rows: list[ChatStatsRow]):
+        if not rows:
+            return
+        statement = insert(ChatStats)
+        excluded = statement.excluded
+        statement = statement.on_conflict_do_update(
+            index_elements=[ChatStats.chat_id],
+            set_={
+                "messages":
+                    ChatStats.messages + excluded.messages,
+                "successes":
+                    ChatStats.successes + excluded.successes,
+                "failures":
+                    ChatStats.failures + excluded.failures,
+                # sqlite's max of several arguments
+                "last_message_at":
+                    func.max(ChatStats.last_message_at,
+                             excluded.last_message_at),
+                "media_bytes":
+                    ChatStats.media_bytes + excluded.media_bytes,
+            })
+        session.execute(statement, [{
+            "chat_id": row.chat_id,
+            "messages": row.messages,
+            "successes": row.successes,
+            "failures": row.failures,
+            "last_message_at": row.last_message_at,
+            "media_bytes": row.media_bytes
+        } for row in rows])
+
+    def __select_pending_media(self, created_before: datetime,
+                               limit: int) -> list[MessageRow]:
+        with Session(self.__engine) as session:
+            return self.__rows(
+                session.execute(
+                    select(Message.id, Message.chat_id, Message.content,
+                           Message.created_at, Message.status,
+                           Message.media_status, Message.media_info).where(
+                               Message.media_status ==
+                               Message.MediaStatus.PENDING,
+                               Message.created_at < created_before).order_by(
+                                   Message.id).limit(limit)))
+
+    def __update_media_info(self, message_id: int,
+                            media_status: Message.MediaStatus,
+                            media_info: dict):
+        # a message archived meanwhile keeps its pending status
+        with Session(self.__engine) as session:
+            session.execute(
+                update(Message).where(Message.id == message_id).values(
+                    media_status=media_status, media_info=media_info))
+            session.commit()
+
+    def __select_chats(self, client_id: int) -> list[ChatRow]:
+        with Session(self.__engine) as session:
+            return [
+                ChatRow(*row) for row in session.execute(
+                    select(Chat.id, Chat.client_id, Chat.created_at,
+                           Chat.timezone).where(
+                               Chat.client_id == client_id).order_by(Chat.id))
+            ]
+
+    @staticmethod
+    def __partial_upload_row(upload: PartialUpload) -> PartialUploadRow:
+        return PartialUploadRow(upload.client_id, upload.upload_id,
+                                upload.chat_id, upload.type, upload.path,
+                                upload.partial_path, upload.size,
+                                upload.received)
+
+    def __select_partial_upload(self, client_id: int,
+                                upload_id: str) -> PartialUploadRow | None:
+        with Session(self.__engine) as session:
+            upload = session.query(PartialUpload).filter_by(
+                client_id=client_id, upload_id=upload_id).one_or_none()
+            return self.__partial_upload_row(upload) if upload else None
+
+    def __upsert_partial_upload(self, client_id: int, upload_id: str,
+                                fields: dict):
+        with Session(self.__engine) as session:
+            upload = session.query(PartialUpload).filter_by(
+                client_id=client_id, upload_id=upload_id).one_or_none()
+            if upload is None:
+                upload = PartialUpload(client_id=client_id,
+                                       upload_id=upload_id)
+                session.add(upload)
+            for name, value in fields.items():
+                setattr(upload, name, value)
+            upload.updated_at = datetime.now()
+            session.commit()
+
+    def __delete_partial_upload(self, client_id: int, upload_id: str):
+        with Session(self.__engine) as session:
+            session.query(PartialUpload).filter_by(
+                client_id=client_id, upload_id=upload_id).delete()
+            session.commit()
+
+    def __take_expired_partial_uploads(
+            self, updated_before: datetime) -> list[PartialUploadRow]:
+        with Session(self.__engine) as session:
+            uploads = session.query(PartialUpload).filter(
+                PartialUpload.updated_at < updated_before).all()
+            rows = [self.__partial_upload_row(upload) for upload in uploads]
+            for upload in uploads:
+                session.delete(upload)
+            session.commit()
+        return rows
+
+    def __segments(self,
+                   session: Session,
+                   start: datetime | None = None,
+                   end: datetime | None = None) -> list[tuple[datetime, str]]:
+        """
+        Get the (period start, path) of the segments of the periods that may
+        hold messages created from `start` to `end`.
+        """
+        query = select(ArchiveSegment.period_start, ArchiveSegment.path)
+        if start is not None:
+            query = query.where(ArchiveSegment.period_start >=
+                                self.__archive.period_start(start))
+        if end is not None:
+            query = query.where(ArchiveSegment.period_start <=
+                                self.__archive.period_start(end))
+        return session.execute(
+            query.order_by(ArchiveSegment.period_start,
+                           ArchiveSegment.first_id)).all()
+
+    def __find_message(self, session: Session, chat_id: int,
+                       message_id: int) -> tuple[datetime, int] | None:
+        """
+        Get the (created_at, id) of a message of a chat, in either tier.
+        """
+        message = session.get(Message, message_id)
+        if message is not None:
+            return ((message.created_at, message.id)
+                    if message.chat_id == chat_id else None)
+        if self.__archive is None:
+            return None
+        paths = session.scalars(
+            select(ArchiveSegment.path).where(
+                ArchiveSegment.first_id <= message_id,
+                ArchiveSegment.last_id >= message_id)).all()
+        return self.__archive.find(paths, chat_id, message_id)
+
+    def __read_archive(self,
+                       chat_id: int,
+                       limit: int,
+                       after: tuple[datetime, int] | None = None,
+                       before: tuple[datetime, int] | None = None,
+                       since: datetime | None = None,
+                       until: datetime | None = None,
+                       status: Message.Status | None = None
+                       ) -> list[MessageRow]:
+        """
+        Get archived messages of a chat, see `ArchiveStore.read`.
+        Called after reading the message table, so that messages archived
+        meanwhile are read twice rather than missed.
+        """
+        if self.__archive is None:
+            return []
+        # periods wholly on the wrong side of the cursor are not read
+        start = max((at for at in (after and after[0], since) if at),
+                    default=None)
+        end = min((at for at in (before and before[0], until) if at),
+                  default=None)
+        with Session(self.__engine) as session:
+            segments = self.__segments(session, start, end)
+        if not segments:
+            return []
+        rows = self.__archive.read(segments, chat_id, limit, after, before,
+                                   since, until,
+                                   status.value if status else None)
+        return [
+            MessageRow(id, chat_id, content, created_at, Message.Status(value),
+                       Message.MediaStatus(media_value) if media_value else
+                       None, media_info)
+            for id, content, created_at, value, media_value, media_info in rows
+        ]
+
+    @staticmethod
+    def __merge(messages: list,
+                archived: list,
+                limit: int,
+                reverse: bool = False) -> list:
+        """
+        Merge messages of both tiers read in the same order, and drop the ones
+        read twice.
+        """
+        if not archived:
+            return messages[:limit]
+        merged, seen = [], set()
+        for message in heapq.merge(messages,
+                                   archived,
+                                   key=lambda m: (m.created_at, m.id),
+                                   reverse=reverse):
+            if message.id not in seen:
+                seen.add(message.id)
+                merged.append(message)
+                if len(merged) == limit:
+                    break
+        return merged
+
+    @staticmethod
+    def __index_messages(session: Session, messages: list):
+        if not messages:
+            return
+        session.execute(INDEX_MESSAGE, [{
+            "id": message.id,
+            "content": message.content,
+            "chat_id": message.chat_id,
+            "created_at": str(message.created_at),
+            "status": message.status.name
+        } for message in messages])
+
+    def __migrate(self):
+        """
+        Bring an existing database up to date with the models. `create_all`
+        only creates missing tables, so columns and indexes added to existing
+        tables are created here, and messages written before the full-text
+        index or the chat counters existed are added to them.
+        """
+        for table in Base.metadata.sorted_tables:
+            existing = {
+                column["name"]
+                for column in inspect(self.__engine).get_columns(table.name)
+            }
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                # added columns are nullable, existing rows get NULL
+                with self.__engine.begin() as connection:
+                    connection.execute(
+                        text("ALTER TABLE %s ADD COLUMN %s %s" %
+                             (table.name, column.name,
+                              column.type.compile(self.__engine.dialect))))
+            for index in table.indexes:
+                index.create(self.__engine, checkfirst=True)
+        with Session(self.__engine) as session:
+            session.execute(CREATE_SEARCH_INDEX)
+            # messages are indexed as they are written, in id order
+            indexed = session.scalar(
+                text("SELECT coalesce(max(rowid), 0) FROM message_search"))
+            paths = session.scalars(
+                select(ArchiveSegment.path).where(
+                    ArchiveSegment.last_id > indexed)).all()
+            for path in paths if self.__archive is not None else []:
+                self.__index_messages(session, [
+                    message for message in self.__archived_messages(path)
+                    if message.id > indexed
+                ])
+            session.execute(
+                text("INSERT INTO message_search(rowid, content, chat_id, "
+                     "created_at, status) SELECT id, content, chat_id, "
+                     "created_at, status FROM message WHERE id > :indexed"),
+                {"indexed": indexed})
+            self.__count_existing_messages(session)
+            session.commit()
+
+    def __count_existing_messages(self, session: Session):
+        """
+        Fill the chat counters from the messages, if they are empty.
+        """
+        digest = func.substr(Message.content, len(CONTENT_PREFIX) + 1)
+        query = select(
+            Message.chat_id, func.count(Message.id),
+            func.sum(case((Message.status == Message.Status.SUCCESS, 1),
+                          else_=0)),
+            func.sum(case((Message.status != Message.Status.SUCCESS, 1),
+                          else_=0)), func.max(Message.created_at),
+            func.coalesce(func.sum(Blob.size), 0)).outerjoin(
+                Blob, Blob.digest == digest).where(
+                    ~exists(select(ChatStats.chat_id))).group_by(
+                        Message.chat_id)
+        # the guard and the insert are one statement, so that only one of
+        # several workers starting together fills the counters
+        result = session.execute(
+            insert(ChatStats).from_select([
+                "chat_id", "messages", "successes", "failures",
+                "last_message_at", "media_bytes"
+            ], query))
+        # the message table keeps the latest message, so it is never empty
+        # when messages were archived
+        if result.rowcount and self.__archive is not None:
+            for path in session.scalars(select(ArchiveSegment.path)).all():
+                self.__count_messages(session,
+                                      self.__archived_messages(path))
+
+    def __archived_messages(self, path: str) -> list[Message]:
+        return [
+            Message(id=id,
+                    chat_id=chat_id,
+                    content=content,
+                    created_at=created_at,
+                    status=Message.Status(value))
+            for chat_id, (id, content, created_at, value,
+                          *_) in self.__archive.iter_rows(path)
+        ]
@@ -0,0 +1,80 @@
+import asyncio
+import enum
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import AsyncIterator
+
+from db import DB, Message, MessageRow
+
+
+class ExportFormat(enum.Enum):
+    NDJSON = "ndjson"  # one JSON object per message
+    COLUMNS = "columns"  # one JSON object of column arrays per batch of rows
+
+
+class Exporter:
+    """
+    Stream the history of a chat in constant memory. Messages are read in
+    keyset batches of `batch_size` rows, each batch in its own short read,
+    so an export never holds the database while its client reads slowly.
+    Reads run on `workers` threads of their own, so concurrent exports
+    queue behind each other instead of competing with live traffic.
+    """
+
+    def __init__(self, db: DB, batch_size: int = 1000, workers: int = 1):
+        self.__db = db
+        self.__batch_size = batch_size
+        self.__executor = ThreadPoolExecutor(max_workers=workers,
+                                             thread_name_prefix="export")
+
+    async def stream(self,
+                     chat_id: int,
+                     format: ExportFormat = ExportFormat.NDJSON,
+                     after_id: int | None = None,
+                     since: datetime | None = None,
+                     until: datetime | None = None,
+                     status: Message.Status | None = None
+                     ) -> AsyncIterator[bytes]:
+        """
+        Yield the encoded messages of a chat in (created_at, id) order,
+        starting right after message `after_id` to resume an export.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            rows = await loop.run_in_executor(self.__executor,
+                                              self.__db.export_messages,
+                                              chat_id, self.__batch_size,
+                                              after_id, since, until, status)
+            if not rows:
+                return
+            if format == ExportFormat.COLUMNS:
+                yield self.__encode_columns(rows)
+            else:
+                yield self.__encode_ndjson(rows)
+            if len(rows) < self.__batch_size:
+                return
+            after_id = rows[-1].id
+
+    @staticmethod
+    def __encode_ndjson(rows: list[MessageRow]) -> bytes:
+        lines = [
+            json.dumps({
+                "id": row.id,
+                "chat_id": row.chat_id,
+                "content": row.content,
+                "created_at": row.created_at.isoformat(),
+                "status": row.status.value
+            }) for row in rows
+        ]
+        return ("\n".join(lines) + "\n").encode()
+
+    @staticmethod
+    def __encode_columns(rows: list[MessageRow]) -> bytes:
+        return (json.dumps({
+            "chat_id": rows[0].chat_id,
+            "id": [row.id for row in rows],
+            "content": [row.content for row in rows],
+            "created_at": [row.created_at.isoformat() for row in rows],
+            "status": [row.status.value for row in rows]
+        }) + "\n").encode()
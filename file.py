@@ -1,9 +1,10 @@
+import asyncio
 import os
-import re
 from enum import Enum
+from typing import AsyncIterator
 
-import requests
-from utils import is_downloadable, is_url
+from remote import RemoteSource, default_source
+from utils import is_url
 
 
 class File:
@@ -12,11 +13,13 @@ class File:
         LOCAL = 1
         REMOTE = 2
 
-    def __init__(self, address: str):
+    def __init__(self, address: str, source: RemoteSource | None = None):
         self.__address = address  # file path or url
+        self.__source = source or default_source()
         if os.path.exists(self.__address):
             self.__type = File.Type.LOCAL
-        elif is_url(self.__address) and is_downloadable(self.__address):
+        elif is_url(self.__address) and self.__source.is_downloadable(
+                self.__address):
             self.__type = File.Type.REMOTE
         else:
             return TypeError("Invalid file address")
@@ -25,32 +28,14 @@ class File:
         """
         Get metadata of the file.
         """
-        if self.__type == File.Type.LOCAL:
-            return {
-                "name": os.path.basename(self.__address),
-                "size": os.path.getsize(self.__address)
-            }
-        elif self.__type == File.Type.REMOTE:
-            response = requests.head(self.__address)
-            content_disposition = response.headers.get('content-disposition')
-            if content_disposition:
-                filename = re.findall("filename=(.+)", content_disposition)[0]
-                return {
-                    "name": filename,
-                    "size": int(response.headers.get('content-length', 0))
-                }
-            else:
-                raise ValueError(
-                    "Filename not found in content-disposition of this file")
+        return {"name": self.get_file_name(), "size": self.get_file_size()}
 
     def get_file_name(self) -> str:
         if self.__type == File.Type.LOCAL:
             return os.path.basename(self.__address)
         elif self.__type == File.Type.REMOTE:
-            response = requests.head(self.__address)
-            content_disposition = response.headers.get('content-disposition')
-            if content_disposition:
-                filename = re.findall("filename=(.+)", content_disposition)[0]
+            filename = self.__source.head(self.__address).name
+            if filename:
                 return filename
             else:
                 raise ValueError(
@@ -60,18 +45,36 @@ class File:
         if self.__type == File.Type.LOCAL:
             return os.path.getsize(self.__address)
         elif self.__type == File.Type.REMOTE:
-            response = requests.head(self.__address)
-            return int(response.headers.get('content-length', 0))
+            return self.__source.head(self.__address).size
 
-    def get_bytes_stream(self, size: int = 1024):
+    def get_bytes_stream(self, size: int = 1024, offset: int = 0):
+        """
+        Stream the file in chunks of `size` bytes, starting at `offset`.
+        """
         if self.__type == File.Type.LOCAL:
             with open(self.__address, 'rb') as file:
+                file.seek(offset)
                 while True:
                     data = file.read(size)
                     if not data:
                         break
                     yield data
         elif self.__type == File.Type.REMOTE:
-            response = requests.get(self.__address, stream=True)
-            for chunk in response.iter_content(size):
+            for chunk in self.__source.iter_bytes(self.__address, size):
+                if offset >= len(chunk):
+                    offset -= len(chunk)
+                    continue
+                yield chunk[offset:]
+                offset = 0
+
+    async def aget_bytes_stream(self, size: int = 1024) -> AsyncIterator[bytes]:
+        """
+        Stream the file without blocking the event loop.
+        """
+        if self.__type == File.Type.REMOTE:
+            async for chunk in self.__source.aiter_bytes(self.__address, size):
                 yield chunk
+            return
+        chunks = self.get_bytes_stream(size)
+        while chunk := await asyncio.to_thread(next, chunks, None):
+            yield chunk
@@ -0,0 +1,289 @@
+import asyncio
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from media import MediaStore
+
+COPY_SIZE = 1024 * 1024  # bytes read at once when copying or rehashing
+
+
+class Transfer:
+    """
+    An in-flight multimedia transfer of `size` bytes being received at `path`
+    until it is stored in the media store. The file handle is opened by the
+    first write and kept open until the transfer is closed. The content is
+    hashed as it is written, so its digest is known as soon as it ends.
+
+    A resumed transfer keeps the first `offset` bytes a previous attempt
+    left at `path`, they are hashed again before the first write.
+
+    Once the first `store.prefix_size` bytes match the prefix of a stored
+    blob of the same size, the following chunks are compared against that
+    blob instead of being written. If they stop matching, the matched part
+    is copied from the blob and writing resumes.
+    """
+
+    def __init__(self,
+                 path: str,
+                 size: int,
+                 store: MediaStore,
+                 offset: int = 0):
+        self.path = path
+        self.size = size
+        self.received = offset  # bytes handed over to the ingest manager
+        self.digest: str | None = None  # set once the transfer is stored
+        self.buffer = bytearray()  # frames not yet handed to a writer thread
+        self.pending: asyncio.Future | None = None  # write in progress
+        self.__store = store
+        self.__offset = offset
+        self.__handle = None
+        self.__hash = hashlib.sha256()
+        self.__prefix_hash = hashlib.sha256()
+        self.__position = 0  # bytes of the content processed
+        self.__written = 0  # bytes of the content in the file
+        self.__match = None  # (digest, handle) of the blob being compared
+
+    def write_chunk(self, chunk: bytes):
+        """
+        Append a chunk to the file. Runs on a writer thread.
+        """
+        if self.__handle is None:
+            self.__open()
+        view = memoryview(chunk)
+        while view:
+            if self.__match is not None:
+                if not self.__compare(view):
+                    self.__unmatch()
+                    continue
+                self.__position += len(view)
+                break
+            part = view
+            if self.__position < self.__store.prefix_size:
+                part = view[:self.__store.prefix_size - self.__position]
+            self.__handle.write(part)
+            self.__update(part)
+            self.__written = self.__position
+            view = view[len(part):]
+            if self.__position == self.__store.prefix_size and len(part):
+                self.__find_match()
+
+    def suspend(self):
+        """
+        Make the file hold everything received and close it, so that a later
+        transfer can resume from it. Runs on a writer thread.
+        """
+        if self.__match is not None:
+            self.__unmatch()
+        self.close_handle()
+
+    def store(self) -> str:
+        """
+        Close the file and move the content to the media store. Runs on a
+        writer thread.
+        """
+        if self.__handle is None:
+            self.__open()
+        self.__handle.close()
+        self.__handle = None
+        if self.__match is not None:
+            digest = self.__match[0]
+        else:
+            digest = self.__hash.hexdigest()
+        try:
+            # whether the blob compared against still exists is checked
+            # by the store under its lock
+            self.digest = self.__store.commit(self.path, digest, self.size,
+                                              self.__prefix_hash.hexdigest(),
+                                              self.__position - self.__written,
+                                              self.__complete)
+        finally:
+            self.close_handle()
+        return self.digest
+
+    def close_handle(self):
+        """
+        Close the file handle. Runs on a writer thread.
+        """
+        if self.__match is not None:
+            self.__match[1].close()
+            self.__match = None
+        if self.__handle is not None:
+            self.__handle.close()
+            self.__handle = None
+
+    def __complete(self) -> str:
+        """
+        Write the part compared against a blob deleted since then, from its
+        handle that is still readable. Return the digest of the content.
+        """
+        self.__handle = open(self.path, "ab")
+        self.__unmatch()
+        self.close_handle()
+        return self.__hash.hexdigest()
+
+    def __open(self):
+        self.__handle = open(self.path, "ab")
+        if self.__offset:
+            # hash what a previous attempt kept, drop what it wrote past it
+            with open(self.path, "rb") as file:
+                while self.__position < self.__offset:
+                    data = file.read(
+                        min(COPY_SIZE, self.__offset - self.__position))
+                    if not data:
+                        raise OSError("%s is shorter than its offset" %
+                                      self.path)
+                    self.__update(data)
+            self.__written = self.__position
+            self.__offset = 0
+        self.__handle.truncate(self.__written)
+
+    def __update(self, data):
+        if self.__position < self.__store.prefix_size:
+            self.__prefix_hash.update(data[:self.__store.prefix_size -
+                                           self.__position])
+        self.__hash.update(data)
+        self.__position += len(data)
+
+    def __find_match(self):
+        if self.size <= self.__position:
+            return
+        digest = self.__store.find(self.__prefix_hash.hexdigest(), self.size)
+        if digest is None:
+            return
+        try:
+            blob = open(self.__store.path(digest), "rb")
+        except FileNotFoundError:
+            return
+        blob.seek(self.__position)
+        self.__match = (digest, blob)
+
+    def __compare(self, view: memoryview) -> bool:
+        blob = self.__match[1]
+        blob.seek(self.__position)
+        return blob.read(len(view)) == view
+
+    def __unmatch(self):
+        """
+        Stop comparing, copy the part that matched from the blob to the file.
+        """
+        digest, blob = self.__match
+        self.__match = None
+        blob.seek(self.__written)
+        while self.__written < self.__position:
+            data = blob.read(min(COPY_SIZE, self.__position - self.__written))
+            self.__handle.write(data)
+            self.__hash.update(data)
+            self.__written += len(data)
+        blob.close()
+
+
+class IngestManager:
+    """
+    Write incoming multimedia streams to disk without blocking the event loop.
+    Frames are coalesced in memory until `flush_size` bytes are buffered and
+    then written by a bounded pool of writer threads. While a write of a
+    transfer is in progress, its next frames keep buffering behind it; the
+    caller is only made to wait once `max_buffer` bytes are pending.
+    Complete transfers are moved to the media store.
+    """
+
+    def __init__(self,
+                 store: MediaStore,
+                 workers: int = 4,
+                 flush_size: int = 64 * 1024,
+                 max_buffer: int = 1024 * 1024):
+        self.__store = store
+        self.__executor = ThreadPoolExecutor(max_workers=workers,
+                                             thread_name_prefix="ingest")
+        self.__flush_size = flush_size
+        self.__max_buffer = max_buffer
+
+    def open(self,
+             size: int,
+             name: str | None = None,
+             offset: int = 0) -> Transfer:
+        """
+        Start receiving `size` bytes. A transfer with a `name` may be
+        resumed later by opening the same name at the offset it reached.
+        """
+        return Transfer(self.__store.temp_path(name), size, self.__store,
+                        offset)
+
+    async def write(self, transfer: Transfer, data: bytes):
+        """
+        Queue `data` to be appended to the transfer's file.
+        """
+        transfer.buffer += data
+        transfer.received += len(data)
+        if len(transfer.buffer) < self.__flush_size:
+            return
+        if transfer.pending is not None and not transfer.pending.done():
+            if len(transfer.buffer) < self.__max_buffer:
+                return
+            await transfer.pending
+        self.__flush(transfer)
+
+    async def close(self, transfer: Transfer) -> str:
+        """
+        Write everything buffered for the transfer and store it in the media
+        store. Return the digest of its content.
+        """
+        try:
+            await self.__drain(transfer)
+        except BaseException:
+            await self.__run(transfer.close_handle)
+            raise
+        return await self.__run(transfer.store)
+
+    async def suspend(self, transfer: Transfer):
+        """
+        Write everything buffered for a resumable transfer and close its
+        file, so that a later transfer can continue it.
+        """
+        try:
+            await self.__drain(transfer)
+        finally:
+            await self.__run(transfer.suspend)
+
+    async def abort(self, transfer: Transfer):
+        """
+        Drop the transfer and delete whatever was written of it.
+        """
+        transfer.buffer = bytearray()
+        try:
+            await self.__drain(transfer)
+        finally:
+            await self.__run(transfer.close_handle)
+            await self.__run(self.__remove, transfer.path)
+
+    async def remove(self, path: str):
+        """
+        Delete a file left by a transfer, e.g. an expired partial upload.
+        """
+        await self.__run(self.__remove, path)
+
+    async def __drain(self, transfer: Transfer):
+        if transfer.pending is not None:
+            await transfer.pending
+        if transfer.buffer:
+            self.__flush(transfer)
+            await transfer.pending
+
+    def __flush(self, transfer: Transfer):
+        # surface the error of the previous write, if any, to the caller
+        if transfer.pending is not None and transfer.pending.done():
+            transfer.pending.result()
+        chunk = bytes(transfer.buffer)
+        transfer.buffer = bytearray()
+        transfer.pending = asyncio.get_running_loop().run_in_executor(
+            self.__executor, transfer.write_chunk, chunk)
+
+    async def __run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.__executor, func, *args)
+
+    @staticmethod
+    def __remove(path: str):
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,110 @@
+import os
+import threading
+import uuid
+from typing import Callable
+
+from db import CONTENT_PREFIX, DB
+
+
+class MediaStore:
+    """
+    Content-addressed store of received media. Each blob is stored once under
+    the SHA-256 digest of its content, in `shard_depth` levels of directories
+    named after the leading bytes of the digest, and is reference counted so
+    that it is deleted once nothing points at it anymore. Uploads are written
+    to `root/tmp` until their digest is known.
+
+    The digest of the first `prefix_size` bytes of every blob is kept as
+    well, so that an upload whose prefix and size match a stored blob can be
+    compared against it instead of being written out.
+    """
+
+    def __init__(self,
+                 db: DB,
+                 root: str = "media",
+                 shard_depth: int = 2,
+                 prefix_size: int = 64 * 1024):
+        self.__db = db
+        self.__root = root
+        self.__tmp = os.path.join(root, "tmp")
+        self.__shard_depth = shard_depth
+        self.prefix_size = prefix_size
+        self.__lock = threading.Lock()
+        self.__stored = 0
+        self.__deduplicated = 0
+        self.__skipped_bytes = 0  # not written thanks to the prefix fast path
+        os.makedirs(self.__tmp, exist_ok=True)
+
+    def temp_path(self, name: str | None = None) -> str:
+        """
+        Get a path to receive an upload at. Uploads that may be resumed pass
+        a stable `name`, the others get a unique one.
+        """
+        return os.path.join(self.__tmp, "%s.part" % (name or uuid.uuid4().hex))
+
+    def path(self, digest: str) -> str:
+        shards = [digest[2 * i:2 * i + 2] for i in range(self.__shard_depth)]
+        return os.path.join(self.__root, *shards, digest)
+
+    def find(self, prefix_digest: str, size: int) -> str | None:
+        """
+        Get the digest of a stored blob of `size` bytes whose prefix has
+        `prefix_digest`, if any.
+        """
+        return self.__db.find_blob(prefix_digest, size)
+
+    def commit(self,
+               temp_path: str,
+               digest: str,
+               size: int,
+               prefix_digest: str,
+               skipped: int = 0,
+               complete: Callable[[], str] | None = None) -> str:
+        """
+        Store the upload at `temp_path` under its digest, or drop it if the
+        blob is stored already, and take a reference to the blob. `skipped`
+        bytes were compared against the stored blob instead of written. If
+        that blob was deleted meanwhile, `complete` writes them to
+        `temp_path` and returns the digest of the content. Runs on an ingest
+        thread.
+        """
+        with self.__lock:
+            path = self.path(digest)
+            if skipped and not os.path.exists(path):
+                digest = complete()
+                skipped = 0
+                path = self.path(digest)
+            if os.path.exists(path):
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                self.__deduplicated += 1
+                self.__skipped_bytes += skipped
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+                self.__stored += 1
+            self.__db.add_blob_reference(digest, size, prefix_digest)
+        return digest
+
+    def release(self, digest: str):
+        """
+        Drop a reference to a blob, deleting it once it has none left.
+        """
+        with self.__lock:
+            if self.__db.release_blob(digest) == 0:
+                path = self.path(digest)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def get_stats(self) -> dict:
+        stats = self.__db.get_blob_stats()
+        stats.update({
+            "stored": self.__stored,
+            "deduplicated": self.__deduplicated,
+            "skipped_bytes": self.__skipped_bytes,
+        })
+        return stats
+
+
+def content_id(digest: str) -> str:
+    return CONTENT_PREFIX + digest
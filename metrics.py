@@ -0,0 +1,243 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+PREFIX = "bluebelt_"
+# upper bounds in seconds, from sub-millisecond handlers to slow uploads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = tuple[tuple[str, str], ...]
+
+logger = logging.getLogger("bluebelt")
+sql_logger = logging.getLogger("bluebelt.sql")
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket, along with their sum and count.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.__lock = threading.Lock()  # observed from worker threads too
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Timer:
+    """
+    Context manager observing the seconds spent in its block.
+    """
+    __slots__ = ("__histogram", "__start")
+
+    def __init__(self, histogram: Histogram):
+        self.__histogram = histogram
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__histogram.observe(time.perf_counter() - self.__start)
+
+
+class Metrics:
+    """
+    In-process registry of counters, gauges and histograms, rendered in the
+    Prometheus text format. Updates are a dict lookup and an addition, so the
+    hot paths can stay instrumented in production. Values kept elsewhere are
+    read through callbacks only when the metrics are rendered.
+
+    `instrument_engine` times every SQL statement and commit of an engine and
+    logs a `sql_sample_rate` fraction of the statements, plus every statement
+    slower than `slow_query_ms`. The event loop lag is sampled every
+    `loop_lag_interval` seconds once `start` is called.
+    """
+
+    def __init__(self,
+                 sql_sample_rate: float = 0.001,
+                 slow_query_ms: float = 100.0,
+                 loop_lag_interval: float = 0.5):
+        self.__sql_sample_rate = sql_sample_rate
+        self.__slow_query = slow_query_ms / 1000
+        self.__loop_lag_interval = loop_lag_interval
+        self.__counters: dict[tuple[str, Labels], float] = {}
+        self.__histograms: dict[tuple[str, Labels], Histogram] = {}
+        # name -> (type, callback) of the metrics read when rendered
+        self.__collected: dict[str, tuple[str, Callable[[], float]]] = {}
+        self.__local = threading.local()  # commit start of the thread
+        self.__lag_task: asyncio.Task | None = None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(labels.items()))
+        self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = (name, tuple(labels.items()))
+        histogram = self.__histograms.get(key)
+        if histogram is None:
+            histogram = self.__histograms.setdefault(key, Histogram())
+        return histogram
+
+    def timer(self, name: str, **labels) -> Timer:
+        return Timer(self.histogram(name, **labels))
+
+    def collect(self, name: str, func: Callable[[], float],
+                type: str = "gauge"):
+        """
+        Register a metric whose value is read from `func` when rendered,
+        for values another component keeps track of already.
+        """
+        self.__collected[name] = (type, func)
+
+    async def start(self):
+        self.__lag_task = asyncio.create_task(self.__measure_loop_lag())
+
+    async def stop(self):
+        if self.__lag_task is not None:
+            self.__lag_task.cancel()
+
+    def instrument_engine(self, engine: Engine):
+        """
+        Time the statements and commits of `engine`.
+        """
+        event.listen(engine, "before_cursor_execute", self.__before_execute)
+        event.listen(engine, "after_cursor_execute", self.__after_execute)
+        event.listen(engine, "commit", self.__before_commit)
+        event.listen(Session, "after_commit", self.__after_commit)
+
+    def render(self) -> str:
+        lines = []
+        for name, (type, func) in self.__collected.items():
+            lines.append("# TYPE %s%s %s" % (PREFIX, name, type))
+            lines.append("%s%s %s" % (PREFIX, name, func()))
+        typed = set()
+        for (name, labels), value in sorted(self.__counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s%s counter" % (PREFIX, name))
+            lines.append("%s%s%s %s" %
+                         (PREFIX, name, self.__labels(labels), value))
+        for (name, labels), histogram in sorted(self.__histograms.items(),
+                                                key=lambda item: item[0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s%s histogram" % (PREFIX, name))
+            cumulative = 0
+            bounds = [*histogram.buckets, "+Inf"]
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append("%s%s_bucket%s %d" %
+                             (PREFIX, name,
+                              self.__labels(labels + (("le", bound),)),
+                              cumulative))
+            lines.append("%s%s_sum%s %s" %
+                         (PREFIX, name, self.__labels(labels), histogram.sum))
+            lines.append("%s%s_count%s %d" %
+                         (PREFIX, name, self.__labels(labels),
+                          histogram.count))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __labels(labels: Labels) -> str:
+        if not labels:
+            return ""
+        return "{%s}" % ",".join("%s=\"%s\"" % pair for pair in labels)
+
+    async def __measure_loop_lag(self):
+        histogram = self.histogram("event_loop_lag_seconds")
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.__loop_lag_interval)
+            lag = time.perf_counter() - start - self.__loop_lag_interval
+            histogram.observe(max(lag, 0.0))
+
+    def __before_execute(self, conn, cursor, statement, parameters, context,
+                         executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def __after_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        duration = time.perf_counter() - conn.info["query_start"].pop()
+        self.observe("db_query_seconds", duration)
+        if duration >= self.__slow_query:
+            log("slow_query",
+                sql_logger,
+                logging.WARNING,
+                statement=statement,
+                seconds=duration)
+        elif random.random() < self.__sql_sample_rate:
+            log("query", sql_logger, statement=statement, seconds=duration)
+
+    def __before_commit(self, conn):
+        self.__local.commit_start = time.perf_counter()
+
+    def __after_commit(self, session):
+        start = getattr(self.__local, "commit_start", None)
+        if start is not None:
+            self.__local.commit_start = None
+            self.observe("db_commit_seconds", time.perf_counter() - start)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line, with the fields passed to
+    `log` at the top level.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "pid": os.getpid(),
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["error"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def log(event: str,
+        target: logging.Logger = logger,
+        level: int = logging.INFO,
+        **fields):
+    """
+    Log a structured event.
+    """
+    if target.isEnabledFor(level):
+        target.log(level, event, extra={"fields": fields})
+
+
+def configure_logging(level: str = "info"):
+    """
+    Send the structured logs of the server to stderr as JSON lines.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    logger.handlers[:] = [handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
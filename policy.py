@@ -0,0 +1,130 @@
+import time as clock
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from typing import Iterable
+
+import pytz
+
+DEFAULT_WINDOWS = {
+    "text": ("05:00", "23:59"),
+    "voice": ("08:00", "12:00"),
+    "video": ("08:00", "23:59"),
+}
+
+
+@dataclass(frozen=True)
+class TimeWindow:
+    """
+    Daily window of local wall clock time, both ends included. A window whose
+    end is before its start spans midnight.
+    """
+    start: time
+    end: time
+
+    @classmethod
+    def parse(cls, start: str, end: str) -> "TimeWindow":
+        return cls(cls.__parse_time(start), cls.__parse_time(end))
+
+    @staticmethod
+    def __parse_time(value: str) -> time:
+        hour, minute = [int(e) for e in value.split(":")]
+        return time(hour, minute)
+
+
+class PolicyEngine:
+    """
+    Decide whether a kind of message is accepted now in a timezone. The
+    windows are compiled once; for every (kind, timezone) the engine keeps
+    whether the window is open and the UTC second of its next transition, so
+    a check is a single integer comparison until that second is reached.
+
+    Boundaries follow the local wall clock across DST changes. A boundary in
+    a skipped hour takes effect when the clock jumps past it. In a repeated
+    hour, a window opens at the first occurrence of its start and closes
+    after the last occurrence of its end.
+    """
+
+    def __init__(self, windows: dict[str, list[str]] | None = None):
+        self.__windows = {
+            kind: TimeWindow.parse(*window)
+            for kind, window in (windows or DEFAULT_WINDOWS).items()
+        }
+        # (kind, timezone) -> (is open, UTC second of the next transition)
+        self.__states: dict[tuple[str, str], tuple[bool, int]] = {}
+
+    def is_allowed(self,
+                   kind: str,
+                   timezone: str,
+                   now: int | None = None) -> bool:
+        """
+        Check whether a message of `kind` is accepted now in `timezone`.
+        Unknown kinds are never accepted.
+        """
+        now = int(clock.time()) if now is None else now
+        state = self.__states.get((kind, timezone))
+        if state is None or now >= state[1]:
+            if kind not in self.__windows:
+                return False
+            state = self.__compile(kind, timezone, now)
+        return state[0]
+
+    def is_allowed_many(self,
+                        kind: str,
+                        timezones: Iterable[str],
+                        now: int | None = None) -> list[bool]:
+        """
+        Check many timezones, e.g. of many chats, against the same instant.
+        """
+        now = int(clock.time()) if now is None else now
+        return [self.is_allowed(kind, timezone, now) for timezone in timezones]
+
+    def __compile(self, kind: str, timezone: str,
+                  now: int) -> tuple[bool, int]:
+        window = self.__windows[kind]
+        tz = pytz.timezone(timezone)
+        today = datetime.fromtimestamp(now, tz).date()
+        events = []  # (UTC second, opens)
+        for days in (-1, 0, 1):
+            day = today + timedelta(days=days)
+            end_day = day if window.end >= window.start else day + timedelta(
+                days=1)
+            events.append((self.__to_utc(tz, day, window.start, True), True))
+            events.append(
+                (self.__to_utc(tz, end_day, window.end, False) + 1, False))
+        events.sort()
+
+        is_open = False
+        until = now + 3600  # only reached if the window never changes
+        for second, opens in events:
+            if second > now:
+                until = second
+                break
+            is_open = opens
+        state = (is_open, until)
+        self.__states[(kind, timezone)] = state
+        return state
+
+    @staticmethod
+    def __to_utc(tz, day: date, at: time, first: bool) -> int:
+        """
+        Get the UTC second at which the local wall clock of `tz` reaches `at`
+        on `day`, using the first or last occurrence of a repeated time.
+        """
+        wall = datetime.combine(day, at)
+        try:
+            return int(tz.localize(wall, is_dst=None).timestamp())
+        except pytz.AmbiguousTimeError:
+            return int(tz.localize(wall, is_dst=first).timestamp())
+        except pytz.NonExistentTimeError:
+            pass
+        # the clock skips `at`, find the second at which it jumps past it
+        low, high = sorted(
+            int(tz.localize(wall, is_dst=is_dst).timestamp())
+            for is_dst in (True, False))
+        while low < high:
+            middle = (low + high) // 2
+            if datetime.fromtimestamp(middle, tz).replace(tzinfo=None) >= wall:
+                high = middle
+            else:
+                low = middle + 1
+        return low
@@ -0,0 +1,297 @@
+import hashlib
+import os
+import struct
+
+HEADER_SIZE = 4096  # bytes read to sniff a container
+TAIL_SIZE = 65536  # bytes read from the end of an Ogg stream for its duration
+MAX_BOX_SIZE = 16 * 1024 * 1024  # largest MP4 moov box read into memory
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# MPEG audio layer III bitrates in kbit/s by bitrate index, for MPEG-1 and
+# for MPEG-2/2.5
+MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# sample rates by MPEG version bits and sample rate index
+MP3_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG-1
+    2: (22050, 24000, 16000),  # MPEG-2
+    0: (11025, 12000, 8000),  # MPEG-2.5
+}
+
+
+class Media:
+    """
+    What was found in a media file. `kinds` are the message types ("voice",
+    "video") its content may be sent as.
+    """
+    __slots__ = ("mime", "kinds", "duration", "width", "height")
+
+    def __init__(self, mime: str, kinds: tuple[str, ...] = ()):
+        self.mime = mime
+        self.kinds = kinds
+        self.duration: float | None = None
+        self.width: int | None = None
+        self.height: int | None = None
+
+
+def inspect_media(path: str, type: str, size: int,
+                  digest: str) -> tuple[str, dict]:
+    """
+    Check a stored media file against the size and type it was declared with
+    and the digest it is stored under, and read its container, duration and
+    dimensions. Return the media status value and what was found. Only reads
+    the file, so it can run in another process.
+    """
+    try:
+        actual_size = os.path.getsize(path)
+        with open(path, "rb") as file:
+            sha256 = hashlib.sha256()
+            while chunk := file.read(HASH_CHUNK_SIZE):
+                sha256.update(chunk)
+            media = sniff(file, actual_size)
+    except (OSError, IndexError, ValueError, struct.error) as e:
+        return "failed", {"error": str(e)}
+    info = {
+        "mime": media.mime,
+        "duration": media.duration,
+        "width": media.width,
+        "height": media.height,
+    }
+    if actual_size != size:
+        info["error"] = "size %d, %d declared" % (actual_size, size)
+    elif sha256.hexdigest() != digest:
+        info["error"] = "checksum mismatch"
+    elif type not in media.kinds:
+        info["error"] = "%s is not a %s" % (media.mime, type)
+    return ("invalid" if "error" in info else "valid"), info
+
+
+def sniff(file, size: int) -> Media:
+    """
+    Recognize a container from its leading bytes and read what it tells of
+    its content.
+    """
+    file.seek(0)
+    header = file.read(HEADER_SIZE)
+    if header[4:8] == b"ftyp":
+        return read_mp4(file, size, header)
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return read_wav(file, size)
+    if header[:4] == b"RIFF" and header[8:12] == b"AVI ":
+        return read_avi(header)
+    if header[:4] == b"OggS":
+        return read_ogg(file, size, header)
+    if header[:4] == b"fLaC":
+        return read_flac(header)
+    if header[:4] == b"\x1aE\xdf\xa3":
+        # the tracks are not parsed, a WebM or Matroska file may hold either
+        if b"webm" in header[:64]:
+            return Media("video/webm", ("voice", "video"))
+        return Media("video/x-matroska", ("voice", "video"))
+    if len(header) > 1 and header[0] == 0xFF and header[1] & 0xF6 == 0xF0:
+        return Media("audio/aac", ("voice",))  # ADTS frames, layer bits 00
+    if header[:3] == b"ID3" or (len(header) > 1 and header[0] == 0xFF and
+                                header[1] & 0xE0 == 0xE0):
+        return read_mp3(header, size)
+    if header[:3] == b"\xff\xd8\xff":
+        return Media("image/jpeg")
+    if header[:8] == b"\x89PNG\r\n\x1a\n":
+        return Media("image/png")
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return Media("image/gif")
+    return Media("application/octet-stream")
+
+
+def read_mp4(file, size: int, header: bytes) -> Media:
+    """
+    Read the duration from the movie header and the dimensions from the
+    track headers of an MP4 or QuickTime file. A file without a track with
+    dimensions is audio.
+    """
+    brand = header[8:12]
+    moov = None
+    offset = 0
+    while offset + 8 <= size:
+        file.seek(offset)
+        box_size, box_type, box_header = read_box_header(file, offset, size)
+        if box_type == b"moov":
+            if box_size > MAX_BOX_SIZE:
+                raise ValueError("moov box of %d bytes" % box_size)
+            moov = file.read(box_size - box_header)
+            break
+        offset += box_size
+    quicktime = brand == b"qt  "
+    media = Media("video/quicktime" if quicktime else "video/mp4", ("video",))
+    if moov is None:
+        return media
+    for box_type, body in iter_boxes(moov):
+        if box_type == b"mvhd":
+            if body[0] == 1:
+                timescale, duration = struct.unpack_from("!IQ", body, 20)
+            else:
+                timescale, duration = struct.unpack_from("!II", body, 12)
+            if timescale:
+                media.duration = duration / timescale
+        elif box_type == b"trak":
+            for track_type, track in iter_boxes(body):
+                if track_type != b"tkhd":
+                    continue
+                width, height = struct.unpack_from(
+                    "!II", track, 88 if track[0] == 1 else 76)
+                if width and height:
+                    # 16.16 fixed point, the first video track is kept
+                    media.width = media.width or width >> 16
+                    media.height = media.height or height >> 16
+    if not media.width and not quicktime:
+        media.mime, media.kinds = "audio/mp4", ("voice",)
+    return media
+
+
+def read_box_header(file, offset: int, size: int) -> tuple[int, bytes, int]:
+    """
+    Read the (size, type, header size) of the ISO media box at the current
+    position of `file`, which is at `offset` of a file of `size` bytes.
+    """
+    box_size, box_type = struct.unpack("!I4s", file.read(8))
+    header = 8
+    if box_size == 1:
+        box_size, = struct.unpack("!Q", file.read(8))
+        header = 16
+    elif box_size == 0:
+        box_size = size - offset  # the box runs to the end of the file
+    if box_size < header:
+        raise ValueError("invalid box at %d" % offset)
+    return box_size, box_type, header
+
+
+def iter_boxes(data: bytes):
+    """
+    Iterate over the (type, body) of the boxes held in a box body.
+    """
+    offset = 0
+    while offset + 8 <= len(data):
+        box_size, box_type = struct.unpack_from("!I4s", data, offset)
+        header = 8
+        if box_size == 1:
+            box_size, = struct.unpack_from("!Q", data, offset + 8)
+            header = 16
+        elif box_size == 0:
+            box_size = len(data) - offset
+        if box_size < header:
+            return
+        yield box_type, data[offset + header:offset + box_size]
+        offset += box_size
+
+
+def read_wav(file, size: int) -> Media:
+    media = Media("audio/wav", ("voice",))
+    byte_rate = None
+    offset = 12
+    while offset + 8 <= size:
+        file.seek(offset)
+        chunk_id, chunk_size = struct.unpack("<4sI", file.read(8))
+        if chunk_id == b"fmt ":
+            _, _, _, byte_rate = struct.unpack("<HHII", file.read(12))
+        elif chunk_id == b"data":
+            if byte_rate:
+                media.duration = min(chunk_size, size - offset - 8) / byte_rate
+            break
+        offset += 8 + chunk_size + chunk_size % 2  # chunks are word aligned
+    return media
+
+
+def read_avi(header: bytes) -> Media:
+    media = Media("video/x-msvideo", ("video",))
+    # RIFF AVI, LIST hdrl and the main AVI header come first
+    if header[12:16] == b"LIST" and header[24:28] == b"avih":
+        frame_usec, _, _, _, frames = struct.unpack_from("<5I", header, 32)
+        media.width, media.height = struct.unpack_from("<II", header, 64)
+        media.duration = frames * frame_usec / 1000000
+    return media
+
+
+def read_ogg(file, size: int, header: bytes) -> Media:
+    """
+    Read the sample rate from the identification header of the first stream
+    and the duration from the granule position of the last page.
+    """
+    segments = header[26]
+    packet = header[27 + segments:]
+    if packet[:7] == b"\x80theora":
+        return Media("video/ogg", ("video",))
+    media = Media("audio/ogg", ("voice",))
+    rate, skip = 0, 0
+    if packet[:7] == b"\x01vorbis":
+        rate, = struct.unpack_from("<I", packet, 12)
+    elif packet[:8] == b"OpusHead":
+        skip, = struct.unpack_from("<H", packet, 10)
+        rate = 48000  # opus granules count 48 kHz samples
+    elif packet[:5] == b"\x7fFLAC":
+        rate = struct.unpack_from("!I", packet, 27)[0] >> 12
+    if not rate:
+        return media
+    file.seek(max(size - TAIL_SIZE, 0))
+    tail = file.read()
+    last_page = tail.rfind(b"OggS")
+    if last_page >= 0 and last_page + 14 <= len(tail):
+        granule, = struct.unpack_from("<q", tail, last_page + 6)
+        if granule > 0:
+            media.duration = max(granule - skip, 0) / rate
+    return media
+
+
+def read_flac(header: bytes) -> Media:
+    media = Media("audio/flac", ("voice",))
+    # STREAMINFO is the first metadata block, after the 4 byte block header
+    info, = struct.unpack_from("!Q", header, 18)
+    rate = info >> 44
+    samples = info & 0xFFFFFFFFF
+    if rate:
+        media.duration = samples / rate
+    return media
+
+
+def read_mp3(header: bytes, size: int) -> Media:
+    """
+    Estimate the duration of an MP3 file from the frame count of its Xing or
+    Info header if it has one, or from its first frame as constant bitrate.
+    """
+    media = Media("audio/mpeg", ("voice",))
+    offset = 0
+    if header[:3] == b"ID3":
+        # the tag size is a 28 bit syncsafe integer
+        tag_size = 0
+        for byte in header[6:10]:
+            tag_size = tag_size << 7 | byte & 0x7F
+        offset = 10 + tag_size
+        if offset + 4 > len(header):
+            return media  # the first frame is past the sniffed bytes
+    while offset + 4 <= len(header):
+        if header[offset] == 0xFF and header[offset + 1] & 0xE0 == 0xE0:
+            break
+        offset += 1
+    else:
+        return media
+    frame, = struct.unpack_from("!I", header, offset)
+    version = frame >> 19 & 3
+    layer = frame >> 17 & 3
+    bitrate_index = frame >> 12 & 15
+    rate_index = frame >> 10 & 3
+    mono = frame >> 6 & 3 == 3
+    if version == 1 or layer != 1 or bitrate_index in (
+            0, 15) or rate_index == 3:
+        return media  # not layer III, or a free or invalid format
+    mpeg1 = version == 3
+    bitrate = MP3_BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+    rate = MP3_SAMPLE_RATES[version][rate_index]
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    xing = offset + 4 + side_info
+    if header[xing:xing + 4] in (b"Xing", b"Info"):
+        flags, frames = struct.unpack_from("!II", header, xing + 4)
+        if flags & 1:
+            media.duration = frames * (1152 if mpeg1 else 576) / rate
+            return media
+    media.duration = (size - offset) * 8 / bitrate
+    return media
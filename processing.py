@@ -0,0 +1,148 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+from db import CONTENT_PREFIX, DB, Message
+from media import MediaStore
+from metrics import Metrics, log
+from probe import inspect_media
+
+
+class MediaProcessor:
+    """
+    Check stored media after they are received, on `workers` processes so
+    that hashing and parsing never run on the event loop and use every core.
+    Each message holding media is saved as pending, then its file is hashed
+    and sniffed and the result is saved on the message.
+
+    The queue holds up to `max_queue` messages. A message that does not fit
+    stays pending, and so does one whose process died with the server:
+    pending messages older than `retry_after` seconds are queued again every
+    `sweep_interval` seconds.
+    """
+
+    def __init__(self,
+                 db: DB,
+                 media: MediaStore,
+                 metrics: Metrics,
+                 workers: int = 2,
+                 max_queue: int = 1000,
+                 sweep_interval: float = 60,
+                 retry_after: float = 300):
+        self.__db = db
+        self.__media = media
+        self.__metrics = metrics
+        self.__workers = workers
+        self.__max_queue = max_queue
+        self.__sweep_interval = sweep_interval
+        self.__retry_after = retry_after
+        self.__queue: asyncio.Queue | None = None
+        self.__queued: set[int] = set()  # ids queued or being processed
+        self.__tasks: list[asyncio.Task] = []
+        self.__executor: ProcessPoolExecutor | None = None
+        self.__processed = 0
+        self.__deferred = 0
+
+    async def start(self):
+        self.__executor = self.__create_executor()
+        self.__queue = asyncio.Queue(self.__max_queue)
+        self.__tasks = [
+            asyncio.create_task(self.__run()) for _ in range(self.__workers)
+        ]
+        self.__tasks.append(asyncio.create_task(self.__sweep()))
+
+    async def stop(self):
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, message_id: int, content: str, media_info: dict) -> bool:
+        """
+        Queue a pending message for processing. Return False if the queue is
+        full, the message is then picked up by a later sweep.
+        """
+        if message_id in self.__queued:
+            return True
+        try:
+            self.__queue.put_nowait((message_id, content, media_info))
+        except asyncio.QueueFull:
+            self.__deferred += 1
+            return False
+        self.__queued.add(message_id)
+        return True
+
+    def get_stats(self) -> dict:
+        return {
+            "queue_depth": self.__queue.qsize() if self.__queue else 0,
+            "in_progress": len(self.__queued) -
+                           (self.__queue.qsize() if self.__queue else 0),
+            "processed": self.__processed,
+            "deferred": self.__deferred,
+        }
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message_id, content, media_info = await self.__queue.get()
+            executor = self.__executor
+            try:
+                digest = content[len(CONTENT_PREFIX):]
+                start = time.perf_counter()
+                status, found = await loop.run_in_executor(
+                    executor, inspect_media,
+                    self.__media.path(digest), media_info["type"],
+                    media_info["size"], digest)
+                self.__metrics.observe("media_processing_seconds",
+                                       time.perf_counter() - start)
+                await self.__db.set_media_info(message_id,
+                                               Message.MediaStatus(status),
+                                               {**media_info, **found})
+                self.__processed += 1
+                self.__metrics.inc("processed_media_total", status=status)
+                if status != Message.MediaStatus.VALID.value:
+                    log("media_rejected",
+                        message_id=message_id,
+                        status=status,
+                        error=found.get("error"))
+            except BrokenProcessPool as e:
+                # a process died, the pool is replaced and the message is
+                # left pending
+                log("media_processing_failed",
+                    message_id=message_id,
+                    error=str(e))
+                if executor is self.__executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self.__executor = self.__create_executor()
+            except Exception as e:
+                # left pending, a later sweep retries it
+                log("media_processing_failed",
+                    message_id=message_id,
+                    error=str(e))
+            finally:
+                self.__queued.discard(message_id)
+
+    async def __sweep(self):
+        while True:
+            await asyncio.sleep(self.__sweep_interval)
+            try:
+                free = self.__max_queue - self.__queue.qsize()
+                if free <= 0:
+                    continue
+                messages = await self.__db.get_pending_media(
+                    datetime.now() - timedelta(seconds=self.__retry_after),
+                    free)
+                for message in messages:
+                    self.submit(message.id, message.content,
+                                message.media_info)
+            except Exception as e:
+                log("media_sweep_failed", error=str(e))
+
+    def __create_executor(self) -> ProcessPoolExecutor:
+        # spawned processes do not inherit the threads of the server
+        return ProcessPoolExecutor(
+            max_workers=self.__workers,
+            mp_context=multiprocessing.get_context("spawn"))
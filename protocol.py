@@ -0,0 +1,86 @@
+import enum
+import json
+import struct
+import zlib
+from dataclasses import dataclass
+
+# Websocket subprotocol a client requests to use framed binary messages.
+# Connections that do not negotiate it use the legacy pickle format, where a
+# transfer is a pickled metadata dict followed by raw chunks.
+SUBPROTOCOL = "bluebelt.frame.v1"
+VERSION = 1
+
+# version, frame type, flags, transfer id, offset, payload length, checksum
+HEADER = struct.Struct("!BBHIQII")
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class FrameType(enum.IntEnum):
+    META = 1  # start of a transfer, payload is its JSON metadata
+    DATA = 2  # chunk of a transfer starting at `offset`
+    ACK = 3  # result of a transfer, payload is the UTF-8 status text
+    ABORT = 4  # transfer abandoned by its sender
+    RESUME = 5  # query for where to resume an upload, payload is JSON
+
+
+class Flag(enum.IntFlag):
+    CHECKSUM = 1  # checksum field holds the CRC-32 of the payload
+
+
+@dataclass
+class Frame:
+    type: FrameType
+    transfer_id: int
+    offset: int
+    payload: bytes | memoryview
+
+    def json(self) -> dict:
+        return json.loads(bytes(self.payload))
+
+    def text(self) -> str:
+        return bytes(self.payload).decode()
+
+
+def encode(type: FrameType,
+           transfer_id: int,
+           payload: bytes | memoryview = b"",
+           offset: int = 0,
+           checksum: bool = False) -> bytes:
+    """
+    Encode a frame into a single binary websocket message.
+    """
+    flags = Flag.CHECKSUM if checksum else 0
+    crc = zlib.crc32(payload) if checksum else 0
+    header = HEADER.pack(VERSION, type, flags, transfer_id, offset,
+                         len(payload), crc)
+    return header + payload
+
+
+def encode_json(type: FrameType, transfer_id: int, data: dict) -> bytes:
+    return encode(type, transfer_id, json.dumps(data).encode())
+
+
+def decode(message: bytes) -> Frame:
+    """
+    Decode a binary websocket message into a frame, validating its header.
+    The payload is a zero-copy view into `message`.
+    """
+    if len(message) < HEADER.size:
+        raise ProtocolError("Frame shorter than its header")
+    version, type, flags, transfer_id, offset, length, crc = HEADER.unpack_from(
+        message)
+    if version != VERSION:
+        raise ProtocolError("Unsupported frame version %d" % version)
+    try:
+        type = FrameType(type)
+    except ValueError:
+        raise ProtocolError("Unknown frame type %d" % type)
+    payload = memoryview(message)[HEADER.size:]
+    if len(payload) != length:
+        raise ProtocolError("Frame length does not match its payload")
+    if flags & Flag.CHECKSUM and zlib.crc32(payload) != crc:
+        raise ProtocolError("Frame checksum mismatch")
+    return Frame(type, transfer_id, offset, payload)
@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterator
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+
+@dataclass
+class RemoteMetadata:
+    name: str | None  # from content-disposition, None if not sent
+    size: int
+    content_type: str
+    fetched_at: float
+
+
+class RemoteSource:
+    """
+    Access to remote files over HTTP. Requests go through pooled keep-alive
+    sessions, HEAD responses are cached per URL for `head_ttl` seconds, and
+    downloaded bodies are kept in `cache_dir` if it is set. Both blocking and
+    asyncio variants are offered, the latter for use on the event loop.
+    """
+
+    def __init__(self,
+                 head_ttl: float = 60.0,
+                 cache_dir: str | None = None,
+                 pool_size: int = 10,
+                 timeout: float = 10.0,
+                 session: requests.Session | None = None):
+        self.__head_ttl = head_ttl
+        self.__cache_dir = cache_dir
+        self.__pool_size = pool_size
+        self.__timeout = timeout
+        self.__heads: dict[str, RemoteMetadata] = {}
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.__session = session
+        self.__async_client: httpx.AsyncClient | None = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def head(self, url: str) -> RemoteMetadata:
+        metadata = self.__cached_head(url)
+        if metadata is None:
+            response = self.__session.head(url,
+                                           allow_redirects=True,
+                                           timeout=self.__timeout)
+            metadata = self.__store_head(url, response.headers)
+        return metadata
+
+    async def ahead(self, url: str) -> RemoteMetadata:
+        metadata = self.__cached_head(url)
+        if metadata is None:
+            response = await self.__get_async_client().head(
+                url, follow_redirects=True)
+            metadata = self.__store_head(url, response.headers)
+        return metadata
+
+    def is_downloadable(self, url: str) -> bool:
+        content_type = self.head(url).content_type.lower()
+        return "text" not in content_type and "html" not in content_type
+
+    def iter_bytes(self, url: str, size: int = 1024) -> Iterator[bytes]:
+        """
+        Stream the body of `url` in chunks of `size` bytes.
+        """
+        cached = self.__cached_body(url)
+        if cached:
+            yield from self.__read_file(cached, size)
+            return
+        with self.__session.get(url, stream=True,
+                                timeout=self.__timeout) as response:
+            response.raise_for_status()
+            yield from self.__tee(url, response.iter_content(size))
+
+    async def aiter_bytes(self,
+                          url: str,
+                          size: int = 1024) -> AsyncIterator[bytes]:
+        """
+        Stream the body of `url` without blocking the event loop.
+        """
+        cached = self.__cached_body(url)
+        if cached:
+            chunks = self.__read_file(cached, size)
+            while chunk := await asyncio.to_thread(next, chunks, None):
+                yield chunk
+            return
+        async with self.__get_async_client().stream("GET", url) as response:
+            response.raise_for_status()
+            spool = self.__open_spool(url)
+            try:
+                async for chunk in response.aiter_bytes(size):
+                    if spool:
+                        await asyncio.to_thread(spool.write, chunk)
+                    yield chunk
+            except BaseException:
+                self.__discard_spool(spool)
+                raise
+            self.__commit_spool(url, spool)
+
+    async def aclose(self):
+        self.__session.close()
+        if self.__async_client is not None:
+            await self.__async_client.aclose()
+
+    def __get_async_client(self) -> httpx.AsyncClient:
+        if self.__async_client is None:
+            self.__async_client = httpx.AsyncClient(
+                timeout=self.__timeout,
+                limits=httpx.Limits(max_connections=self.__pool_size,
+                                    max_keepalive_connections=self.__pool_size))
+        return self.__async_client
+
+    def __cached_head(self, url: str) -> RemoteMetadata | None:
+        metadata = self.__heads.get(url)
+        if metadata and time.monotonic() - metadata.fetched_at < self.__head_ttl:
+            return metadata
+        return None
+
+    def __store_head(self, url: str, headers) -> RemoteMetadata:
+        content_disposition = headers.get("content-disposition")
+        names = re.findall("filename=(.+)", content_disposition or "")
+        metadata = RemoteMetadata(name=names[0] if names else None,
+                                  size=int(headers.get("content-length", 0)),
+                                  content_type=headers.get("content-type", ""),
+                                  fetched_at=time.monotonic())
+        self.__heads[url] = metadata
+        return metadata
+
+    def __cache_path(self, url: str) -> str | None:
+        if not self.__cache_dir:
+            return None
+        return os.path.join(self.__cache_dir,
+                            hashlib.sha256(url.encode()).hexdigest())
+
+    def __cached_body(self, url: str) -> str | None:
+        """
+        Get the path of the cached body of `url` if it is complete.
+        """
+        path = self.__cache_path(url)
+        if not path or not os.path.exists(path):
+            return None
+        metadata = self.__heads.get(url)
+        if metadata and metadata.size and os.path.getsize(
+                path) != metadata.size:
+            return None
+        return path
+
+    def __tee(self, url: str, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        spool = self.__open_spool(url)
+        try:
+            for chunk in chunks:
+                if spool:
+                    spool.write(chunk)
+                yield chunk
+        except BaseException:
+            self.__discard_spool(spool)
+            raise
+        self.__commit_spool(url, spool)
+
+    def __open_spool(self, url: str):
+        path = self.__cache_path(url)
+        if not path:
+            return None
+        # unique, so concurrent downloads of a URL do not share a spool
+        return tempfile.NamedTemporaryFile(
+            dir=self.__cache_dir,
+            prefix="%s." % os.path.basename(path),
+            suffix=".part",
+            delete=False)
+
+    def __commit_spool(self, url: str, spool):
+        if spool:
+            spool.close()
+            os.replace(spool.name, self.__cache_path(url))
+
+    @staticmethod
+    def __discard_spool(spool):
+        if spool:
+            spool.close()
+            os.remove(spool.name)
+
+    @staticmethod
+    def __read_file(path: str, size: int) -> Iterator[bytes]:
+        with open(path, "rb") as file:
+            while data := file.read(size):
+                yield data
+
+
+_default_source: RemoteSource | None = None
+
+
+def default_source() -> RemoteSource:
+    """
+    Get the process-wide source used when none is given explicitly.
+    """
+    global _default_source
+    if _default_source is None:
+        _default_source = RemoteSource()
+    return _default_source
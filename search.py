@@ -0,0 +1,80 @@
+import asyncio
+import base64
+import enum
+import json
+
+from db import DB
+
+
+class SearchOrder(enum.Enum):
+    RANK = "rank"  # best matches first
+    RECENT = "recent"  # newest matches first
+
+
+def match_query(text: str) -> str:
+    """
+    Turn user input into an FTS5 query matching messages that contain every
+    word, so that operators and quotes in it are searched for literally.
+    """
+    return " ".join('"%s"' % word.replace('"', '""') for word in text.split())
+
+
+def encode_cursor(rank: float, id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([rank, id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[float, int]:
+    rank, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return float(rank), int(id)
+
+
+class Searcher:
+    """
+    Search the full-text index of message content, scoped to a set of chats.
+    Results come in pages of `limit`, and each page carries an opaque cursor
+    to the next one. Ranked pages are keyed by (rank, id), so a page may
+    shift slightly if messages are written between two requests.
+    """
+
+    def __init__(self, db: DB):
+        self.__db = db
+
+    async def search(self,
+                     text: str,
+                     chat_ids: list[int],
+                     limit: int = 20,
+                     order: SearchOrder = SearchOrder.RANK,
+                     cursor: str | None = None) -> dict:
+        """
+        Raise ValueError if the text has no words or the cursor is invalid.
+        """
+        query = match_query(text)
+        if not query:
+            raise ValueError("Empty search")
+        after = None
+        if cursor is not None:
+            try:
+                after = decode_cursor(cursor)
+            except (ValueError, TypeError) as e:
+                raise ValueError("Invalid cursor") from e
+        results = []
+        if chat_ids:
+            results = await asyncio.to_thread(self.__db.search_messages,
+                                              query, chat_ids, limit + 1,
+                                              order == SearchOrder.RANK, after)
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_cursor = encode_cursor(results[-1].rank, results[-1].id)
+        return {
+            "results": [{
+                "id": e.id,
+                "chat_id": e.chat_id,
+                "content": e.content,
+                "created_at": e.created_at.isoformat(),
+                "status": e.status.value,
+                "rank": e.rank,
+                "snippet": e.snippet
+            } for e in results],
+            "next_cursor": next_cursor
+        }
@@ -1,74 +1,171 @@
+import asyncio
+import contextlib
 import os
 import pickle
-from time import sleep
+import re
+import time
+from datetime import datetime, timedelta
 from typing import List
 
 import pytz
 import uvicorn
-from fastapi import FastAPI, Query, WebSocket, WebSocketDisconnect
-
-from db import DB, Chat, Message
-from file import File
-from utils import is_now_between_range_in_timezone
+from fastapi import (FastAPI, HTTPException, Query, WebSocket,
+                     WebSocketDisconnect)
+from fastapi.responses import PlainTextResponse, StreamingResponse
+
+import protocol
+from admission import AdmissionController
+from archive import ArchiveStore
+from assets import AssetCache
+from broker import create_broker
+from cache import ChatCache
+from config import config
+from connection import ConnectionManager
+from db import DB, ChatRow, Message, MessageRow
+from export import Exporter, ExportFormat
+from ingest import IngestManager, Transfer
+from media import MediaStore, content_id
+from metrics import Metrics, configure_logging, log
+from policy import PolicyEngine
+from processing import MediaProcessor
+from protocol import FrameType, ProtocolError
+from remote import RemoteSource
+from search import Searcher, SearchOrder
+from writer import MessageWriter
 
 TEXT_SUCCESS_RESPONSE = "Saved message"
 TEXT_DISCARD_RESPONSE = "Message discarded"
+TEXT_REJECTED_RESPONSE = "Message rejected"  # over a limit, nothing saved
 AUDIO_RESPONSE = "%s/static/random_audio_to_client.mp3" % os.path.abspath(
     os.getcwd())
 IMAGE_RESPONSE = "%s/static/okay.jpg" % os.path.abspath(os.getcwd())
-SOCKETS_LIMIT = 50
-
-
-class ConnectionManager:
-
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket) -> bool:
-        if len(self.active_connections) >= SOCKETS_LIMIT:
-            await websocket.close()
-            return False
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        return True
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def send_text(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-
-    async def send_json(self, data: dict, websocket: WebSocket):
-        await websocket.send_json(data)
-
-    async def send_voice(self, file_address: str, websocket: WebSocket):
-        await self.__send_file_stream(file_address, "voice", websocket)
-
-    async def send_image(self, file_address: str, websocket: WebSocket):
-        await self.__send_file_stream(file_address, "image", websocket)
-
-    def is_connected(self, websocket: WebSocket) -> bool:
-        return websocket in self.active_connections
-
-    async def __send_file_stream(self, file_address: str, type: str,
-                                 websocket: WebSocket):
-        file = File(file_address)
-        file_metadata = file.get_metadata()
-        file_metadata["type"] = type
-        await websocket.send_bytes(pickle.dumps(file_metadata))
-
-        for chunk in file.get_bytes_stream(256):
-            await websocket.send_bytes(chunk)
+UVICORN_OPTIONS = dict(host="0.0.0.0",
+                       port=8000,
+                       ws_max_queue=500,
+                       ws_ping_interval=10,
+                       ws_ping_timeout=2)
+LEGACY_TRANSFER_ID = 0  # legacy connections carry one transfer at a time
+UPLOAD_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+MAX_SUMMARIES = 1000  # chats whose summary is retrieved in one request
+
+
+class Upload:
+    """
+    A multimedia message being received from a client. `transfer` is None if
+    the message is discarded. An upload with an `upload_id` is resumable, it
+    is kept on disk if its connection drops and can be continued later.
+    A `rejected` upload was refused by admission control, its bytes are
+    read and dropped.
+    """
+
+    def __init__(self,
+                 type: str,
+                 size: int,
+                 transfer: Transfer | None,
+                 upload_id: str | None = None,
+                 received: int = 0,
+                 name: str = "",
+                 rejected: bool = False):
+        self.type = type
+        self.size = size
+        self.received = received
+        self.transfer = transfer
+        self.upload_id = upload_id
+        self.name = name  # as sent by the client, without any directory
+        self.rejected = rejected
+        self.admitted = False  # holds a transfer slot of admission control
+        self.active_at = time.monotonic()  # when its last chunk was received
+
+    @property
+    def bytes_left(self) -> int:
+        return self.size - self.received
 
 
 class Server:
 
     def __init__(self):
-        self.__app = FastAPI()
-        self.__manager = ConnectionManager()
-        self.__db = DB()
+        configure_logging(**config.get("logging", {}))
+        self.__app = FastAPI(lifespan=self.__lifespan)
+        self.__metrics = Metrics(**config.get("metrics", {}))
+        self.__remote = RemoteSource(**config.get("remote", {}))
+        self.__manager = ConnectionManager(
+            AssetCache(**config.get("assets", {})),
+            create_broker(**config.get("broker", {})),
+            self.__remote,
+            self.__metrics,
+            **config.get("connections", {}))
+        archive = dict(config.get("archive", {}))
+        self.__compact_interval = archive.pop("compact_interval", 600)
+        self.__archive_grace = archive.pop("grace", 3600)
+        self.__db = DB(chat_cache=ChatCache(**config.get("chat_cache", {})),
+                       archive=ArchiveStore(**archive),
+                       **config.get("db", {}))
+        self.__metrics.instrument_engine(self.__db.engine)
+        self.__exporter = Exporter(self.__db, **config.get("export", {}))
+        self.__searcher = Searcher(self.__db)
+        self.__writer = MessageWriter(self.__db, **config.get("writer", {}))
+        self.__media = MediaStore(self.__db, **config.get("media", {}))
+        self.__ingest = IngestManager(self.__media,
+                                      **config.get("ingest", {}))
+        self.__processor = MediaProcessor(self.__db, self.__media,
+                                          self.__metrics,
+                                          **config.get("processing", {}))
+        self.__policy = PolicyEngine(config.get("windows"))
+        self.__admission = AdmissionController(**config.get("admission", {}))
+        uploads = config.get("uploads", {})
+        self.__partial_ttl = uploads.get("partial_ttl", 24 * 3600)
+        self.__gc_interval = uploads.get("gc_interval", 600)
+        # resumable uploads in progress in this process, by (client, upload id)
+        self.__active_uploads: set[tuple[int, str]] = set()
+        self.__init_metrics()
         self.__init_app()
 
+    @property
+    def app(self) -> FastAPI:
+        return self.__app
+
+    @contextlib.asynccontextmanager
+    async def __lifespan(self, app: FastAPI):
+        await self.__metrics.start()
+        await self.__manager.start()
+        await self.__processor.start()
+        collector = asyncio.create_task(self.__collect_partial_uploads())
+        compactor = asyncio.create_task(self.__compact_archive())
+        yield
+        collector.cancel()
+        compactor.cancel()
+        await self.__processor.stop()
+        await self.__manager.stop()
+        await self.__remote.aclose()
+        await self.__metrics.stop()
+
+    def __init_metrics(self):
+        """
+        Expose the counters other components keep through the metrics.
+        """
+        manager_stats = self.__manager.get_stats
+        for name, key, type in (
+            ("connections", "connections", "gauge"),
+            ("clients", "clients", "gauge"),
+            ("queued_messages", "queued", "gauge"),
+            ("rejected_connections_total", "rejected", "counter"),
+            ("dropped_messages_total", "dropped", "counter"),
+            ("slow_disconnects_total", "slow_disconnects", "counter"),
+        ):
+            self.__metrics.collect(name,
+                                   lambda key=key: manager_stats()[key], type)
+        self.__metrics.collect(
+            "writer_queue_depth",
+            lambda: self.__writer.get_stats()["queue_depth"])
+        self.__metrics.collect(
+            "media_queue_depth",
+            lambda: self.__processor.get_stats()["queue_depth"])
+        self.__metrics.collect("active_uploads",
+                               lambda: len(self.__active_uploads))
+        self.__metrics.collect(
+            "admitted_transfers",
+            lambda: self.__admission.get_stats()["transfers"])
+
     def __init_app(self):
         """
         Initialize the FastAPI app with routes and websocket endpoint.
@@ -82,158 +179,690 @@ class Server:
             by a unique client_id. Please note that the client must send its timezone
             as the first message after connecting.
             """
-            ok = await self.__manager.connect(websocket)
+            ok = await self.__manager.connect(websocket, client_id)
             if not ok:
                 return
-            chat = self.__db.get_chat(client_id)
-
-            # if chat is not in db, create a new chat
-            if not chat:
-                timezone = None
-                data = await websocket.receive()
-                if data["type"] == 'websocket.receive':
-                    timezone = data["text"]
-
-                # check if timezone is valid
-                try:
-                    pytz.timezone(timezone)
-                except pytz.exceptions.UnknownTimeZoneError:
-                    await self.__manager.send_text("Invalid timezone",
-                                                   websocket)
-                    await websocket.close()
-                    return
-
-                chat = self.__db.create_chat(client_id, timezone)
-
-            # handle messages
-            type = None  # type of multimedia message
-            bytes_left = -1  # number of bytes left to receive in multimedia message
-            filename = None  # filename of multimedia message, filename is None if message is discarded
-            # _todo use is_discarded flag instead of filename for better readability
+            chat = None
+            uploads: dict[int, Upload] = {}  # in-flight uploads by transfer id
+            refused: set[int] = set()  # transfers whose META was invalid
             try:
-                while True:
+                chat = await self.__db.get_chat(client_id)
+
+                # if chat is not in db, create a new chat
+                if not chat:
                     data = await websocket.receive()
+                    if data["type"] != 'websocket.receive':
+                        return
+                    timezone = data.get("text")
+
+                    # check if timezone is valid
+                    try:
+                        pytz.timezone(timezone)
+                    except (pytz.exceptions.UnknownTimeZoneError,
+                            AttributeError):
+                        await self.__manager.send_text(
+                            "Invalid timezone", websocket)
+                        await self.__manager.close(websocket)
+                        return
+
+                    chat = await self.__db.create_chat(client_id, timezone)
+
+                # handle messages
+                framed = self.__manager.is_framed(websocket)
+                while True:
+                    data = await self.__receive(websocket, uploads, chat)
                     if data["type"] == 'websocket.receive':
+                        size = len(data.get("text") or data.get("bytes") or
+                                   b"")
+                        self.__metrics.inc("received_bytes_total", size)
+                        # stop reading from a client over its byte rate
+                        delay = self.__admission.reserve_bytes(
+                            client_id, size)
+                        if delay:
+                            self.__metrics.observe("admission_delay_seconds",
+                                                   delay)
+                            await asyncio.sleep(delay)
                         if "text" in data:
                             await self.__handle_text_message(
                                 websocket, data["text"], chat)
+                        elif "bytes" in data and framed:
+                            await self.__handle_frame(websocket,
+                                                      data["bytes"], uploads,
+                                                      refused, chat)
                         elif "bytes" in data:
-                            if bytes_left == -1:  # new multimedia message
-                                type, bytes_left, filename = self.__parse_metadata(
-                                    data["bytes"], chat.timezone)
-                            elif bytes_left > 0:
-                                bytes_left = await self.__handle_multimedia_stream(
-                                    websocket, data["bytes"], filename,
-                                    bytes_left, chat)
-                                if bytes_left == 0:
-                                    if filename:
-                                        await self.__manager.send_text(
-                                            TEXT_SUCCESS_RESPONSE, websocket)
-                                        await self.__manager.send_voice(
-                                            AUDIO_RESPONSE, websocket)
-                                        if type == "video":
-                                            await self.__manager.send_image(
-                                                IMAGE_RESPONSE, websocket)
-                                    else:
-                                        self.__manager.send_text(
-                                            TEXT_DISCARD_RESPONSE, websocket)
-                                    bytes_left = -1  # reset
+                            await self.__handle_legacy_bytes(
+                                websocket, data["bytes"], uploads, chat)
 
                     elif data["type"] == 'websocket.disconnect':
                         raise WebSocketDisconnect
             except WebSocketDisconnect:
-                # delete file and set message status to unsuccessful if has any
-                if filename and os.path.exists(filename) and bytes_left > 0:
-                    os.remove(filename)
-                    self.__db.create_message(chat.id, "",
-                                             Message.Status.UNSUCCESS)
-                    print("File deleted due to client disconnect")
-                self.__manager.disconnect(websocket)
+                pass
+            finally:
+                # whatever ended the connection, keep resumable uploads,
+                # delete files and set message status to unsuccessful for the
+                # others, and unregister it
+                try:
+                    for upload in uploads.values():
+                        if upload.upload_id and upload.transfer:
+                            await self.__suspend_upload(upload, chat)
+                        else:
+                            await self.__abort_upload(upload, chat)
+                finally:
+                    await self.__manager.disconnect(websocket)
 
         @app.get("/chats")
         async def get_chats(client_id: int):
             """
             Retrieve all chats of a specific client.
             """
-            chats = self.__db.get_chats(client_id)
-            return [id for id in chats]
+            return await self.__db.get_chats(client_id)
+
+        @app.get("/chats/summary")
+        async def get_chat_summaries(chat_id: List[int] = Query([]),
+                                     client_id: int | None = None):
+            """
+            Retrieve message counts, last message time and media bytes of
+            several chats at once: the chats given as repeated `chat_id`
+            parameters, and every chat of `client_id` if given.
+            """
+            chat_ids = list(chat_id)
+            if client_id is not None:
+                chat_ids += [
+                    chat.id for chat in await self.__db.get_chats(client_id)
+                ]
+            if not chat_ids:
+                raise HTTPException(status_code=400,
+                                    detail="chat_id or client_id is required")
+            if len(chat_ids) > MAX_SUMMARIES:
+                raise HTTPException(status_code=400,
+                                    detail="At most %d chats at once" %
+                                    MAX_SUMMARIES)
+            return await self.__db.get_chat_stats(chat_ids)
 
         @app.get("/messages")
         async def get_messages(chat_id: int,
                                limit: int = Query(10, ge=1, le=100),
-                               offset: int = Query(0, ge=0)):
+                               offset: int = Query(0, ge=0),
+                               after_id: int | None = None,
+                               before_id: int | None = None):
             """
             Retrieve messages for a specific chat with pagination using limit and offset.
+            Pass `after_id` or `before_id` instead of offset to page from a
+            known message, which stays fast however deep the page is.
+            """
+            if after_id is not None and before_id is not None:
+                raise HTTPException(
+                    status_code=400,
+                    detail="after_id and before_id are mutually exclusive")
+            return await self.__db.get_messages(chat_id,
+                                                limit=limit,
+                                                offset=offset,
+                                                after_id=after_id,
+                                                before_id=before_id)
+
+        @app.get("/messages/export")
+        async def export_messages(chat_id: int,
+                                  format: ExportFormat = ExportFormat.NDJSON,
+                                  after_id: int | None = None,
+                                  since: datetime | None = None,
+                                  until: datetime | None = None,
+                                  status: Message.Status | None = None):
             """
-            messages = self.__db.get_messages(chat_id,
-                                              limit=limit,
-                                              offset=offset)
-            return messages
+            Stream every message of a chat in (created_at, id) order, as
+            NDJSON or as JSON lines of column arrays. Messages can be filtered
+            by creation time and status, and an interrupted export resumes
+            with `after_id` set to the last id received.
+            """
+            return StreamingResponse(self.__exporter.stream(
+                chat_id, format, after_id, since, until, status),
+                                     media_type="application/x-ndjson")
+
+        @app.get("/search")
+        async def search_messages(q: str,
+                                  chat_id: int | None = None,
+                                  client_id: int | None = None,
+                                  limit: int = Query(20, ge=1, le=100),
+                                  order: SearchOrder = SearchOrder.RANK,
+                                  cursor: str | None = None):
+            """
+            Search the messages of a chat, or of every chat of a client, for
+            the words of `q`. Pass the `next_cursor` of a page as `cursor` to
+            get the next one, with the same query, scope and order.
+            """
+            if (chat_id is None) == (client_id is None):
+                raise HTTPException(
+                    status_code=400,
+                    detail="Exactly one of chat_id and client_id is required")
+            chat_ids = [chat_id] if chat_id is not None else [
+                chat.id for chat in await self.__db.get_chats(client_id)
+            ]
+            with self.__metrics.timer("handler_seconds", handler="search"):
+                try:
+                    return await self.__searcher.search(
+                        q, chat_ids, limit, order, cursor)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+
+        @app.post("/clients/{client_id}/messages")
+        async def send_to_client(client_id: int, message: dict):
+            """
+            Send a JSON message to every connection of a client, whichever
+            worker holds them.
+            """
+            await self.__manager.broadcast(message, [client_id])
+            return {"status": "queued"}
+
+        @app.get("/metrics", response_class=PlainTextResponse)
+        async def get_metrics():
+            """
+            Retrieve the metrics of this worker in the Prometheus text format.
+            """
+            return self.__metrics.render()
+
+        @app.get("/stats/writer")
+        async def get_writer_stats():
+            """
+            Retrieve queue depth and commit latency of the message writer.
+            """
+            return self.__writer.get_stats()
+
+        @app.get("/stats/chat_cache")
+        async def get_chat_cache_stats():
+            """
+            Retrieve size and hit/miss counters of the chat cache.
+            """
+            return self.__db.get_chat_cache_stats()
+
+        @app.get("/stats/media")
+        async def get_media_stats():
+            """
+            Retrieve blob counts and deduplication counters of the media store.
+            """
+            return await asyncio.to_thread(self.__media.get_stats)
+
+        @app.get("/stats/archive")
+        async def get_archive_stats():
+            """
+            Retrieve segment and message counts of the archived and hot tiers.
+            """
+            return await asyncio.to_thread(self.__db.get_archive_stats)
+
+        @app.get("/stats/processing")
+        async def get_processing_stats():
+            """
+            Retrieve queue depth and counters of the media processor.
+            """
+            return self.__processor.get_stats()
+
+        @app.get("/stats/connections")
+        async def get_connection_stats():
+            """
+            Retrieve connection counts and outbound queue statistics.
+            """
+            stats = self.__manager.get_stats()
+            stats["total_connections"] = await self.__manager.connection_count()
+            return stats
+
+        @app.get("/uploads/{upload_id}")
+        async def get_upload(upload_id: str, client_id: int):
+            """
+            Retrieve the offset at which a partial upload of a client can be
+            resumed, for clients that cannot ask over their websocket.
+            """
+            return await self.__get_resume_offset(client_id, upload_id)
+
+    async def __receive(self, ws: WebSocket, uploads: dict[int, Upload],
+                        chat: ChatRow) -> dict:
+        """
+        Receive the next message of a connection. Uploads that get no chunk
+        for the idle timeout are suspended if resumable and aborted otherwise,
+        so that a silent client does not hold its transfer slots.
+        """
+        timeout = self.__admission.idle_timeout
+        while True:
+            if not uploads or not timeout:
+                return await ws.receive()
+            deadline = min(upload.active_at
+                           for upload in uploads.values()) + timeout
+            try:
+                return await asyncio.wait_for(
+                    ws.receive(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                await self.__expire_uploads(ws, uploads, chat)
+
+    async def __expire_uploads(self, ws: WebSocket, uploads: dict[int, Upload],
+                               chat: ChatRow):
+        idle_before = time.monotonic() - self.__admission.idle_timeout
+        for transfer_id, upload in list(uploads.items()):
+            if upload.active_at > idle_before:
+                continue
+            del uploads[transfer_id]
+            self.__metrics.inc("idle_uploads_total")
+            log("upload_idle", chat_id=chat.id, received=upload.received)
+            if upload.upload_id and upload.transfer:
+                await self.__suspend_upload(upload, chat)
+            else:
+                await self.__abort_upload(upload, chat)
+            if not self.__manager.is_framed(ws):
+                # the rest of a legacy stream cannot be told apart anymore
+                await self.__manager.close(ws, 1008)
+                raise WebSocketDisconnect
+            await self.__manager.send_frame(
+                protocol.encode(FrameType.ABORT, transfer_id), ws)
 
     async def __handle_text_message(self, ws: WebSocket, message: str,
-                                    chat: Chat):
+                                    chat: ChatRow):
         """
         Handle text message from client if it is in the valid time range.
         """
-        if not is_now_between_range_in_timezone("05:00", "23:59",
-                                                chat.timezone):
-            self.__db.create_message(chat.id, message, Message.Status.UNSUCCESS)
-            await self.__manager.send_text(TEXT_DISCARD_RESPONSE, ws)
+        with self.__metrics.timer("handler_seconds", handler="text"):
+            reason = self.__admission.admit_message(chat.client_id)
+            if reason is not None:
+                self.__metrics.inc("admission_rejections_total", reason=reason)
+                await self.__manager.send_text(TEXT_REJECTED_RESPONSE, ws)
+                return
+            if not self.__policy.is_allowed("text", chat.timezone):
+                await self.__write_message(chat.id, message,
+                                           Message.Status.UNSUCCESS)
+                await self.__manager.send_text(TEXT_DISCARD_RESPONSE, ws)
+                return
+            # ack only once the row is committed
+            saved = await self.__write_message(chat.id, message,
+                                               Message.Status.SUCCESS)
+            await self.__manager.send_text(
+                TEXT_SUCCESS_RESPONSE if saved else TEXT_DISCARD_RESPONSE, ws)
+
+    async def __handle_legacy_bytes(self, ws: WebSocket, message: bytes,
+                                    uploads: dict[int, Upload], chat: ChatRow):
+        """
+        Handle a binary message of a legacy connection: a pickled metadata
+        dict starts a multimedia message and raw chunks follow it. Legacy
+        uploads cannot be resumed, so an `upload_id` is ignored.
+        """
+        upload = uploads.get(LEGACY_TRANSFER_ID)
+        if upload is None:  # new multimedia message
+            metadata = pickle.loads(message)
+            metadata.pop("upload_id", None)
+            metadata.pop("offset", None)
+            uploads[LEGACY_TRANSFER_ID] = await self.__parse_metadata(
+                metadata, chat)
+            return
+
+        if len(message) > upload.bytes_left:
+            # more than declared, so not held to the upload size limit
+            del uploads[LEGACY_TRANSFER_ID]
+            await self.__abort_upload(upload, chat)
+            await self.__manager.close(ws, 1008)
+            raise WebSocketDisconnect
+        await self.__handle_multimedia_stream(message, upload, chat)
+        if upload.bytes_left == 0:
+            del uploads[LEGACY_TRANSFER_ID]
+            if upload.rejected:
+                await self.__manager.send_text(TEXT_REJECTED_RESPONSE, ws)
+                return
+            await self.__manager.send_text(
+                TEXT_SUCCESS_RESPONSE
+                if upload.transfer else TEXT_DISCARD_RESPONSE, ws)
+            await self.__send_upload_replies(ws, upload)
+
+    async def __handle_frame(self, ws: WebSocket, message: bytes,
+                             uploads: dict[int, Upload], refused: set[int],
+                             chat: ChatRow):
+        """
+        Handle a binary message of a framed connection. Frames of several
+        transfers can be interleaved with each other and with text messages.
+        A transfer whose META is invalid gets an ABORT frame, and the frames
+        of it the client sent meanwhile are dropped. So does a META reusing
+        the id of a transfer in progress, which is aborted.
+        """
+        try:
+            frame = protocol.decode(message)
+            if frame.type == FrameType.RESUME:
+                upload_id = frame.json()["upload_id"]
+                await self.__manager.send_frame(
+                    protocol.encode_json(
+                        FrameType.RESUME, frame.transfer_id,
+                        await self.__get_resume_offset(
+                            chat.client_id, upload_id)), ws)
+                return
+            if frame.type == FrameType.META and frame.transfer_id in uploads:
+                # replacing the upload would leak its slot and its file
+                await self.__abort_upload(uploads.pop(frame.transfer_id),
+                                          chat)
+                refused.add(frame.transfer_id)
+                await self.__manager.send_frame(
+                    protocol.encode(
+                        FrameType.ABORT, frame.transfer_id,
+                        b"Transfer %d is in progress" % frame.transfer_id),
+                    ws)
+                return
+            if frame.type == FrameType.META:
+                refused.discard(frame.transfer_id)
+                try:
+                    upload = await self.__parse_metadata(frame.json(), chat)
+                except (ValueError, KeyError) as e:
+                    refused.add(frame.transfer_id)
+                    await self.__manager.send_frame(
+                        protocol.encode(FrameType.ABORT, frame.transfer_id,
+                                        str(e).encode()), ws)
+                    return
+                uploads[frame.transfer_id] = upload
+                if upload.rejected:
+                    # answered now so the client can stop sending it
+                    await self.__manager.send_frame(
+                        protocol.encode(FrameType.ACK, frame.transfer_id,
+                                        TEXT_REJECTED_RESPONSE.encode()), ws)
+                return
+            upload = uploads.get(frame.transfer_id)
+            if upload is None and frame.transfer_id in refused:
+                return
+            if upload is None:
+                raise ProtocolError("Unknown transfer %d" % frame.transfer_id)
+            if frame.type == FrameType.ABORT:
+                del uploads[frame.transfer_id]
+                await self.__abort_upload(upload, chat)
+                return
+            if frame.type != FrameType.DATA or frame.offset != upload.received:
+                raise ProtocolError("Unexpected frame for transfer %d" %
+                                    frame.transfer_id)
+        except (ValueError, KeyError) as e:
+            await self.__manager.send_text("Invalid frame: %s" % e, ws)
+            return
+
+        if len(frame.payload) > upload.bytes_left:
+            # more than declared, so not held to the upload size limit
+            del uploads[frame.transfer_id]
+            await self.__abort_upload(upload, chat)
+            await self.__manager.send_frame(
+                protocol.encode(FrameType.ABORT, frame.transfer_id), ws)
+            return
+        await self.__handle_multimedia_stream(frame.payload, upload, chat)
+        if upload.bytes_left == 0:
+            del uploads[frame.transfer_id]
+            if upload.rejected:
+                return
+            status = TEXT_SUCCESS_RESPONSE if upload.transfer else TEXT_DISCARD_RESPONSE
+            await self.__manager.send_frame(
+                protocol.encode(FrameType.ACK, frame.transfer_id,
+                                status.encode()), ws)
+            await self.__send_upload_replies(ws, upload)
+
+    async def __send_upload_replies(self, ws: WebSocket, upload: Upload):
+        """
+        Send the canned multimedia responses for a saved upload.
+        """
+        if not upload.transfer:
+            return
+        await self.__manager.send_voice(AUDIO_RESPONSE, ws)
+        if upload.type == "video":
+            await self.__manager.send_image(IMAGE_RESPONSE, ws)
+
+    async def __get_resume_offset(self, client_id: int, upload_id: str) -> dict:
+        """
+        Get the offset at which a client can resume an upload, 0 if nothing
+        of it is kept. An upload still in progress cannot be resumed yet.
+        """
+        partial = await self.__db.get_partial_upload(client_id, upload_id)
+        return {
+            "upload_id": upload_id,
+            "offset": partial.received if partial else 0,
+            "in_progress": (client_id, upload_id) in self.__active_uploads
+        }
+
+    async def __parse_metadata(self, metadata: dict, chat: ChatRow) -> Upload:
+        """
+        Parse metadata of multimedia message and attach a transfer to save it
+        if it is admitted and in the valid time range. A metadata with an
+        `upload_id` and an `offset` continues a partial upload from that
+        offset.
+        """
+        with self.__metrics.timer("handler_seconds", handler="metadata"):
+            size = int(metadata["size"])
+            name = os.path.basename(metadata["name"])
+            upload_id = metadata.get("upload_id")
+            offset = int(metadata.get("offset", 0))
+            reason = self.__admission.admit_upload(chat.client_id, size)
+            if reason is not None:
+                self.__metrics.inc("admission_rejections_total", reason=reason)
+                return Upload(metadata["type"], size, None, received=offset,
+                              rejected=True)
+            try:
+                upload = await self.__start_upload(metadata, chat, size, name,
+                                                   upload_id, offset)
+            except BaseException:
+                self.__admission.release_upload(chat.client_id)
+                raise
+            upload.admitted = True
+            return upload
+
+    async def __start_upload(self, metadata: dict, chat: ChatRow, size: int,
+                             name: str, upload_id: str | None,
+                             offset: int) -> Upload:
+        """
+        Check the metadata of an admitted upload and attach a transfer to it
+        if it is in the valid time range.
+        """
+        partial = None
+        if upload_id is not None:
+            if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+                raise ProtocolError("Invalid upload id")
+            if (chat.client_id, upload_id) in self.__active_uploads:
+                raise ProtocolError("Upload %s is in progress" % upload_id)
+            partial = await self.__db.get_partial_upload(
+                chat.client_id, upload_id)
+        if offset and (partial is None or partial.received != offset or
+                       partial.size != size):
+            raise ProtocolError("Cannot resume upload at offset %d" % offset)
+
+        transfer = None
+        if metadata["type"] == "voice" and self.__policy.is_allowed(
+                "voice", chat.timezone):
+            transfer = await self.__open_transfer(
+                name, upload_id, offset, metadata["type"], size, chat)
+        elif metadata["type"] == "video" and self.__policy.is_allowed(
+                "video", chat.timezone):
+            transfer = await self.__open_transfer(
+                name, upload_id, offset, metadata["type"], size, chat)
+        elif partial is not None:
+            # the rest is discarded, so is what was kept of it
+            await self.__ingest.remove(partial.partial_path)
+            await self.__db.delete_partial_upload(chat.client_id, upload_id)
+        return Upload(metadata["type"], size, transfer, upload_id, offset,
+                      name)
+
+    async def __open_transfer(self, name: str, upload_id: str | None,
+                              offset: int, type: str, size: int,
+                              chat: ChatRow) -> Transfer:
+        if upload_id is None:
+            return self.__ingest.open(size)
+        transfer = self.__ingest.open(size,
+                                      "%d_%s" % (chat.client_id, upload_id),
+                                      offset)
+        await self.__db.save_partial_upload(chat.client_id,
+                                            upload_id,
+                                            chat_id=chat.id,
+                                            type=type,
+                                            path=name,
+                                            partial_path=transfer.path,
+                                            size=size,
+                                            received=offset)
+        self.__active_uploads.add((chat.client_id, upload_id))
+        return transfer
+
+    async def __handle_multimedia_stream(self, message: bytes, upload: Upload,
+                                         chat: ChatRow):
+        """
+        Handle a chunk of a multimedia message from client. The bytes are
+        written to disk by the ingest manager, off the event loop.
+        """
+        with self.__metrics.timer("handler_seconds", handler="chunk"):
+            upload.active_at = time.monotonic()
+            if upload.transfer:
+                await self.__ingest.write(upload.transfer, message)
+            upload.received += len(message)
+            if upload.bytes_left == 0:
+                self.__release_upload(upload, chat)
+            if upload.bytes_left == 0 and upload.transfer:
+                digest = await self.__ingest.close(upload.transfer)
+                if upload.upload_id:
+                    await self.__forget_partial_upload(upload, chat)
+                media_info = {"type": upload.type, "size": upload.size}
+                saved = await self.__write_message(chat.id,
+                                                   content_id(digest),
+                                                   Message.Status.SUCCESS,
+                                                   media_info)
+                if saved:
+                    self.__processor.submit(saved.id, saved.content,
+                                            media_info)
+                else:
+                    # nothing points at the blob, drop the reference taken
+                    # when it was stored
+                    await asyncio.to_thread(self.__media.release, digest)
+                    upload.transfer = None  # answered as discarded
+            if upload.bytes_left == 0 and not (upload.transfer or
+                                               upload.rejected):
+                await self.__write_message(chat.id, "some multimedia file",
+                                           Message.Status.UNSUCCESS)
+
+    async def __abort_upload(self, upload: Upload, chat: ChatRow):
+        """
+        Delete the file of an unfinished upload and record it as unsuccessful.
+        """
+        self.__release_upload(upload, chat)
+        if upload.transfer and upload.bytes_left > 0:
+            await self.__ingest.abort(upload.transfer)
+            if upload.upload_id:
+                await self.__forget_partial_upload(upload, chat)
+            await self.__write_message(chat.id, "", Message.Status.UNSUCCESS)
+            log("upload_aborted", chat_id=chat.id, received=upload.received)
+
+    async def __write_message(self,
+                              chat_id: int,
+                              content: str,
+                              status: Message.Status,
+                              media_info: dict | None = None
+                              ) -> MessageRow | None:
+        """
+        Save a message through the writer. Return None if its batch could
+        not be committed, so the caller answers without dropping the
+        connection.
+        """
+        try:
+            return await self.__writer.write(chat_id, content, status,
+                                             media_info)
+        except Exception as e:
+            self.__metrics.inc("failed_writes_total")
+            log("message_write_failed", chat_id=chat_id, error=str(e))
+            return None
+
+    def __release_upload(self, upload: Upload, chat: ChatRow):
+        """
+        Give the transfer slot of an upload back to admission control.
+        """
+        if upload.admitted:
+            upload.admitted = False
+            self.__admission.release_upload(chat.client_id)
+
+    async def __forget_partial_upload(self, upload: Upload, chat: ChatRow):
+        self.__active_uploads.discard((chat.client_id, upload.upload_id))
+        await self.__db.delete_partial_upload(chat.client_id,
+                                              upload.upload_id)
+
+    async def __suspend_upload(self, upload: Upload, chat: ChatRow):
+        """
+        Keep what was received of a resumable upload and persist its offset.
+        """
+        self.__release_upload(upload, chat)
+        if upload.bytes_left == 0:
             return
-        self.__db.create_message(chat.id, message, Message.Status.SUCCESS)
-        await self.__manager.send_text(TEXT_SUCCESS_RESPONSE, ws)
-
-    def __parse_metadata(self, message: bytes,
-                         timezone: str) -> tuple[str, str, str | None]:
-        """
-        Parse metadata of multimedia message and attach filename to save 
-        if it is in the valid time range. Return number of bytes left and filename.
-        """
-        metadata = pickle.loads(message)
-        bytes_left = metadata["size"]
-        filename = None
-        if metadata["type"] == "voice" and is_now_between_range_in_timezone(
-                "08:00", "12:00", timezone):
-            filename = "SERVER_RECEIVED_FROM%s_%d" % (metadata["name"],
-                                                      metadata["client_id"])
-            sleep(1)
-        elif metadata["type"] == "video" and is_now_between_range_in_timezone(
-                "08:00", "23:59", timezone):
-            filename = "SERVER_RECEIVED_FROM%s_%d" % (metadata["name"],
-                                                      metadata["client_id"])
-            sleep(2)
-        return metadata["type"], bytes_left, filename
-
-    async def __handle_multimedia_stream(self, ws: WebSocket, message: bytes,
-                                         file_to_save: str | None, bytes_left,
-                                         chat: Chat) -> int:
-        """
-        Handle multimedia message from client and return number of bytes left.
-        """
-        if file_to_save:
-            with open(file_to_save, "ab") as f:
-                f.write(message)
-        bytes_left -= len(message)
-        if bytes_left == 0 and file_to_save:
-            self.__db.create_message(chat.id, file_to_save,
-                                     Message.Status.SUCCESS)
-        if bytes_left == 0 and not file_to_save:
-            self.__db.create_message(chat.id, "some multimedia file",
-                                     Message.Status.UNSUCCESS)
-        return bytes_left
+        try:
+            await self.__ingest.suspend(upload.transfer)
+            await self.__db.save_partial_upload(
+                chat.client_id,
+                upload.upload_id,
+                chat_id=chat.id,
+                type=upload.type,
+                path=upload.name,
+                partial_path=upload.transfer.path,
+                size=upload.size,
+                received=upload.transfer.received)
+        finally:
+            self.__active_uploads.discard((chat.client_id, upload.upload_id))
+
+    async def __collect_partial_uploads(self):
+        """
+        Delete partial uploads that were not resumed within the TTL and
+        record them as unsuccessful.
+        """
+        while True:
+            try:
+                expired = await self.__db.take_expired_partial_uploads(
+                    datetime.now() - timedelta(seconds=self.__partial_ttl))
+                for partial in expired:
+                    # a transfer outliving the TTL saves its row again
+                    if (partial.client_id,
+                            partial.upload_id) in self.__active_uploads:
+                        continue
+                    await self.__ingest.remove(partial.partial_path)
+                    await self.__write_message(partial.chat_id, "",
+                                               Message.Status.UNSUCCESS)
+            except Exception as e:
+                log("partial_upload_collection_failed", error=str(e))
+            await asyncio.sleep(self.__gc_interval)
+
+    async def __compact_archive(self):
+        """
+        Move the messages of closed periods to the archive, one period at a
+        time, so the message table written to keeps only recent messages.
+        """
+        while True:
+            try:
+                closed_before = datetime.now() - timedelta(
+                    seconds=self.__archive_grace)
+                while True:
+                    with self.__metrics.timer("archive_compaction_seconds"):
+                        count = await asyncio.to_thread(
+                            self.__db.compact_archive, closed_before)
+                    if not count:
+                        break
+                    self.__metrics.inc("archived_messages_total", count)
+                    log("segment_archived", messages=count)
+            except Exception as e:
+                log("archive_compaction_failed", error=str(e))
+            await asyncio.sleep(self.__compact_interval)
 
     def start(self):
         """
         Start the server.
         """
-        uvicorn.run(self.__app,
-                    host="0.0.0.0",
-                    port=8000,
-                    ws_max_queue=500,
-                    ws_ping_interval=10,
-                    ws_ping_timeout=2)
+        uvicorn.run(self.__app, **UVICORN_OPTIONS)
+
+
+def create_app() -> FastAPI:
+    """
+    Build the app of a worker process.
+    """
+    return Server().app
+
+
+def start_workers(workers: int):
+    """
+    Start the server as several worker processes listening on the same port.
+    Each worker builds its own app with `create_app`, and the workers share
+    connection state through the configured broker.
+    """
+    if config.get("broker", {}).get("backend", "local") == "local":
+        raise ValueError("Running several workers needs a shared broker")
+    uvicorn.run("server:create_app",
+                factory=True,
+                workers=workers,
+                **UVICORN_OPTIONS)
 
 
 if __name__ == "__main__":
-    server = Server()
-    server.start()
+    workers = config.get("workers", 1)
+    if workers > 1:
+        start_workers(workers)
+    else:
+        server = Server()
+        server.start()
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# config.yml is loaded from the working directory when config is imported
+os.chdir(ROOT)
+
+from config import config  # noqa: E402
+
+
+@pytest.fixture
+def make_server(tmp_path, monkeypatch):
+    """
+    Build servers keeping their database, media and archive in a temporary
+    directory and saving every kind of message at any time. Keyword
+    arguments override entries of config sections.
+    """
+    from server import Server
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(config, "windows", {
+        "text": ["00:00", "23:59"],
+        "voice": ["00:00", "23:59"],
+        "video": ["00:00", "23:59"],
+    })
+
+    def make_server(**sections) -> Server:
+        for name, values in sections.items():
+            monkeypatch.setitem(config, name, {
+                **config.get(name, {}),
+                **values
+            })
+        return Server()
+
+    return make_server
+
+
+@pytest.fixture
+def server(make_server):
+    return make_server()
@@ -0,0 +1,45 @@
+from admission import AdmissionController
+
+
+def test_upload_slots_are_given_back():
+    admission = AdmissionController(max_transfers_per_client=2,
+                                    max_transfers=3)
+    assert admission.admit_upload(1, 10) is None
+    assert admission.admit_upload(1, 10) is None
+    assert admission.admit_upload(1, 10) == "client transfers"
+    assert admission.admit_upload(2, 10) is None
+    assert admission.admit_upload(3, 10) == "global transfers"
+    assert admission.get_stats()["transfers"] == 3
+
+    admission.release_upload(1)
+    assert admission.get_stats()["transfers"] == 2
+    assert admission.admit_upload(3, 10) is None
+    for client_id in (1, 2, 3):
+        admission.release_upload(client_id)
+    assert admission.get_stats()["transfers"] == 0
+
+
+def test_release_without_a_slot_is_ignored():
+    admission = AdmissionController()
+    admission.release_upload(1)  # unknown client
+    assert admission.admit_message(1) is None
+    admission.release_upload(1)  # known client without transfers
+    assert admission.get_stats()["transfers"] == 0
+    assert admission.admit_upload(1, 10) is None
+    admission.release_upload(1)
+    admission.release_upload(1)
+    assert admission.get_stats()["transfers"] == 0
+
+
+def test_rejected_uploads_take_no_slot():
+    admission = AdmissionController(message_burst=1, max_upload_size=100)
+    assert admission.admit_upload(1, 101) == "upload size"
+    assert admission.admit_upload(1, 10) is None
+    assert admission.admit_upload(1, 10) == "client message rate"
+    assert admission.get_stats()["transfers"] == 1
+
+
+def test_byte_reservations_wait_for_the_debt():
+    admission = AdmissionController(byte_rate=1000, byte_burst=1000)
+    assert admission.reserve_bytes(1, 1000) == 0
+    assert 0.9 < admission.reserve_bytes(1, 1000) <= 1
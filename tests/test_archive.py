@@ -0,0 +1,121 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from archive import ArchiveStore, Segment
+from db import DB, Message
+
+START = datetime(2024, 1, 1)  # a period start with 7 day periods
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ArchiveStore(str(tmp_path), period_days=7, cache_size=0)
+
+
+def write_segments(store: ArchiveStore, periods=3, segments=2, rows=10):
+    """
+    Write `segments` segments of `rows` messages of chat 1 and 2 per period,
+    one message per hour. Return the (period start, path) of the segments
+    and the rows of chat 1 in (created_at, id) order.
+    """
+    paths, expected = [], []
+    id = 1
+    for period in range(periods):
+        period_start = store.period_start(START + timedelta(days=7 * period))
+        for _ in range(segments):
+            chat_rows = []
+            for chat_id in (1, 2):
+                for _ in range(rows):
+                    row = (id, "m%d" % id, period_start + timedelta(hours=id),
+                           "success" if id % 3 else "unsuccess", None, None)
+                    chat_rows.append((chat_id, row))
+                    if chat_id == 1:
+                        expected.append(row)
+                    id += 1
+            paths.append(
+                (period_start,
+                 store.write(period_start, chat_rows[0][1][0], chat_rows)))
+    return paths, expected
+
+
+def test_pages_forward_and_backward(store):
+    segments, expected = write_segments(store)
+    rows, after = [], None
+    while page := store.read(segments, 1, 7, after=after):
+        rows += page
+        after = (page[-1][2], page[-1][0])
+    assert rows == expected
+
+    rows, before = [], (datetime.max, 0)
+    while page := store.read(segments, 1, 7, before=before):
+        rows += page
+        before = (page[-1][2], page[-1][0])
+    assert rows == expected[::-1]
+
+
+def test_filters_by_time_and_status(store):
+    segments, expected = write_segments(store)
+    since, until = expected[5][2], expected[40][2]
+    rows = store.read(segments, 1, 100, since=since, until=until,
+                      status="success")
+    assert rows == [
+        row for row in expected
+        if since <= row[2] < until and row[3] == "success"
+    ]
+
+
+def test_skips_segments_outside_the_page(store, monkeypatch):
+    segments, expected = write_segments(store)
+    read = []
+    read_chat = Segment.read_chat
+    monkeypatch.setattr(
+        Segment, "read_chat",
+        lambda segment, chat_id: read.append(segment.path) or read_chat(
+            segment, chat_id))
+
+    cursor = expected[-5]
+    rows = store.read(segments, 1, 3, after=(cursor[2], cursor[0]))
+    assert rows == expected[-4:-1]
+    assert read == [segments[-1][1]]
+
+    read.clear()
+    cursor = expected[12]
+    rows = store.read(segments, 1, 4, before=(cursor[2], cursor[0]))
+    assert rows == expected[8:12][::-1]
+    assert read == [segments[1][1], segments[0][1]]
+
+
+
+def test_pages_across_archived_and_live_messages(tmp_path):
+    archive = ArchiveStore(str(tmp_path / "archive"),
+                           period_days=7,
+                           segment_rows=4)
+    db = DB("sqlite:///%s" % (tmp_path / "local.db"), archive=archive)
+    chat = asyncio.run(db.create_chat(1, "UTC"))
+    now = datetime.now()
+    db.create_messages([(chat.id, "m%d" % i, Message.Status.SUCCESS,
+                         now - timedelta(days=30 - i), None)
+                        for i in range(10)])
+    db.create_messages([(chat.id, "m%d" % i, Message.Status.SUCCESS,
+                         now - timedelta(minutes=20 - i), None)
+                        for i in range(10, 15)])
+    while db.compact_archive(now - timedelta(days=14)):
+        pass
+    assert db.get_archive_stats()["archived"] == 10
+
+    messages, page = [], asyncio.run(db.get_messages(chat.id, limit=4))
+    while page:
+        messages += page
+        page = asyncio.run(
+            db.get_messages(chat.id, limit=4, after_id=page[-1].id))
+    assert [message.content for message in messages
+            ] == ["m%d" % i for i in range(15)]
+
+    older, page = [], [messages[-1]]
+    while page:
+        page = asyncio.run(
+            db.get_messages(chat.id, limit=4, before_id=page[0].id))
+        older = page + older
+    assert older == messages[:-1]
@@ -0,0 +1,51 @@
+import asyncio
+
+from connection import ConnectionManager
+
+
+class WebSocket:
+    """
+    A websocket whose reader takes every message once `ready` is set.
+    """
+
+    def __init__(self, ready: bool = True):
+        self.scope = {}
+        self.ready = asyncio.Event()
+        if ready:
+            self.ready.set()
+        self.received = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, message: str):
+        await self.ready.wait()
+        self.received.append(message)
+
+
+def test_broadcast_does_not_wait_for_a_slow_reader():
+
+    async def main():
+        manager = ConnectionManager(queue_size=1, backpressure="block")
+        await manager.start()
+        slow, fast = WebSocket(ready=False), WebSocket()
+        assert await manager.connect(slow, 1)
+        assert await manager.connect(fast, 2)
+        for i in range(5):
+            await asyncio.wait_for(manager.broadcast("m%d" % i), 1)
+            await asyncio.sleep(0)
+        assert fast.received == ["m%d" % i for i in range(5)]
+        assert manager.get_stats()["dropped"] > 0
+
+        # a reply to the sender still waits for room in its queue
+        reply = asyncio.create_task(manager.send_text("reply", slow))
+        await asyncio.sleep(0.01)
+        assert not reply.done()
+        slow.ready.set()
+        await asyncio.wait_for(reply, 1)
+        await manager.stop()
+
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+import hashlib
+import os
+
+import pytest
+
+from db import DB
+from ingest import Transfer
+from media import MediaStore
+
+CONTENT = os.urandom(1000)
+
+
+@pytest.fixture
+def store(tmp_path):
+    db = DB("sqlite:///%s" % (tmp_path / "local.db"))
+    return MediaStore(db, str(tmp_path / "media"), prefix_size=100)
+
+
+def receive(store: MediaStore, content: bytes) -> Transfer:
+    transfer = Transfer(store.temp_path(), len(content), store)
+    for start in range(0, len(content), 300):
+        transfer.write_chunk(content[start:start + 300])
+    return transfer
+
+
+def test_repeated_upload_is_stored_once(store):
+    first = receive(store, CONTENT).store()
+    second = receive(store, CONTENT).store()
+    assert first == second == hashlib.sha256(CONTENT).hexdigest()
+    stats = store.get_stats()
+    assert (stats["stored"], stats["deduplicated"]) == (1, 1)
+    assert stats["skipped_bytes"] == len(CONTENT) - 100
+
+
+def test_blob_deleted_before_a_matching_upload_commits(store, monkeypatch):
+    digest = receive(store, CONTENT).store()
+    transfer = receive(store, CONTENT)
+    commit = store.commit
+
+    def release_then_commit(*args):
+        # the only reference is dropped right before the commit
+        store.release(digest)
+        return commit(*args)
+
+    monkeypatch.setattr(store, "commit", release_then_commit)
+    assert transfer.store() == digest
+    with open(store.path(digest), "rb") as file:
+        assert file.read() == CONTENT
+    assert not os.listdir(os.path.dirname(store.temp_path()))
@@ -0,0 +1,130 @@
+import hashlib
+import io
+import struct
+
+import pytest
+
+import probe
+
+
+def box(type: bytes, body: bytes) -> bytes:
+    return struct.pack("!I4s", 8 + len(body), type) + body
+
+
+def wav() -> bytes:
+    fmt = struct.pack("<HHIIHH", 1, 1, 8000, 16000, 2, 16)
+    data = b"\0" * 32000
+    body = (b"WAVE" + b"fmt " + struct.pack("<I", len(fmt)) + fmt + b"data" +
+            struct.pack("<I", len(data)) + data)
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+def mp3(xing_frames: int | None = None) -> bytes:
+    # MPEG-1 layer III, 128 kbit/s, 44.1 kHz, stereo
+    frame = struct.pack("!I", 0xFFFB9000) + b"\0" * 32
+    if xing_frames is not None:
+        frame += b"Xing" + struct.pack("!II", 1, xing_frames)
+    return frame + b"\0" * (16000 - len(frame))
+
+
+def mp4(width: int = 0, height: int = 0) -> bytes:
+    mvhd = b"\0" * 12 + struct.pack("!II", 1000, 5000) + b"\0" * 80
+    tkhd = b"\0" * 76 + struct.pack("!II", width << 16, height << 16)
+    moov = box(b"mvhd", mvhd) + box(b"trak", box(b"tkhd", tkhd))
+    return box(b"ftyp", b"isom\0\0\0\0") + box(b"free", b"\0" * 10) + box(
+        b"moov", moov)
+
+
+def ogg_page(granule: int, packet: bytes) -> bytes:
+    return (b"OggS\0\0" + struct.pack("<qII", granule, 1, 0) + b"\0\0\0\0" +
+            bytes([1, len(packet)]) + packet)
+
+
+def opus() -> bytes:
+    head = b"OpusHead" + bytes([1, 2]) + struct.pack("<HI", 312, 48000)
+    return ogg_page(0, head) + ogg_page(48000 * 3 + 312, b"\0" * 100)
+
+
+def flac() -> bytes:
+    info = struct.pack("!HH", 4096, 4096) + b"\0" * 6 + struct.pack(
+        "!Q", 44100 << 44 | 88200)
+    return b"fLaC" + b"\0\0\0\x22" + info + b"\0" * 16
+
+
+def avi() -> bytes:
+    header = bytearray(512)
+    header[0:12] = b"RIFF\0\0\0\0AVI "
+    header[12:16] = b"LIST"
+    header[24:28] = b"avih"
+    struct.pack_into("<5I", header, 32, 40000, 0, 0, 0, 250)
+    struct.pack_into("<II", header, 64, 320, 240)
+    return bytes(header)
+
+
+def sniff(data: bytes) -> probe.Media:
+    return probe.sniff(io.BytesIO(data), len(data))
+
+
+@pytest.mark.parametrize("data, mime, kinds, duration, dimensions", [
+    (wav(), "audio/wav", ("voice",), 2.0, (None, None)),
+    (mp3(), "audio/mpeg", ("voice",), 1.0, (None, None)),
+    (mp3(38), "audio/mpeg", ("voice",), 38 * 1152 / 44100, (None, None)),
+    (mp4(640, 480), "video/mp4", ("video",), 5.0, (640, 480)),
+    (mp4(), "audio/mp4", ("voice",), 5.0, (None, None)),
+    (opus(), "audio/ogg", ("voice",), 3.0, (None, None)),
+    (flac(), "audio/flac", ("voice",), 2.0, (None, None)),
+    (avi(), "video/x-msvideo", ("video",), 10.0, (320, 240)),
+    (b"\x89PNG\r\n\x1a\n" + b"\0" * 8, "image/png", (), None, (None, None)),
+    (b"plain text", "application/octet-stream", (), None, (None, None)),
+])
+def test_sniff(data, mime, kinds, duration, dimensions):
+    media = sniff(data)
+    assert (media.mime, media.kinds) == (mime, kinds)
+    assert media.duration == pytest.approx(duration)
+    assert (media.width, media.height) == dimensions
+
+
+def test_id3_tag_is_skipped():
+    tag = b"ID3\x04\0\0" + bytes([0, 0, 1, 0]) + b"\0" * 128
+    media = sniff(tag + mp3())
+    assert media.mime == "audio/mpeg"
+    assert media.duration == pytest.approx(1.0)
+
+
+def test_invalid_box_is_an_error():
+    with pytest.raises(ValueError):
+        sniff(box(b"ftyp", b"isom\0\0\0\0") + struct.pack("!I4s", 4, b"moov"))
+
+
+@pytest.fixture
+def stored(tmp_path):
+    data = mp3()
+    path = tmp_path / "blob"
+    path.write_bytes(data)
+    return str(path), len(data), hashlib.sha256(data).hexdigest()
+
+
+def test_inspect_valid_media(stored):
+    path, size, digest = stored
+    status, info = probe.inspect_media(path, "voice", size, digest)
+    assert status == "valid"
+    assert info["mime"] == "audio/mpeg"
+    assert "error" not in info
+
+
+@pytest.mark.parametrize("type, size, digest, error", [
+    ("video", None, None, "audio/mpeg is not a video"),
+    ("voice", 10, None, "size 16000, 10 declared"),
+    ("voice", None, "0" * 64, "checksum mismatch"),
+])
+def test_inspect_invalid_media(stored, type, size, digest, error):
+    path, actual_size, actual_digest = stored
+    status, info = probe.inspect_media(path, type, size or actual_size, digest
+                                       or actual_digest)
+    assert (status, info["error"]) == ("invalid", error)
+
+
+def test_inspect_missing_media(tmp_path):
+    status, info = probe.inspect_media(str(tmp_path / "missing"), "voice", 1,
+                                       "0" * 64)
+    assert status == "failed"
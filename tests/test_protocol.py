@@ -0,0 +1,47 @@
+import pytest
+
+import protocol
+from protocol import HEADER, FrameType, ProtocolError
+
+
+@pytest.mark.parametrize("checksum", [False, True])
+def test_encode_decode_round_trip(checksum):
+    message = protocol.encode(FrameType.DATA,
+                              7,
+                              b"chunk",
+                              offset=1 << 40,
+                              checksum=checksum)
+    frame = protocol.decode(message)
+    assert (frame.type, frame.transfer_id, frame.offset) == (FrameType.DATA, 7,
+                                                             1 << 40)
+    assert bytes(frame.payload) == b"chunk"
+
+
+def test_json_payload():
+    message = protocol.encode_json(FrameType.META, 1, {"size": 3})
+    assert protocol.decode(message).json() == {"size": 3}
+
+
+def test_payload_is_a_view_of_the_message():
+    message = bytearray(protocol.encode(FrameType.DATA, 1, b"abc"))
+    frame = protocol.decode(message)
+    message[-1:] = b"d"
+    assert bytes(frame.payload) == b"abd"
+
+
+@pytest.mark.parametrize("message, error", [
+    (b"\x01\x02", "shorter than its header"),
+    (b"\x02" + protocol.encode(FrameType.ACK, 1)[1:], "version 2"),
+    (protocol.encode(FrameType.ACK, 1)[:1] + b"\x09" +
+     protocol.encode(FrameType.ACK, 1)[2:], "frame type 9"),
+    (protocol.encode(FrameType.DATA, 1, b"abc")[:-1], "length"),
+    (protocol.encode(FrameType.DATA, 1, b"abc", checksum=True)[:-1] + b"d",
+     "checksum"),
+])
+def test_invalid_frames_are_rejected(message, error):
+    with pytest.raises(ProtocolError, match=error):
+        protocol.decode(message)
+
+
+def test_header_size():
+    assert HEADER.size == len(protocol.encode(FrameType.ABORT, 1))
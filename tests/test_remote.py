@@ -0,0 +1,41 @@
+import os
+
+from remote import RemoteSource
+
+BODY = b"0123456789" * 100
+
+
+class Response:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size: int):
+        for start in range(0, len(BODY), size):
+            yield BODY[start:start + size]
+
+
+class Session:
+
+    def get(self, url: str, **kwargs) -> Response:
+        return Response()
+
+
+def test_concurrent_downloads_of_a_url_are_cached(tmp_path):
+    source = RemoteSource(cache_dir=str(tmp_path), session=Session())
+    url = "http://example.com/a.mp3"
+    first = source.iter_bytes(url, 100)
+    second = source.iter_bytes(url, 100)
+    chunks = [next(first), next(second)]
+    assert chunks[0] + b"".join(first) == BODY
+    assert chunks[1] + b"".join(second) == BODY
+    # one cached body and no spool left behind
+    assert len(os.listdir(tmp_path)) == 1
+    assert not os.listdir(tmp_path)[0].endswith(".part")
+    assert b"".join(source.iter_bytes(url, 100)) == BODY
@@ -0,0 +1,104 @@
+import glob
+import hashlib
+import os
+
+from fastapi.testclient import TestClient
+
+import protocol
+from protocol import FrameType
+
+
+def metric(client: TestClient, name: str) -> float:
+    for line in client.get("/metrics").text.splitlines():
+        if line.startswith("bluebelt_%s " % name):
+            return float(line.split()[1])
+    raise KeyError(name)
+
+
+def connect(client: TestClient, client_id: int):
+    return client.websocket_connect("/ws/%d" % client_id,
+                                    subprotocols=[protocol.SUBPROTOCOL])
+
+
+def test_resumed_upload_continues_from_its_offset(make_server):
+    server = make_server(admission={"idle_timeout": 0.2})
+    data = os.urandom(300000)
+    meta = {
+        "type": "voice",
+        "name": "a.mp3",
+        "size": len(data),
+        "upload_id": "u1"
+    }
+    with TestClient(server.app) as client:
+        with connect(client, 1) as ws:
+            ws.send_text("UTC")
+            ws.send_bytes(protocol.encode_json(FrameType.META, 1, meta))
+            ws.send_bytes(protocol.encode(FrameType.DATA, 1, data[:100000]))
+            ws.send_bytes(
+                protocol.encode(FrameType.DATA, 1, data[100000:200000],
+                                100000))
+            # an idle resumable upload is suspended
+            frame = protocol.decode(ws.receive_bytes())
+            assert (frame.type, frame.transfer_id) == (FrameType.ABORT, 1)
+
+            ws.send_bytes(
+                protocol.encode_json(FrameType.RESUME, 2, {"upload_id": "u1"}))
+            frame = protocol.decode(ws.receive_bytes())
+            assert frame.type == FrameType.RESUME
+            assert frame.json() == {
+                "upload_id": "u1",
+                "offset": 200000,
+                "in_progress": False
+            }
+
+            # only the offset kept can be resumed from
+            ws.send_bytes(
+                protocol.encode_json(FrameType.META, 3, {
+                    **meta, "offset": 100000
+                }))
+            frame = protocol.decode(ws.receive_bytes())
+            assert (frame.type, frame.text()) == (
+                FrameType.ABORT, "Cannot resume upload at offset 100000")
+
+            ws.send_bytes(
+                protocol.encode_json(FrameType.META, 4, {
+                    **meta, "offset": 200000
+                }))
+            ws.send_bytes(
+                protocol.encode(FrameType.DATA, 4, data[200000:], 200000))
+            frame = protocol.decode(ws.receive_bytes())
+            assert (frame.type, frame.text()) == (FrameType.ACK,
+                                                  "Saved message")
+
+        assert client.get("/uploads/u1", params={
+            "client_id": 1
+        }).json()["offset"] == 0
+        chat = client.get("/chats", params={"client_id": 1}).json()[0]
+        messages = client.get("/messages", params={
+            "chat_id": chat["id"]
+        }).json()
+        assert messages[-1]["content"] == "sha256:%s" % hashlib.sha256(
+            data).hexdigest()
+
+
+def test_reused_transfer_id_aborts_upload(server, tmp_path):
+    meta = protocol.encode_json(FrameType.META, 1, {
+        "type": "voice",
+        "name": "a.ogg",
+        "size": 200000
+    })
+    with TestClient(server.app) as client:
+        with connect(client, 1) as ws:
+            ws.send_text("UTC")
+            ws.send_bytes(meta)
+            ws.send_bytes(protocol.encode(FrameType.DATA, 1, b"x" * 100000))
+            ws.send_bytes(meta)
+            ws.send_bytes(protocol.encode(FrameType.DATA, 1, b"y" * 100000))
+            frame = protocol.decode(ws.receive_bytes())
+            assert frame.type == FrameType.ABORT
+            assert frame.transfer_id == 1
+            # the frames sent behind the reused META are dropped
+            ws.send_text("hello")
+            assert ws.receive_text() == "Saved message"
+            assert metric(client, "admitted_transfers") == 0
+            assert not glob.glob(str(tmp_path / "media" / "tmp" / "*.part"))
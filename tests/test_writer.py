@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from db import DB, Message
+from writer import MessageWriter
+
+
+@pytest.fixture
+def db(tmp_path):
+    return DB("sqlite:///%s" % (tmp_path / "local.db"))
+
+
+def test_concurrent_writes_share_a_commit(db):
+
+    async def main():
+        chat = await db.create_chat(1, "UTC")
+        writer = MessageWriter(db, batch_size=8, max_delay=1)
+        messages = await asyncio.gather(*[
+            writer.write(chat.id, "m%d" % i, Message.Status.SUCCESS)
+            for i in range(8)
+        ])
+        return chat, messages, writer.get_stats()
+
+    chat, messages, stats = asyncio.run(main())
+    assert [message.content for message in messages
+            ] == ["m%d" % i for i in range(8)]
+    assert (stats["batches"], stats["rows"]) == (1, 8)
+    stored = asyncio.run(db.get_messages(chat.id, limit=10))
+    assert [message.id for message in stored
+            ] == [message.id for message in messages]
+
+
+def test_commit_error_reaches_every_writer(db, monkeypatch):
+
+    def fail(rows):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(db, "create_messages", fail)
+
+    async def main():
+        writer = MessageWriter(db, batch_size=4, max_delay=1)
+        writes = [
+            writer.write(1, "m%d" % i, Message.Status.SUCCESS)
+            for i in range(4)
+        ]
+        return writer, await asyncio.gather(*writes, return_exceptions=True)
+
+    writer, results = asyncio.run(main())
+    assert [str(result) for result in results] == ["disk full"] * 4
+    assert writer.get_stats()["failed_batches"] == 1
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from db import DB, Message, MessageRow
+
+
+class MessageWriter:
+    """
+    Write-behind queue for messages. Rows submitted by every connection are
+    collected into batches and persisted with a single commit, so the event
+    loop never waits on the disk. A batch is flushed once it holds
+    `batch_size` rows or once its first row has waited `max_delay` seconds.
+    """
+
+    def __init__(self,
+                 db: DB,
+                 batch_size: int = 64,
+                 max_delay: float = 0.005,
+                 max_queue: int = 10000):
+        self.__db = db
+        self.__batch_size = batch_size
+        self.__max_delay = max_delay
+        self.__max_queue = max_queue
+        self.__queue: asyncio.Queue | None = None
+        self.__batch_full: asyncio.Event | None = None
+        self.__task: asyncio.Task | None = None
+        # a single thread keeps commits serialized, batches queue up behind it
+        self.__executor = ThreadPoolExecutor(max_workers=1,
+                                             thread_name_prefix="writer")
+        self.__batches = 0
+        self.__rows = 0
+        self.__failed_batches = 0
+        self.__commit_seconds_total = 0.0
+        self.__commit_seconds_last = 0.0
+        self.__commit_seconds_max = 0.0
+
+    async def write(self,
+                    chat_id: int,
+                    content: str,
+                    status: Message.Status,
+                    media_info: dict | None = None) -> MessageRow:
+        """
+        Queue a message and wait until the batch holding it is committed.
+        Raise the commit error if the batch could not be persisted. A message
+        with `media_info` is saved as pending media processing.
+        """
+        self.__ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self.__queue.put(
+            (chat_id, content, status, datetime.now(), media_info, future))
+        if self.__queue.qsize() >= self.__batch_size:
+            self.__batch_full.set()
+        return await future
+
+    def get_stats(self) -> dict:
+        """
+        Get queue depth and commit latency statistics of the writer.
+        """
+        batches = self.__batches
+        return {
+            "queue_depth": self.__queue.qsize() if self.__queue else 0,
+            "batches": batches,
+            "rows": self.__rows,
+            "failed_batches": self.__failed_batches,
+            "avg_batch_size": self.__rows / batches if batches else 0,
+            "last_commit_ms": self.__commit_seconds_last * 1000,
+            "avg_commit_ms": (self.__commit_seconds_total * 1000 /
+                              batches if batches else 0),
+            "max_commit_ms": self.__commit_seconds_max * 1000,
+        }
+
+    def __ensure_started(self):
+        # the queue must be created inside the running loop
+        if self.__task is None or self.__task.done():
+            self.__queue = asyncio.Queue(self.__max_queue)
+            self.__batch_full = asyncio.Event()
+            self.__task = asyncio.create_task(self.__run())
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.__queue.get()]
+            if self.__queue.qsize() + 1 < self.__batch_size:
+                self.__batch_full.clear()
+                try:
+                    await asyncio.wait_for(self.__batch_full.wait(),
+                                           self.__max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.__batch_size and not self.__queue.empty():
+                batch.append(self.__queue.get_nowait())
+
+            rows = [row[:-1] for row in batch]
+            start = time.perf_counter()
+            try:
+                messages = await loop.run_in_executor(
+                    self.__executor, self.__db.create_messages, rows)
+            except Exception as e:
+                self.__failed_batches += 1
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            elapsed = time.perf_counter() - start
+
+            self.__batches += 1
+            self.__rows += len(batch)
+            self.__commit_seconds_last = elapsed
+            self.__commit_seconds_total += elapsed
+            self.__commit_seconds_max = max(self.__commit_seconds_max, elapsed)
+            for (*_, future), message in zip(batch, messages):
+                if not future.done():
+                    future.set_result(message)